@@ -0,0 +1,17 @@
+"""
+Benchmarks for the taskApi app, see the Benchmarks section of the README
+"""
+import os
+
+
+def setup_django(**environ):
+    """
+    Load Django with the given environment variables overriding the settings
+    """
+    os.environ.update(environ)
+    for name, value in (("SECRET_KEY", "benchmarks"), ("APP_NAME", "benchmarks"),
+                        ("API_CONTACT_EMAIL", "benchmarks@localhost"),
+                        ("DJANGO_SETTINGS_MODULE", "taskPrj.settings")):
+        os.environ.setdefault(name, value)
+    import django
+    django.setup()
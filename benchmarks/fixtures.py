@@ -0,0 +1,148 @@
+"""
+Synthetic studies for the benchmarks, laid out as the upstream repositories serve them:
+    {root}/pub/databases/metabolights/studies/public/MTBLSxxx/   MetaboLights (FTP and http)
+    {root}/workbench/STxxx/                                      Metabolomics-Workbench
+    {root}/public/metabobank/study/MTBKSxxx/                     MetaboBank
+"""
+import json
+import os
+import random
+
+MTBLS_DIR = os.path.join("pub", "databases", "metabolights", "studies", "public")
+MTWB_DIR = "workbench"
+MTBK_DIR = os.path.join("public", "metabobank", "study")
+
+MAF_COLUMNS = ["database_identifier", "chemical_formula", "smiles", "inchi",
+               "metabolite_identification", "mass_to_charge", "fragmentation",
+               "modifications", "charge", "retention_time", "taxid", "species",
+               "database", "database_version", "reliability", "uri",
+               "search_engine", "search_engine_score",
+               "smallmolecule_abundance_sub", "smallmolecule_abundance_stdev_sub",
+               "smallmolecule_abundance_std_error_sub"]
+
+
+def metabolite_name(rng, i):
+    return f"metabolite {i} ({rng.choice(['L', 'D', 'alpha', 'beta'])}-{rng.randrange(10 ** 6)})"
+
+
+def write_maf(path, rows, samples, seed=0, missing_ratio=0.02):
+    """
+    Write a metabolite assignment file (MAF) with `rows` metabolites and
+    `samples` abundance columns, some of them without identification
+    """
+    rng = random.Random(seed)
+    sample_columns = [f"sample_{j}" for j in range(samples)]
+    with open(path, "w") as f:
+        f.write("\t".join(MAF_COLUMNS + sample_columns) + "\n")
+        for i in range(rows):
+            name = "" if rng.random() < missing_ratio else metabolite_name(rng, i)
+            fields = [f"CHEBI:{i}", "C6H12O6", "OC1C(O)C(O)C(CO)OC1O", "InChI=1S/C6H12O6",
+                      name, f"{rng.uniform(50, 1500):.4f}", "", "", "1",
+                      f"{rng.uniform(0, 30):.2f}", "9606", "Homo sapiens",
+                      "ChEBI", "v1", "1", "", "", "", "", "", ""]
+            fields += [f"{rng.uniform(0, 1e6):.3f}" for j in range(samples)]
+            f.write("\t".join(fields) + "\n")
+    return path
+
+
+def write_metadata(path, accession, comments=200,
+                   title_key="Study Title", description_key="Study Description"):
+    with open(path, "w") as f:
+        f.write(f"{title_key}\tSynthetic study {accession}\n")
+        f.write(f"{description_key}\t" + "Synthetic study generated for benchmarking. " * 20 + "\n")
+        for i in range(comments):
+            f.write(f"Comment[field {i}]\tvalue {i}\n")
+    return path
+
+
+def make_mtbls_study(root, accession, maf_files=1, rows=1000, samples=20, raw_files=100, seed=0):
+    study_dir = os.path.join(root, MTBLS_DIR, accession)
+    os.makedirs(os.path.join(study_dir, "FILES", "RAW"), exist_ok=True)
+    write_metadata(os.path.join(study_dir, "i_Investigation.txt"), accession)
+    with open(os.path.join(study_dir, f"s_{accession}.txt"), "w") as f:
+        f.write("Source Name\tSample Name\n")
+        f.writelines(f"source_{j}\tsample_{j}\n" for j in range(samples))
+    with open(os.path.join(study_dir, f"a_{accession}_metabolite_profiling.txt"), "w") as f:
+        f.write("Sample Name\tRaw Spectral Data File\n")
+        f.writelines(f"sample_{j}\tRAW/sample_{j}.mzML\n" for j in range(samples))
+    for k in range(maf_files):
+        write_maf(os.path.join(study_dir, f"m_{accession}_maf_{k}.tsv"),
+                  rows, samples, seed=seed + k)
+    for j in range(raw_files):
+        # half of the raw files within a subdirectory
+        subdir = "RAW" if j % 2 else ""
+        open(os.path.join(study_dir, "FILES", subdir, f"raw_{j}.mzML"), "w").close()
+    return study_dir
+
+
+def make_mtwb_json(accession, rows=1000, samples=20, seed=0):
+    rng = random.Random(seed)
+    sample_columns = [f"sample_{j}" for j in range(samples)]
+    data = []
+    for i in range(rows):
+        entry = {"Metabolite": metabolite_name(rng, i)}
+        entry.update((column, f"{rng.uniform(0, 1e6):.3f}") for column in sample_columns)
+        data.append(entry)
+    return {
+        "METABOLOMICS WORKBENCH": {"STUDY_ID": accession, "ANALYSIS_ID": f"AN{accession[2:]}"},
+        "STUDY": {"STUDY_TITLE": f"Synthetic study {accession}",
+                  "STUDY_SUMMARY": "Synthetic study generated for benchmarking. " * 20},
+        "MS_METABOLITE_DATA": {"Units": "counts", "Data": data},
+    }
+
+
+def make_mtwb_study(root, accession, rows=1000, samples=20, seed=0):
+    study_dir = os.path.join(root, MTWB_DIR, accession)
+    os.makedirs(study_dir, exist_ok=True)
+    json_data = make_mtwb_json(accession, rows, samples, seed)
+    with open(os.path.join(study_dir, f"{accession}.json"), "w") as f:
+        json.dump(json_data, f)
+    with open(os.path.join(study_dir, f"{accession}.mwtab.txt"), "w") as f:
+        f.write(f"#METABOLOMICS WORKBENCH STUDY_ID:{accession}\n")
+        f.writelines(f"MS_METABOLITE_DATA\t{entry['Metabolite']}\n"
+                     for entry in json_data["MS_METABOLITE_DATA"]["Data"])
+    return study_dir
+
+
+def write_filelist(path, accession, maf_files, raw_files):
+    with open(path, "w") as f:
+        f.write("Name\tType\tSize\n")
+        for k in range(maf_files):
+            f.write(f"{accession}.maf.{k}.txt\tmaf\t1000\n")
+        for j in range(raw_files):
+            f.write(f"raw_{j}.mzML\traw\t1000000\n")
+    return path
+
+
+def make_mtbk_study(root, accession, maf_files=1, rows=1000, samples=20, raw_files=100, seed=0):
+    study_dir = os.path.join(root, MTBK_DIR, accession)
+    os.makedirs(study_dir, exist_ok=True)
+    write_metadata(os.path.join(study_dir, f"{accession}.idf.txt"), accession)
+    with open(os.path.join(study_dir, f"{accession}.sdrf.txt"), "w") as f:
+        f.write("Source Name\tExtract Name\tRaw Data File\n")
+        f.writelines(f"source_{j}\textract_{j}\traw_{j}.mzML\n" for j in range(samples))
+    write_filelist(os.path.join(study_dir, f"{accession}.filelist.txt"),
+                   accession, maf_files, raw_files)
+    for k in range(maf_files):
+        write_maf(os.path.join(study_dir, f"{accession}.maf.{k}.txt"),
+                  rows, samples, seed=seed + k)
+    return study_dir
+
+
+def make_repository_tree(root, studies=3, maf_files=1, rows=1000, samples=20, raw_files=100):
+    """
+    Generate `studies` synthetic studies for every repository,
+    returning the accessions by repository prefix
+    """
+    accessions = {"MTBLS": [], "ST": [], "MTBK": []}
+    for n in range(1, studies + 1):
+        accession = f"MTBLS{n}"
+        make_mtbls_study(root, accession, maf_files, rows, samples, raw_files, seed=n)
+        accessions["MTBLS"].append(accession)
+        accession = f"ST{n:06d}"
+        make_mtwb_study(root, accession, rows, samples, seed=n)
+        accessions["ST"].append(accession)
+        accession = f"MTBKS{n}"
+        make_mtbk_study(root, accession, maf_files, rows, samples, raw_files, seed=n)
+        accessions["MTBK"].append(accession)
+    return accessions
@@ -0,0 +1,153 @@
+"""
+Microbenchmarks for the dataset parsing functions, using synthetic files
+from 1k to 1M rows and hundreds of sample columns, i.e.:
+    python -m benchmarks.parsers --rows 1000,10000,100000 --samples 200
+    python -m benchmarks.parsers --save-baseline benchmarks/parsers_baseline.json
+    python -m benchmarks.parsers --baseline benchmarks/parsers_baseline.json --threshold 0.2
+
+Reports the best time and the peak memory of every function and size. With a
+baseline, exits with an error if any function got slower than the threshold.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks import fixtures, setup_django
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="1000,10000,100000",
+                        help="comma separated number of rows of the generated files")
+    parser.add_argument("--samples", type=int, default=200,
+                        help="sample columns of the generated MAF and JSON files")
+    parser.add_argument("--repeat", type=int, default=5, help="repetitions of every function")
+    parser.add_argument("--functions", default="",
+                        help="comma separated functions to run, all by default")
+    parser.add_argument("--fixtures-dir",
+                        help="keep the generated files in this directory, to reuse them")
+    parser.add_argument("--baseline", help="baseline results file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="max. allowed slowdown against the baseline, i.e.: 0.2 for 20%%")
+    parser.add_argument("--save-baseline", help="save the results as baseline to this file")
+    return parser.parse_args()
+
+
+def make_fixtures(fixtures_dir, rows, samples):
+    """
+    Generate (or reuse) the input files for every function with `rows` rows
+    """
+    base_dir = os.path.join(fixtures_dir, f"{rows}x{samples}")
+    paths = {
+        "investigation": os.path.join(base_dir, "i_Investigation.txt"),
+        "mtbls_dir": os.path.join(base_dir, "mtbls"),
+        "mtwb_json": os.path.join(base_dir, "ST000001.json"),
+        "mtbk_dir": os.path.join(base_dir, "mtbk"),
+        "filelist": os.path.join(base_dir, "MTBKS1.filelist.txt"),
+    }
+    if os.path.exists(os.path.join(base_dir, ".complete")):
+        return paths
+    os.makedirs(paths["mtbls_dir"], exist_ok=True)
+    os.makedirs(paths["mtbk_dir"], exist_ok=True)
+    fixtures.write_metadata(paths["investigation"], "MTBLS1", comments=rows)
+    fixtures.write_maf(os.path.join(paths["mtbls_dir"], "m_MTBLS1_maf.tsv"), rows, samples)
+    fixtures.write_maf(os.path.join(paths["mtbk_dir"], "MTBKS1.maf.1.txt"), rows, samples)
+    with open(paths["mtwb_json"], "w") as f:
+        json.dump(fixtures.make_mtwb_json("ST000001", rows, samples), f)
+    fixtures.write_filelist(paths["filelist"], "MTBKS1", maf_files=1, raw_files=rows)
+    open(os.path.join(base_dir, ".complete"), "w").close()
+    return paths
+
+
+def get_benchmarks():
+    """
+    Function name and how to call it with the fixture paths
+    """
+    from taskApi import utils
+
+    return {
+        "get_metadata_mtbls":
+            lambda paths: utils.get_metadata_mtbls(paths["investigation"], {}),
+        "get_metabolites_names_mtbls":
+            lambda paths: utils.get_metabolites_names_mtbls(paths["mtbls_dir"], {}),
+        "get_metabolites_names_mtwb":
+            lambda paths: utils.get_metabolites_names_mtwb(paths["mtwb_json"], {}),
+        "get_metabolites_names_mtbk":
+            lambda paths: utils.get_metabolites_names_mtbk(paths["mtbk_dir"], {}),
+        "get_rawdata_filenames_mtbk":
+            lambda paths: utils.get_rawdata_filenames_mtbk(paths["filelist"], {}),
+    }
+
+
+def run_benchmark(function, paths, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(paths)
+        timings.append(time.perf_counter() - start)
+    # memory in a separate run, tracing allocations slows down the function
+    tracemalloc.start()
+    function(paths)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"best_s": min(timings),
+            "median_s": statistics.median(timings),
+            "peak_mb": peak / 1024 / 1024}
+
+
+def check_regressions(results, baseline, threshold):
+    """
+    List the functions slower than the baseline by more than the threshold
+    """
+    regressions = []
+    for name, result in results.items():
+        if name in baseline:
+            slowdown = result["best_s"] / baseline[name]["best_s"] - 1
+            if slowdown > threshold:
+                regressions.append(f"{name}: {slowdown * 100:+.1f}% "
+                                   f"({baseline[name]['best_s']:.4f}s -> {result['best_s']:.4f}s)")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    setup_django()
+    benchmarks = get_benchmarks()
+    if args.functions:
+        benchmarks = {name: benchmarks[name] for name in args.functions.split(",")}
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="benchmarks-") as tmp_dir:
+        fixtures_dir = args.fixtures_dir or tmp_dir
+        for rows in (int(value) for value in args.rows.split(",")):
+            print(f"Generating files with {rows} rows and {args.samples} samples...")
+            paths = make_fixtures(fixtures_dir, rows, args.samples)
+            for name, function in benchmarks.items():
+                result = run_benchmark(function, paths, args.repeat)
+                results[f"{name}@{rows}"] = result
+                print(f"{name:<30} {rows:>9} rows  best {result['best_s'] * 1000:>10.2f} ms"
+                      f"  median {result['median_s'] * 1000:>10.2f} ms"
+                      f"  peak {result['peak_mb']:>9.2f} MB")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = check_regressions(results, baseline, args.threshold)
+        if regressions:
+            print("Regressions over the baseline:")
+            print("\n".join(regressions))
+            sys.exit(1)
+        print("No regressions over the baseline.")
+
+
+if __name__ == "__main__":
+    main()
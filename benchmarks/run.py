@@ -0,0 +1,234 @@
+"""
+Benchmark suite, run against local stand-ins of the upstream repositories, i.e.:
+    python -m benchmarks.run --studies 5 --rows 10000 --raw-files 1000 --latency 0.02
+
+Measures cold fetch, warm parse, API throughput and memory, appending the
+results to benchmarks/history.jsonl and comparing them with the previous
+run using the same parameters.
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from benchmarks import fixtures, servers, setup_django
+
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "history.jsonl")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--studies", type=int, default=3, help="studies per repository")
+    parser.add_argument("--maf-files", type=int, default=1, help="MAF files per study")
+    parser.add_argument("--rows", type=int, default=1000, help="metabolites per MAF file")
+    parser.add_argument("--samples", type=int, default=20, help="sample columns per MAF file")
+    parser.add_argument("--raw-files", type=int, default=100, help="raw files per study")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to every upstream request")
+    parser.add_argument("--bandwidth", type=float, default=0,
+                        help="upstream bandwidth in MB/s, 0 means unlimited")
+    parser.add_argument("--repeat", type=int, default=5, help="warm parse repetitions")
+    parser.add_argument("--duration", type=float, default=5.0,
+                        help="seconds of API throughput measurement")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent API clients")
+    parser.add_argument("--history", default=HISTORY_FILE, help="results history file")
+    parser.add_argument("--no-history", action="store_true", help="do not record the results")
+    return parser.parse_args()
+
+
+def setup_stand_in_django(http_url, ftp_port, work_dir):
+    """
+    Point the repositories settings to the stand-in servers, and the database
+    and logs to the work dir, before loading Django
+    """
+    setup_django(
+        DATABASE_PATH=os.path.join(work_dir, "db.sqlite3"),
+        LOGS_PATH=os.path.join(work_dir, "logs"),
+        MTBLS_FTP_URL="127.0.0.1",
+        MTBLS_FTP_PORT=str(ftp_port),
+        MTBLS_REMOTE_URL=f"{http_url}/{fixtures.MTBLS_DIR}/",
+        MTWB_REST_BASE_URL=http_url,
+        MTBK_BASE_URL=f"{http_url}/public/metabobank",
+        DATASETS_DIR=os.path.join(work_dir, "datasets"),
+        UPSTREAM_STATE_DIR=os.path.join(work_dir, "upstreams"),
+        UPSTREAM_RATE_LIMIT="0",
+        ALLOWED_HOSTS="testserver")
+    from django.core.management import call_command
+
+    call_command("migrate", run_syncdb=True, verbosity=0)
+
+
+def summarize(samples):
+    """
+    Latency statistics in milliseconds
+    """
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    return {"mean_ms": statistics.mean(samples) * 1000,
+            "p50_ms": samples[len(samples) // 2] * 1000,
+            "p99_ms": samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+            "max_ms": samples[-1] * 1000}
+
+
+def bench_cold_fetch(accessions):
+    from taskApi.repositories import get_repository_by_prefix
+    from taskApi.utils import get_dataset_size
+
+    results = {}
+    for prefix, repository_accessions in accessions.items():
+        repository = get_repository_by_prefix(prefix)
+        latencies = []
+        size = 0
+        for accession in repository_accessions:
+            start = time.perf_counter()
+            repository.fetch(accession)
+            latencies.append(time.perf_counter() - start)
+            size += get_dataset_size(prefix, accession)
+        results[repository.name] = dict(
+            summarize(latencies),
+            mb=size / 1024 / 1024,
+            mb_per_s=size / 1024 / 1024 / sum(latencies))
+    return results
+
+
+def bench_warm_parse(accessions, repeat):
+    from taskApi.repositories import get_repository_by_prefix
+
+    results = {}
+    for prefix, repository_accessions in accessions.items():
+        repository = get_repository_by_prefix(prefix)
+        latencies = []
+        for i in range(repeat):
+            for accession in repository_accessions:
+                start = time.perf_counter()
+                repository.parse(accession)
+                latencies.append(time.perf_counter() - start)
+        # memory in a separate pass, tracing allocations slows down parsing
+        tracemalloc.start()
+        repository.parse(repository_accessions[0])
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[repository.name] = dict(summarize(latencies), peak_mb=peak / 1024 / 1024)
+    return results
+
+
+def bench_api_throughput(accessions, duration, concurrency):
+    from django.test import Client
+
+    urls = [f"/api/dataset/{accession}/"
+            for repository_accessions in accessions.values()
+            for accession in repository_accessions]
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + duration
+
+    def client_loop(offset):
+        client = Client()
+        i = offset
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            response = client.get(urls[i % len(urls)])
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+            i += 1
+
+    threads = [threading.Thread(target=client_loop, args=(n,)) for n in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return dict(summarize(latencies),
+                requests=len(latencies),
+                errors=len(errors),
+                requests_per_s=len(latencies) / elapsed)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=""):
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{key}."))
+        else:
+            values[f"{prefix}{key}"] = value
+    return values
+
+
+def compare_with_previous(history_file, record):
+    """
+    Print the change of every result against the last run with the same parameters
+    """
+    previous = None
+    if os.path.exists(history_file):
+        with open(history_file) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry["params"] == record["params"]:
+                    previous = entry
+    current = flatten(record["results"])
+    before = flatten(previous["results"]) if previous else {}
+    for name, value in current.items():
+        line = f"{name:<55} {value:>12.3f}"
+        if before.get(name):
+            line += f"  ({(value - before[name]) / before[name] * 100:+.1f}% vs {previous['revision']})"
+        print(line)
+
+
+def main():
+    args = parse_args()
+    params = {name: value for name, value in vars(args).items()
+              if name not in ("history", "no_history")}
+    with tempfile.TemporaryDirectory(prefix="benchmarks-") as work_dir:
+        remote_dir = os.path.join(work_dir, "remote")
+        print(f"Generating {args.studies} synthetic studies per repository...")
+        accessions = fixtures.make_repository_tree(
+            remote_dir, args.studies, args.maf_files, args.rows, args.samples, args.raw_files)
+
+        conditions = servers.NetworkConditions(args.latency, args.bandwidth * 1024 * 1024)
+        http_server = servers.start(servers.StandInHTTPServer(remote_dir, conditions))
+        ftp_server = servers.start(servers.StandInFTPServer(remote_dir, conditions))
+        setup_stand_in_django(http_server.url, ftp_server.server_address[1], work_dir)
+
+        print("Cold fetch...")
+        results = {"cold_fetch": bench_cold_fetch(accessions)}
+        print("Warm parse...")
+        results["warm_parse"] = bench_warm_parse(accessions, args.repeat)
+        print("API throughput...")
+        results["api"] = bench_api_throughput(accessions, args.duration, args.concurrency)
+        # peak resident memory of the whole run, in KB on Linux
+        results["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+        http_server.shutdown()
+        ftp_server.shutdown()
+
+    record = {"date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+              "revision": git_revision(),
+              "params": params,
+              "results": results}
+    compare_with_previous(args.history, record)
+    if not args.no_history:
+        with open(args.history, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""
+Local stand-ins of the upstream repositories, serving a tree made by benchmarks.fixtures:
+    - an HTTP server with the Metabolomics-Workbench REST and MetaboBank/MetaboLights file layouts
+    - an FTP server with the MetaboLights tree
+Both inject a fixed latency per request/command and limit the bandwidth of the transfers.
+"""
+import json
+import os
+import posixpath
+import socket
+import socketserver
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks.fixtures import MTWB_DIR
+
+CHUNK_SIZE = 64 * 1024
+
+
+class NetworkConditions:
+    """
+    Latency in seconds added to every request, and bandwidth in bytes/s (0 means unlimited)
+    """
+
+    def __init__(self, latency=0.0, bandwidth=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def send(self, write, data):
+        for i in range(0, len(data), CHUNK_SIZE):
+            chunk = data[i:i + CHUNK_SIZE]
+            write(chunk)
+            if self.bandwidth:
+                time.sleep(len(chunk) / self.bandwidth)
+
+
+def resolve(root, path):
+    """
+    Local path of a remote path, never outside root
+    """
+    path = posixpath.normpath("/" + path).lstrip("/")
+    return os.path.join(root, *path.split("/")) if path else root
+
+
+def mtime(path):
+    return datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)
+
+
+class StandInHTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, content_type="text/plain"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.server.conditions.send(self.wfile.write, body)
+
+    def reply_json(self, data):
+        self.reply(200, json.dumps(data).encode(), "application/json")
+
+    def do_GET(self):
+        self.server.conditions.delay()
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        root = self.server.root
+        # Metabolomics-Workbench REST API
+        if url.path == "/rest/study/study_id/ST/available":
+            studies = sorted(os.listdir(os.path.join(root, MTWB_DIR)))
+            return self.reply_json({str(i): {"study_id": study_id, "study_title": f"Synthetic study {study_id}"}
+                                    for i, study_id in enumerate(studies, 1)})
+        if parts[:3] == ["rest", "study", "study_id"] and parts[-1] == "analysis":
+            study_id = parts[3]
+            if not os.path.isdir(os.path.join(root, MTWB_DIR, study_id)):
+                return self.reply(404, b"")
+            return self.reply_json({"study_id": study_id, "analysis_id": f"AN{study_id[2:]}"})
+        if url.path == "/data/study_textformat_view.php":
+            query = parse_qs(url.query)
+            study_id = query.get("STUDY_ID", [""])[0]
+            suffix = ".json" if query.get("JSON") == ["YES"] else ".mwtab.txt"
+            local_path = resolve(os.path.join(root, MTWB_DIR), f"{study_id}/{study_id}{suffix}")
+        else:
+            local_path = resolve(root, url.path)
+        # static files and directory indexes
+        if os.path.isdir(local_path):
+            return self.reply(200, self.index(url.path, local_path), "text/html")
+        if os.path.isfile(local_path):
+            with open(local_path, "rb") as f:
+                return self.reply(200, f.read())
+        self.reply(404, b"")
+
+    def index(self, path, local_path):
+        """
+        Directory listing, as served by Apache
+        """
+        lines = [f"<html><head><title>Index of {path}</title></head><body>",
+                 f"<h1>Index of {path}</h1><pre>",
+                 '<a href="../">Parent Directory</a>']
+        for name in sorted(os.listdir(local_path)):
+            entry_path = os.path.join(local_path, name)
+            href = name + "/" if os.path.isdir(entry_path) else name
+            size = "-" if os.path.isdir(entry_path) else str(os.path.getsize(entry_path))
+            lines.append(f'<a href="{href}">{href}</a>  '
+                         f'{mtime(entry_path):%Y-%m-%d %H:%M}  {size:>10}')
+        lines.append("</pre></body></html>")
+        return "\n".join(lines).encode()
+
+
+class StandInHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root, conditions, host="127.0.0.1", port=0):
+        self.root = root
+        self.conditions = conditions
+        super().__init__((host, port), StandInHTTPHandler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class StandInFTPHandler(socketserver.StreamRequestHandler):
+    """
+    Anonymous, read-only FTP: just the commands used by ftplib to login and list directories
+    """
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.cwd = "/"
+        self.data_socket = None
+        self.reply("220 Stand-in FTP server ready")
+        for raw_line in self.rfile:
+            command, _, argument = raw_line.decode().rstrip("\r\n").partition(" ")
+            self.server.conditions.delay()
+            handler = getattr(self, f"ftp_{command.lower()}", None)
+            if handler is None:
+                self.reply("502 Command not implemented")
+            elif handler(argument) is False:
+                break
+
+    def ftp_user(self, argument):
+        self.reply("331 Password required")
+
+    def ftp_pass(self, argument):
+        self.reply("230 Login successful")
+
+    def ftp_syst(self, argument):
+        self.reply("215 UNIX Type: L8")
+
+    def ftp_noop(self, argument):
+        self.reply("200 NOOP ok")
+
+    def ftp_type(self, argument):
+        self.reply("200 Type set")
+
+    def ftp_opts(self, argument):
+        self.reply("200 Options set")
+
+    def ftp_pwd(self, argument):
+        self.reply(f'257 "{self.cwd}"')
+
+    def ftp_cwd(self, argument):
+        path = posixpath.normpath(posixpath.join(self.cwd, argument))
+        if os.path.isdir(resolve(self.server.root, path)):
+            self.cwd = path
+            self.reply("250 Directory changed")
+        else:
+            self.reply("550 No such directory")
+
+    def ftp_quit(self, argument):
+        self.reply("221 Goodbye")
+        return False
+
+    def ftp_pasv(self, argument):
+        self.data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.data_socket.bind((self.server.server_address[0], 0))
+        self.data_socket.listen(1)
+        host, port = self.data_socket.getsockname()
+        self.reply(f"227 Entering Passive Mode ({host.replace('.', ',')},{port >> 8},{port & 255})")
+
+    def send_data(self, lines):
+        if self.data_socket is None:
+            self.reply("425 Use PASV first")
+            return
+        self.reply("150 Here comes the directory listing")
+        connection, address = self.data_socket.accept()
+        with connection:
+            self.server.conditions.send(connection.sendall, "".join(lines).encode())
+        self.data_socket.close()
+        self.data_socket = None
+        self.reply("226 Transfer complete")
+
+    def listing(self, argument):
+        path = posixpath.normpath(posixpath.join(self.cwd, argument or "."))
+        local_path = resolve(self.server.root, path)
+        if not os.path.isdir(local_path):
+            return None
+        return local_path, sorted(os.listdir(local_path))
+
+    def ftp_mlsd(self, argument):
+        listing = self.listing(argument)
+        if listing is None:
+            self.reply("550 No such directory")
+            return
+        local_path, names = listing
+        lines = []
+        for name in names:
+            entry_path = os.path.join(local_path, name)
+            entry_type = "dir" if os.path.isdir(entry_path) else "file"
+            lines.append(f"type={entry_type};size={os.path.getsize(entry_path)};"
+                         f"modify={mtime(entry_path):%Y%m%d%H%M%S}; {name}\r\n")
+        self.send_data(lines)
+
+    def ftp_nlst(self, argument):
+        listing = self.listing(argument)
+        if listing is None:
+            self.reply("550 No such directory")
+            return
+        self.send_data([f"{name}\r\n" for name in listing[1]])
+
+
+class StandInFTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, conditions, host="127.0.0.1", port=0):
+        self.root = root
+        self.conditions = conditions
+        super().__init__((host, port), StandInFTPHandler)
+
+
+def start(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
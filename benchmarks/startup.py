@@ -0,0 +1,88 @@
+"""
+Startup time benchmark: `manage.py check` and loading the WSGI application,
+each in a new process, as every worker boot or management command does, i.e.:
+    python -m benchmarks.startup --repeat 10
+    python -m benchmarks.startup --imports 15
+
+Reports the best and median wall time, and optionally the slowest imports.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = {
+    "manage.py check": [sys.executable, "manage.py", "check"],
+    "wsgi app load": [sys.executable, "-c", "import taskPrj.wsgi"],
+    "wsgi app load (preload)": [sys.executable, "-c", "import taskPrj.wsgi"],
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="runs of every target")
+    parser.add_argument("--imports", type=int, default=0,
+                        help="also list the N slowest imports of the WSGI app load")
+    return parser.parse_args()
+
+
+def get_environ(target, work_dir):
+    environ = dict(os.environ)
+    for name, value in (("SECRET_KEY", "benchmarks"), ("APP_NAME", "benchmarks"),
+                        ("API_CONTACT_EMAIL", "benchmarks@localhost"),
+                        ("DJANGO_SETTINGS_MODULE", "taskPrj.settings")):
+        environ.setdefault(name, value)
+    environ["PRELOAD_APP"] = "True" if "preload" in target else "False"
+    # keep the logs and the database of the runs out of the repository
+    environ.setdefault("LOGS_PATH", os.path.join(work_dir, "logs"))
+    environ.setdefault("DATABASE_PATH", os.path.join(work_dir, "db.sqlite3"))
+    return environ
+
+
+def run_target(target, repeat, work_dir):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(TARGETS[target], cwd=BASE_DIR, env=get_environ(target, work_dir),
+                       check=True, capture_output=True)
+        timings.append(time.perf_counter() - start)
+    return {"best_s": min(timings), "median_s": statistics.median(timings)}
+
+
+def slowest_imports(count, work_dir):
+    """
+    Cumulative time of the slowest top level imports, from python -X importtime
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import taskPrj.wsgi"],
+                            cwd=BASE_DIR, env=get_environ("wsgi app load", work_dir),
+                            check=True, capture_output=True, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative_us), name.rstrip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix="benchmarks-") as work_dir:
+        for target in TARGETS:
+            result = run_target(target, args.repeat, work_dir)
+            print(f"{target:<30} best {result['best_s'] * 1000:>8.1f} ms"
+                  f"  median {result['median_s'] * 1000:>8.1f} ms")
+        if args.imports:
+            print("Slowest imports of the WSGI app load:")
+            for cumulative_us, name in slowest_imports(args.imports, work_dir):
+                print(f"{cumulative_us / 1000:>8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+This file contains the columnar abundances store of the taskApi app.
+The abundance matrices of the datasets (metabolites by samples, from the MAF
+files or the Workbench JSON) are extracted once per version of the local copy
+into a NumPy file in DATASETS_COLUMNAR_DIR, column-major so every sample is
+contiguous on disk, and memory-mapped to read only the slices requested.
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from taskApi import utils
+from taskApi.models import normalize_metabolite_name
+from taskPrj import settings
+
+logger = logging.getLogger(__name__)
+
+# matrices kept loaded for the next requests
+LOADED_SIZE = 32
+
+# loaded matrices, as columnar dir: (fetched_at, matrix), least recently used first
+_loaded = OrderedDict()
+_loaded_lock = threading.Lock()
+# one extraction at a time of every dataset, as accession: (lock, requests using it)
+_extracting = {}
+_extracting_lock = threading.Lock()
+
+
+def get_columnar_dir(prefix, accession):
+    return os.path.join(settings.DATASETS_COLUMNAR_DIR, prefix, accession)
+
+
+def read_labels(columnar_dir):
+    try:
+        with open(os.path.join(columnar_dir, "labels.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def extract(repository, accession, fetched_at):
+    """
+    Extract the abundances of the local copy of a dataset, labelled with the
+    fetched_at read by the caller, and return them memory-mapped
+    """
+    import numpy as np
+
+    metabolites, samples, values = repository.read_abundances(accession)
+    logger.debug("Extract abundances of Dataset %s: %d metabolites, %d samples",
+                 accession, len(metabolites), len(samples))
+    columnar_dir = get_columnar_dir(repository.prefix, accession)
+    os.makedirs(os.path.dirname(columnar_dir), exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix=f".{accession}.", dir=os.path.dirname(columnar_dir))
+    try:
+        labels = {"fetched_at": fetched_at, "metabolites": metabolites, "samples": samples}
+        np.save(os.path.join(staging_dir, "values.npy"), np.asfortranarray(values))
+        with open(os.path.join(staging_dir, "labels.json"), "w") as f:
+            json.dump(labels, f)
+        # mapped before the rename, still readable if replaced again meanwhile
+        abundance_matrix = AbundanceMatrix(staging_dir, labels)
+        shutil.rmtree(columnar_dir, ignore_errors=True)
+        os.replace(staging_dir, columnar_dir)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    return abundance_matrix
+
+
+class AbundanceMatrix:
+    """
+    Memory-mapped abundances of a dataset
+    """
+
+    def __init__(self, columnar_dir, labels):
+        import numpy as np
+
+        self.values = np.load(os.path.join(columnar_dir, "values.npy"), mmap_mode="r")
+        self.metabolites = labels["metabolites"]
+        self.samples = labels["samples"]
+        self.rows = {}
+        for row, name in enumerate(self.metabolites):
+            self.rows.setdefault(normalize_metabolite_name(name), []).append(row)
+        self.columns = {sample: column for column, sample in enumerate(self.samples)}
+
+    def get_rows(self, names):
+        """
+        Rows of the given metabolites (all the rows of each name), and the names not found
+        """
+        rows = set()
+        for name in names:
+            rows.update(self.rows.get(normalize_metabolite_name(name), []))
+        return (sorted(rows),
+                [name for name in names if normalize_metabolite_name(name) not in self.rows])
+
+    def get_columns(self, samples):
+        """
+        Columns of the given samples, and the samples not found
+        """
+        return ([self.columns[sample] for sample in samples if sample in self.columns],
+                [sample for sample in samples if sample not in self.columns])
+
+    def get_slice(self, rows, columns):
+        """
+        Abundances of the given rows and columns, None for the missing (or
+        infinite) values, not valid in JSON
+        """
+        import numpy as np
+
+        values = self.values[np.ix_(np.array(rows, dtype=np.intp), np.array(columns, dtype=np.intp))]
+        return np.where(np.isfinite(values), values, None).tolist()
+
+
+def load(columnar_dir, fetched_at):
+    """
+    Abundances of a version of a dataset, kept loaded for the next requests.
+    None if not extracted yet.
+    """
+    with _loaded_lock:
+        loaded = _loaded.get(columnar_dir)
+        if loaded is not None and loaded[0] == fetched_at:
+            _loaded.move_to_end(columnar_dir)
+            return loaded[1]
+    labels = read_labels(columnar_dir)
+    if labels is None or labels["fetched_at"] != fetched_at:
+        return None
+    return keep_loaded(columnar_dir, fetched_at, AbundanceMatrix(columnar_dir, labels))
+
+
+def keep_loaded(columnar_dir, fetched_at, abundance_matrix):
+    with _loaded_lock:
+        _loaded[columnar_dir] = (fetched_at, abundance_matrix)
+        _loaded.move_to_end(columnar_dir)
+        while len(_loaded) > LOADED_SIZE:
+            _loaded.popitem(last=False)
+    return abundance_matrix
+
+
+def get_matrix(repository, accession):
+    """
+    Abundances of the local copy of a dataset, extracted first if not yet
+    (or after it was downloaded again)
+    """
+    columnar_dir = get_columnar_dir(repository.prefix, accession)
+    fetched_at = utils.get_dataset_fetched_at(repository.prefix, accession, "metabolites")
+    abundance_matrix = load(columnar_dir, fetched_at)
+    if abundance_matrix is None:
+        with _extracting_lock:
+            lock, users = _extracting.get(accession, (None, 0))
+            _extracting[accession] = (lock or threading.Lock(), users + 1)
+            lock = _extracting[accession][0]
+        try:
+            with lock:
+                # maybe just extracted by another request
+                abundance_matrix = load(columnar_dir, fetched_at)
+                if abundance_matrix is None:
+                    abundance_matrix = keep_loaded(columnar_dir, fetched_at,
+                                                   extract(repository, accession, fetched_at))
+        finally:
+            with _extracting_lock:
+                lock, users = _extracting[accession]
+                if users > 1:
+                    _extracting[accession] = (lock, users - 1)
+                else:
+                    del _extracting[accession]
+    return abundance_matrix
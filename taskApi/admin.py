@@ -2,9 +2,68 @@
 This module contains the admin configuration for the taskApi app. 
 """
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models.functions import Substr
+from django.utils.functional import cached_property
+
+from taskPrj import settings
+
 from . import models
 
 
+def estimate_count(model):
+    """
+    Approximate number of rows of a table, without scanning it
+    """
+    table = connection.ops.quote_name(model._meta.db_table)
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass",
+                           [model._meta.db_table])
+        elif connection.vendor == "sqlite":
+            # rows are only appended, so the last rowid is close to the count
+            cursor.execute(f"SELECT MAX(rowid) FROM {table}")
+        else:
+            return None
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator using the estimated table size for unfiltered lists of large
+    tables, where counting all the rows takes longer than the page itself
+    """
+
+    @cached_property
+    def count(self):
+        if not self.object_list.query.where:
+            estimate = estimate_count(self.object_list.model)
+            if estimate is not None and estimate > settings.ADMIN_COUNT_ESTIMATE_THRESHOLD:
+                return estimate
+        return super().count
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Admin for tables with millions of rows: estimated counts
+    and long text fields truncated by the database
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    # long text fields shown truncated in the list
+    truncated_fields = ()
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if request.resolver_match and request.resolver_match.url_name.endswith("_changelist"):
+            queryset = queryset.defer(*self.truncated_fields).annotate(**{
+                f"{field}_excerpt": Substr(field, 1, settings.ADMIN_TEXT_EXCERPT_LENGTH)
+                for field in self.truncated_fields})
+        return queryset
+
+
 class DatasetRepositoryFileInline(admin.TabularInline):
     model = models.DatasetRepositoryFile
     extra = 0
@@ -29,33 +88,50 @@ class DatasetRepositoryAdmin(admin.ModelAdmin):
 class DatasetFileInline(admin.TabularInline):
     model = models.DatasetFile
     extra = 0
+    show_change_link = True
 
 
 @admin.register(models.Dataset)
-class DatasetAdmin(admin.ModelAdmin):
+class DatasetAdmin(LargeTableAdmin):
     model = models.Dataset
     empty_value_display = "-empty-"
 
-    list_display = ("accession", "repository", "title", "description")
-    search_fields = ("title", "description")
-    list_filter = ("repository",)
+    list_display = ("accession", "repository", "title", "description_excerpt", "available")
+    search_fields = ("^accession", "title")
+    list_filter = ("repository", "available")
     ordering = ("accession",)
     list_per_page = 10
     list_max_show_all = 100
-    list_select_related = True
     list_display_links = ("accession",)
+    autocomplete_fields = ("repository",)
+    truncated_fields = ("description",)
 
     inlines = [DatasetFileInline]
 
+    def get_queryset(self, request):
+        # the repository shown with every dataset, in the same query
+        return super().get_queryset(request).with_repository()
+
+    @admin.display(description="description")
+    def description_excerpt(self, obj):
+        return obj.description_excerpt
+
+
 @admin.register(models.DatasetFile)
-class DatasetFileAdmin(admin.ModelAdmin):
+class DatasetFileAdmin(LargeTableAdmin):
     model = models.DatasetFile
     empty_value_display = "-empty-"
 
-    list_display = ("id", "dataset", "file", "description")
-    list_filter = ("dataset",)
+    list_display = ("id", "dataset", "file", "description_excerpt")
+    search_fields = ("=dataset__accession", "file")
     ordering = ("dataset",)
     list_per_page = 10
     list_max_show_all = 100
-    list_select_related = True
-    list_display_links = ("id",)
\ No newline at end of file
+    list_select_related = ("dataset",)
+    list_display_links = ("id",)
+    autocomplete_fields = ("dataset",)
+    truncated_fields = ("description",)
+
+    @admin.display(description="description")
+    def description_excerpt(self, obj):
+        return obj.description_excerpt
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class TaskapiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'taskApi'
+
+    def ready(self):
+        # register the dataset repository adapters and the signal handlers
+        from taskApi import repositories, signals
@@ -0,0 +1,170 @@
+"""
+This file contains the content-addressable blob store for the taskApi app.
+With DATASETS_STORAGE=blobs, every downloaded file is stored once by the hash
+of its content, and the dataset dirs hold hardlinks to the stored blobs, so
+identical files shared by several datasets (or unchanged by a refresh) take
+disk space only once. Files are still downloaded into the staging dir of the
+new version and hashed there, then replaced by a link to the blob if already
+stored. The dataset files are the blobs themselves, so they are read-only.
+The number of links of a blob is its reference count: once only the store
+links to it, it can be removed.
+A manifest per dataset (path: hash) allows releasing and verifying its blobs.
+"""
+import hashlib
+import json
+import logging
+import os
+
+from taskPrj import settings
+
+logger = logging.getLogger(__name__)
+
+HASH_ALGORITHM = "sha256"
+CHUNK_SIZE = 1024 * 1024
+
+
+def is_enabled():
+    return settings.DATASETS_STORAGE == "blobs"
+
+
+def get_objects_dir():
+    return os.path.join(settings.DATASETS_BLOBS_DIR, "objects")
+
+
+def get_blob_path(digest):
+    return os.path.join(get_objects_dir(), digest[:2], digest)
+
+
+def get_manifest_path(prefix, accession):
+    return os.path.join(settings.DATASETS_BLOBS_DIR, "manifests", prefix, f"{accession}.json")
+
+
+def file_digest(path):
+    digest = hashlib.new(HASH_ALGORITHM)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_file(path, dest):
+    """
+    Store a file into the blob store, linking it as `dest` (atomically replaced).
+    A new blob is the file itself (same inode), made read-only as `dest` is.
+    Returns the hash of the file, and False if `dest` already had that content.
+    """
+    digest = file_digest(path)
+    blob_path = get_blob_path(digest)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    temp_path = f"{dest}.{digest[:12]}.tmp"
+    while True:
+        try:
+            os.link(path, blob_path)
+            # blobs are shared, so they must never be written in place
+            os.chmod(blob_path, 0o444)
+        except FileExistsError:
+            pass
+        try:
+            if os.path.exists(dest) and os.path.samefile(dest, blob_path):
+                return digest, False
+            os.link(blob_path, temp_path)
+            break
+        except FileNotFoundError:
+            # the blob was garbage collected meanwhile, store it again
+            continue
+    os.replace(temp_path, dest)
+    return digest, True
+
+
+def read_manifest(prefix, accession):
+    """
+    Hashes of the files of a dataset, as relative path: hash
+    """
+    try:
+        with open(get_manifest_path(prefix, accession)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(prefix, accession, manifest):
+    manifest_path = get_manifest_path(prefix, accession)
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(f"{manifest_path}.tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+def remove(digest):
+    """
+    Remove a blob even if still linked (i.e. corrupted), so it is never linked again
+    """
+    try:
+        os.remove(get_blob_path(digest))
+    except FileNotFoundError:
+        pass
+
+
+def iter_blobs():
+    objects_dir = get_objects_dir()
+    if not os.path.isdir(objects_dir):
+        return
+    for shard in os.listdir(objects_dir):
+        shard_dir = os.path.join(objects_dir, shard)
+        for digest in os.listdir(shard_dir):
+            yield digest, os.path.join(shard_dir, digest)
+
+
+def collect_garbage(digests=None, dry_run=False):
+    """
+    Remove the blobs no longer linked by any dataset, only the given ones
+    or all of them. Returns the number of blobs removed and their size.
+    """
+    if digests is None:
+        blobs = iter_blobs()
+    else:
+        blobs = ((digest, get_blob_path(digest)) for digest in digests)
+    count = size = 0
+    for digest, blob_path in blobs:
+        try:
+            stat = os.stat(blob_path)
+            if stat.st_nlink > 1:
+                continue
+            if not dry_run:
+                os.remove(blob_path)
+        except FileNotFoundError:
+            continue
+        logger.debug("Remove unused blob %s", digest)
+        count += 1
+        size += stat.st_size
+    return count, size
+
+
+def get_usage():
+    """
+    Number of blobs stored and their total size, the actual disk usage of the datasets files
+    """
+    count = size = 0
+    for digest, blob_path in iter_blobs():
+        count += 1
+        size += os.path.getsize(blob_path)
+    return count, size
+
+
+def verify():
+    """
+    Hash every blob again. Returns the corrupted ones, as hash: list of
+    (prefix, accession) of the datasets using them.
+    """
+    corrupted = {digest: [] for digest, blob_path in iter_blobs()
+                 if file_digest(blob_path) != digest}
+    if not corrupted:
+        return corrupted
+    manifests_dir = os.path.join(settings.DATASETS_BLOBS_DIR, "manifests")
+    for prefix in os.listdir(manifests_dir) if os.path.isdir(manifests_dir) else []:
+        for filename in os.listdir(os.path.join(manifests_dir, prefix)):
+            accession = filename.rsplit(".json", 1)[0]
+            for digest in set(read_manifest(prefix, accession).values()):
+                if digest in corrupted:
+                    corrupted[digest].append((prefix, accession))
+    return corrupted
@@ -0,0 +1,314 @@
+"""
+This file contains the local datasets cache accounting for the taskApi app.
+Size, last access and hits of every dataset are kept in a small index file,
+used to keep the cache under a quota evicting the least recently (LRU) or
+least frequently (LFU) used datasets. Pinned datasets are never evicted.
+"""
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from taskApi import abundances, blobs, sections, utils
+from taskApi.metrics import DATASET_CACHE_BYTES, DATASET_CACHE_EVICTIONS
+from taskApi.throttling import SharedState
+from taskPrj import settings
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("lru", "lfu")
+
+_index = SharedState(settings.DATASETS_CACHE_INDEX)
+# accesses not yet written to the index, as key: [hits, last_access]
+_pending_accesses = {}
+_pending_lock = threading.Lock()
+_last_flush = time.time()
+_sweeper = None
+
+
+def get_key(prefix, accession):
+    return f"{prefix}/{accession}"
+
+
+def is_pinned(key, entry):
+    return entry.get("pinned") or key.split("/", 1)[1] in settings.DATASETS_CACHE_PINNED
+
+
+def get_dataset_usage(prefix, accession):
+    """
+    Size of a dataset, and with DATASETS_STORAGE=blobs the size of each of
+    its files by inode (as str), so files shared by datasets count once
+    """
+    if not blobs.is_enabled():
+        return {"size": utils.get_dataset_size(prefix, accession)}
+    inodes = {}
+    for root, dirs, files in os.walk(utils.get_dataset_dir(prefix, accession)):
+        for file in files:
+            stat = os.stat(os.path.join(root, file))
+            inodes[str(stat.st_ino)] = stat.st_size
+    return {"size": sum(inodes.values()), "inodes": inodes}
+
+
+def get_total_size(entries):
+    """
+    Disk space used by the datasets, counting every blob once
+    """
+    total = 0
+    inodes = {}
+    for entry in entries.values():
+        if "inodes" in entry:
+            inodes.update(entry["inodes"])
+        else:
+            total += entry["size"]
+    return total + sum(inodes.values())
+
+
+def record_fetch(prefix, accession):
+    """
+    Account a dataset just downloaded, evicting others if over the quota
+    """
+    key = get_key(prefix, accession)
+    usage = get_dataset_usage(prefix, accession)
+    with _index.update() as index:
+        entries = index.setdefault("datasets", {})
+        # unless evicted meanwhile
+        if utils.get_dataset_cached_at(prefix, accession) is not None:
+            entry = entries.setdefault(key, {"hits": 0, "pinned": False})
+            entry.pop("inodes", None)
+            entry.update(usage)
+            entry["last_access"] = time.time()
+        total = get_total_size(entries)
+    DATASET_CACHE_BYTES.set(total)
+    if settings.DATASETS_CACHE_QUOTA and total > settings.DATASETS_CACHE_QUOTA:
+        evict(keep={key})
+
+
+def record_access(prefix, accession):
+    """
+    Account a dataset read, written to the index every few seconds
+    """
+    global _last_flush
+    now = time.time()
+    with _pending_lock:
+        access = _pending_accesses.setdefault(get_key(prefix, accession), [0, now])
+        access[0] += 1
+        access[1] = now
+        flush = now - _last_flush >= settings.DATASETS_CACHE_FLUSH_INTERVAL
+        if flush:
+            _last_flush = now
+    if flush:
+        flush_accesses()
+    start_sweeper()
+
+
+def flush_accesses():
+    """
+    Write the pending accesses to the index
+    """
+    with _pending_lock:
+        accesses = dict(_pending_accesses)
+        _pending_accesses.clear()
+    if not accesses:
+        return
+    with _index.update() as index:
+        entries = index.setdefault("datasets", {})
+        for key, (hits, last_access) in accesses.items():
+            if key not in entries:
+                # downloaded before the cache was accounted
+                prefix, accession = key.split("/", 1)
+                if utils.get_dataset_cached_at(prefix, accession) is None:
+                    continue
+                entries[key] = dict(get_dataset_usage(prefix, accession),
+                                    last_access=last_access, hits=0, pinned=False)
+            entries[key]["hits"] += hits
+            entries[key]["last_access"] = max(entries[key]["last_access"], last_access)
+
+
+def set_pinned(prefix, accession, pinned=True):
+    """
+    Pin a dataset, so it is never evicted, or unpin it
+    """
+    key = get_key(prefix, accession)
+    with _index.update() as index:
+        entries = index.setdefault("datasets", {})
+        if key not in entries:
+            entries[key] = dict(get_dataset_usage(prefix, accession),
+                                last_access=time.time(), hits=0)
+        entries[key]["pinned"] = pinned
+
+
+def rebuild_index():
+    """
+    Scan DATASETS_DIR, adding the datasets (with any complete component) missing in the index
+    and removing the ones no longer on disk. Returns the total size.
+    """
+    logger.debug("Rebuild datasets cache index: %s", settings.DATASETS_CACHE_INDEX)
+    found = {}
+    if os.path.isdir(settings.DATASETS_DIR):
+        for prefix in os.listdir(settings.DATASETS_DIR):
+            # skip the blob store
+            if prefix.startswith(".") or not os.path.isdir(os.path.join(settings.DATASETS_DIR, prefix)):
+                continue
+            for accession in os.listdir(os.path.join(settings.DATASETS_DIR, prefix)):
+                # skip the versions, staging dirs and locks of the datasets
+                if accession.startswith("."):
+                    continue
+                fetched_at = utils.get_dataset_cached_at(prefix, accession)
+                if fetched_at is not None:
+                    found[get_key(prefix, accession)] = (
+                        get_dataset_usage(prefix, accession), fetched_at)
+    with _index.update() as index:
+        entries = index.setdefault("datasets", {})
+        for key in set(entries) - set(found):
+            del entries[key]
+        for key, (usage, fetched_at) in found.items():
+            entry = entries.setdefault(
+                key, {"last_access": fetched_at, "hits": 0, "pinned": False})
+            entry.pop("inodes", None)
+            entry.update(usage)
+        total = get_total_size(entries)
+    DATASET_CACHE_BYTES.set(total)
+    return total
+
+
+def get_usage():
+    """
+    Datasets in the index, as key: entry, and their total size
+    """
+    flush_accesses()
+    with _index.update() as index:
+        entries = index.get("datasets", {})
+    return entries, get_total_size(entries)
+
+
+def evict(quota=None, policy=None, keep=(), dry_run=False):
+    """
+    Remove datasets until the cache fits in the quota, the least recently
+    used first (lru) or the least used first (lfu). Returns the evicted keys.
+    """
+    quota = settings.DATASETS_CACHE_QUOTA if quota is None else quota
+    policy = policy or settings.DATASETS_CACHE_POLICY
+    if policy not in POLICIES:
+        raise ValueError(f"Invalid cache eviction policy: {policy}")
+    if not os.path.exists(settings.DATASETS_CACHE_INDEX):
+        rebuild_index()
+    flush_accesses()
+
+    if policy == "lfu":
+        def order(item): return (item[1]["hits"], item[1]["last_access"])
+    else:
+        def order(item): return item[1]["last_access"]
+
+    evicted = []
+    removed = []
+    with _index.update() as index:
+        entries = index.setdefault("datasets", {})
+        total = get_total_size(entries)
+        # datasets using each blob, only the bytes of the blobs no other dataset uses are freed
+        references = {}
+        for entry in entries.values():
+            for inode in entry.get("inodes", ()):
+                references[inode] = references.get(inode, 0) + 1
+        candidates = sorted(((key, entry) for key, entry in entries.items()
+                             if key not in keep and not is_pinned(key, entry)), key=order)
+        for key, entry in candidates:
+            if total <= quota:
+                break
+            evicted.append(key)
+            if "inodes" in entry:
+                for inode, size in entry["inodes"].items():
+                    references[inode] -= 1
+                    if not references[inode]:
+                        total -= size
+            else:
+                total -= entry["size"]
+            if not dry_run:
+                del entries[key]
+                removed.append(detach(key))
+    if dry_run:
+        return evicted
+
+    # remove the files out of the index lock
+    for key, detached in zip(evicted, removed):
+        logger.debug("Evict dataset %s from the local cache", key)
+        remove_files(key, *detached)
+        DATASET_CACHE_EVICTIONS.inc(prefix=key.split("/", 1)[0])
+    DATASET_CACHE_BYTES.set(total)
+    return evicted
+
+
+def detach(key):
+    """
+    Remove a dataset from the local cache at once, renaming its link to a tombstone
+    (so it is downloaded again if requested) and dropping its blobs manifest.
+    Returns the tombstone and the blobs of the dataset, for remove_files.
+    """
+    prefix, accession = key.split("/", 1)
+    dataset_dir = utils.get_dataset_dir(prefix, accession)
+    tombstone = os.path.join(os.path.dirname(dataset_dir),
+                             f".{accession}.evicted.{uuid.uuid4().hex}")
+    digests = set()
+    with utils.lock_dataset(prefix, accession):
+        try:
+            os.rename(dataset_dir, tombstone)
+        except FileNotFoundError:
+            tombstone = None
+        if blobs.is_enabled():
+            digests = set(blobs.read_manifest(prefix, accession).values())
+            try:
+                os.remove(blobs.get_manifest_path(prefix, accession))
+            except FileNotFoundError:
+                pass
+    return tombstone, digests
+
+
+def remove_files(key, tombstone=None, digests=()):
+    """
+    Remove the files of a detached dataset, and the blobs only it used
+    """
+    prefix, accession = key.split("/", 1)
+    if tombstone is not None:
+        version_dir = os.path.realpath(tombstone)
+        if os.path.islink(tombstone):
+            os.remove(tombstone)
+        shutil.rmtree(version_dir, ignore_errors=True)
+    shutil.rmtree(abundances.get_columnar_dir(prefix, accession), ignore_errors=True)
+    shutil.rmtree(sections.get_sections_dir(prefix, accession), ignore_errors=True)
+    if digests:
+        blobs.collect_garbage(digests)
+
+
+def discard(prefix, accession):
+    """
+    Remove a dataset from the local cache, even if pinned
+    """
+    key = get_key(prefix, accession)
+    with _index.update() as index:
+        index.setdefault("datasets", {}).pop(key, None)
+        detached = detach(key)
+    remove_files(key, *detached)
+
+
+def sweep():
+    while True:
+        time.sleep(settings.DATASETS_CACHE_SWEEP_INTERVAL)
+        try:
+            evict()
+        except Exception as exc:
+            logger.exception(exc)
+
+
+def start_sweeper():
+    """
+    Start the background eviction sweep of this process, if a quota is set
+    """
+    global _sweeper
+    if _sweeper is not None or not settings.DATASETS_CACHE_QUOTA \
+            or not settings.DATASETS_CACHE_SWEEP_INTERVAL:
+        return
+    with _pending_lock:
+        if _sweeper is None:
+            _sweeper = threading.Thread(target=sweep, name="datasets-cache-sweep", daemon=True)
+            _sweeper.start()
@@ -0,0 +1,89 @@
+"""
+This file contains the deadlines of the taskApi app.
+An API request waits at most DATASET_REQUEST_TIMEOUT seconds for the dataset
+downloads, and every download takes at most DATASET_FETCH_TIMEOUT seconds.
+The deadline of the current context bounds the timeout of every upstream
+call made within it, on top of the timeout of each stage (connect, read).
+"""
+import contextvars
+import time
+from contextlib import contextmanager
+
+from taskPrj import settings
+
+# monotonic time the current request or download must be done by, None means no limit
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """
+    The time budget of the current request or download is over
+    """
+
+    def __init__(self):
+        super().__init__("Deadline exceeded")
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Run a block within `seconds` (0 means no limit), or the current deadline if sooner, i.e.:
+        with deadline(settings.DATASET_FETCH_TIMEOUT):
+            repository.fetch(accession)
+    """
+    at = _deadline.get()
+    if seconds:
+        at = time.monotonic() + seconds if at is None else min(at, time.monotonic() + seconds)
+    token = _deadline.set(at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def detached():
+    """
+    Run a block without the deadline of the current context, i.e. a download
+    going on in the background once the request that started it is done
+    """
+    token = _deadline.set(None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """
+    Seconds left to the current deadline, None if there is none
+    """
+    at = _deadline.get()
+    if at is None:
+        return None
+    return max(0.0, at - time.monotonic())
+
+
+def check():
+    if remaining() == 0:
+        raise DeadlineExceeded()
+
+
+def get_timeout(timeout):
+    """
+    Timeout of a stage (0 means no limit), bounded by the current deadline
+    """
+    left = remaining()
+    if left is None:
+        return timeout or None
+    if left == 0:
+        raise DeadlineExceeded()
+    return min(timeout, left) if timeout else left
+
+
+def get_upstream_timeouts():
+    """
+    Connect and read timeouts of an upstream HTTP request, as expected by requests
+    """
+    return (get_timeout(settings.UPSTREAM_CONNECT_TIMEOUT),
+            get_timeout(settings.UPSTREAM_READ_TIMEOUT))
@@ -0,0 +1,232 @@
+"""
+This file contains a pool of reusable FTP connections for the taskApi app
+"""
+import ftplib
+import logging
+import posixpath
+import threading
+import time
+from contextlib import contextmanager
+
+from taskApi import deadlines
+from taskApi.metrics import FTP_CONNECT_SECONDS
+from taskApi.throttling import get_upstream
+from taskPrj import settings
+
+logger = logging.getLogger(__name__)
+
+
+class FTPConnectionPool:
+    """
+    Pool of authenticated FTP connections to a single host.
+    Idle connections are kept alive sending NOOP commands, so the login
+    handshake is only paid once per connection instead of once per dataset.
+    """
+
+    def __init__(self, host, user, passwd, size=4, keepalive=30, port=21):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.keepalive = keepalive
+        # bounds the number of open connections, to respect server limits
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = []
+        self.lock = threading.Lock()
+        self.keepalive_thread = None
+
+    def connect(self):
+        logger.debug("Connecting to FTP server: %s", self.host)
+        with FTP_CONNECT_SECONDS.time("ftp_connect", host=self.host):
+            ftp = ftplib.FTP()
+            ftp.connect(self.host, self.port,
+                        timeout=deadlines.get_timeout(settings.UPSTREAM_CONNECT_TIMEOUT))
+            ftp.login(self.user, self.passwd)
+        logger.debug("Connected: %s", self.host)
+        return ftp
+
+    def is_alive(self, ftp):
+        try:
+            ftp.voidcmd("NOOP")
+            return True
+        except ftplib.all_errors:
+            self.discard(ftp)
+            return False
+
+    def discard(self, ftp):
+        try:
+            ftp.close()
+        except ftplib.all_errors:
+            pass
+
+    def acquire(self):
+        if not self.slots.acquire(timeout=deadlines.get_timeout(0)):
+            raise deadlines.DeadlineExceeded()
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    ftp, last_used = self.idle.pop()
+                # check connections idle for a while, the server may have dropped them
+                if time.monotonic() - last_used < self.keepalive or self.is_alive(ftp):
+                    return ftp
+            return self.connect()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, ftp, healthy=True):
+        if healthy:
+            try:
+                # not bound by the deadline of the request that borrowed it
+                set_timeout(ftp, settings.UPSTREAM_READ_TIMEOUT or None)
+            except OSError:
+                healthy = False
+        if healthy:
+            with self.lock:
+                self.idle.append((ftp, time.monotonic()))
+            self.start_keepalive()
+        else:
+            self.discard(ftp)
+        self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection from the pool, i.e.:
+            with pool.connection() as ftp:
+                ftp.cwd(path)
+        """
+        with get_upstream(self.host).call():
+            ftp = self.acquire()
+            healthy = True
+            try:
+                set_timeout(ftp, deadlines.get_timeout(settings.UPSTREAM_READ_TIMEOUT))
+                yield ftp
+            except ftplib.all_errors:
+                # connection state is unknown after an error
+                healthy = False
+                raise
+            finally:
+                self.release(ftp, healthy)
+
+    def send_keepalives(self):
+        while True:
+            time.sleep(self.keepalive)
+            self.check_idle()
+
+    def check_idle(self):
+        """
+        Send a NOOP on every connection idle for a while, borrowing each one
+        under a slot, so the open connections never exceed the pool size
+        """
+        checked_at = time.monotonic()
+        while self.slots.acquire(blocking=False):
+            try:
+                with self.lock:
+                    # least recently used first, the ones checked go back at the end
+                    if not self.idle or checked_at - self.idle[0][1] < self.keepalive:
+                        return
+                    ftp, last_used = self.idle.pop(0)
+                if self.is_alive(ftp):
+                    with self.lock:
+                        self.idle.append((ftp, time.monotonic()))
+            finally:
+                self.slots.release()
+
+    def start_keepalive(self):
+        if self.keepalive_thread is None and self.keepalive > 0:
+            with self.lock:
+                if self.keepalive_thread is None:
+                    self.keepalive_thread = threading.Thread(
+                        target=self.send_keepalives, daemon=True,
+                        name=f"ftp-keepalive-{self.host}")
+                    self.keepalive_thread.start()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for ftp, last_used in idle:
+            self.discard(ftp)
+
+
+def set_timeout(ftp, timeout):
+    """
+    Timeout of the commands of a connection, and of its data connections
+    """
+    ftp.timeout = timeout
+    ftp.sock.settimeout(timeout)
+
+
+def list_dir(ftp, path, recursive=False):
+    """
+    List a remote directory in a single round trip using MLSD,
+    returning a list of dicts with name, type, size and modify time.
+    If recursive, subdirectories are also listed and names are relative to path.
+    """
+    deadlines.check()
+    entries = []
+    try:
+        listing = list(ftp.mlsd(path, facts=["type", "size", "modify"]))
+    except ftplib.error_perm as exc:
+        # MLSD not supported by the server, fall back to names only
+        logger.debug("MLSD not available on %s: %s", path, exc)
+        listing = list_names(ftp, path)
+    for name, facts in listing:
+        entry_type = facts.get("type", "").lower()
+        if entry_type in ("cdir", "pdir"):
+            continue
+        size = facts.get("size")
+        entries.append({"name": name,
+                        "type": entry_type,
+                        "size": int(size) if size else None,
+                        "modify": facts.get("modify")})
+        if recursive and entry_type == "dir":
+            for entry in list_dir(ftp, posixpath.join(path, name), recursive):
+                entry["name"] = posixpath.join(name, entry["name"])
+                entries.append(entry)
+    return entries
+
+
+def list_names(ftp, path):
+    """
+    List a remote directory using NLST, telling directories from files
+    by changing into each entry, as (name, facts) pairs like MLSD
+    """
+    listing = []
+    cwd = ftp.pwd()
+    for name in ftp.nlst(path):
+        name = posixpath.basename(name.rstrip("/"))
+        if name in ("", ".", ".."):
+            continue
+        try:
+            ftp.cwd(posixpath.join(path, name))
+            entry_type = "dir"
+            ftp.cwd(cwd)
+        except ftplib.error_perm:
+            entry_type = "file"
+        listing.append((name, {"type": entry_type}))
+    return listing
+
+
+_mtbls_pool = None
+_mtbls_pool_lock = threading.Lock()
+
+
+def get_mtbls_ftp_pool():
+    """
+    Shared pool of connections to the MetaboLights FTP server
+    """
+    global _mtbls_pool
+    if _mtbls_pool is None:
+        with _mtbls_pool_lock:
+            if _mtbls_pool is None:
+                _mtbls_pool = FTPConnectionPool(
+                    settings.MTBLS_FTP_URL,
+                    settings.MTBLS_FTP_USER,
+                    settings.MTBLS_FTP_USER_PASS,
+                    size=settings.MTBLS_FTP_POOL_SIZE,
+                    keepalive=settings.MTBLS_FTP_KEEPALIVE,
+                    port=settings.MTBLS_FTP_PORT)
+    return _mtbls_pool
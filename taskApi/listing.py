@@ -0,0 +1,167 @@
+"""
+This file contains the HTTP directory listing parser for the taskApi app.
+Index pages (as served by Apache or nginx) are parsed in a single pass into the
+same entries as taskApi.ftp.list_dir, and cached for a while, one request
+being shared by all the fetches listing the same URL at the same time.
+FTP listings are cached the same way (see get_cached).
+"""
+import logging
+import re
+import threading
+import time
+from datetime import datetime
+from html.parser import HTMLParser
+from urllib.parse import unquote, urljoin, urlparse
+
+from taskApi import deadlines
+from taskPrj import settings
+
+logger = logging.getLogger(__name__)
+
+# date and size following each link, i.e.: "2024-01-31 10:20  1.2K" or "31-Jan-2024 10:20  1234"
+ENTRY_DETAILS_PATTERN = re.compile(
+    r"(?P<date>\d{4}-\d{2}-\d{2} \d{2}:\d{2}(?::\d{2})?|\d{2}-[A-Za-z]{3}-\d{4} \d{2}:\d{2}(?::\d{2})?)"
+    r"\s+(?P<size>\d+(?:\.\d+)?[KMGT]?|-)")
+SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+DATE_FORMATS = ("%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%d-%b-%Y %H:%M", "%d-%b-%Y %H:%M:%S")
+
+
+def parse_size(size):
+    if not size or size == "-":
+        return None
+    unit = SIZE_UNITS.get(size[-1], 1)
+    return int(float(size.rstrip("KMGT")) * unit)
+
+
+def parse_date(date):
+    """
+    Listing date as modify time, in the MLSD format: YYYYMMDDHHMMSS
+    """
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(date, date_format).strftime("%Y%m%d%H%M%S")
+        except ValueError:
+            continue
+    return None
+
+
+class ListingParser(HTMLParser):
+    """
+    Collect the links of an index page, with the text following each of
+    them (where the date and size are), in linear time
+    """
+
+    def __init__(self, url):
+        super().__init__()
+        self.url = url
+        self.links = []
+        self.details = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+        href = dict(attrs).get("href")
+        if href:
+            self.details = []
+            self.links.append((href, self.details))
+
+    def handle_data(self, data):
+        if self.details is not None:
+            self.details.append(data)
+
+    def entries(self):
+        base_path = urlparse(self.url).path
+        entries = []
+        for href, details in self.links:
+            # skip sorting links, the parent directory and links outside of the listed directory
+            if href.startswith("?"):
+                continue
+            path = urlparse(urljoin(self.url, href)).path
+            if not path.startswith(base_path) or path == base_path:
+                continue
+            name = unquote(path[len(base_path):])
+            entry_type = "dir" if name.endswith("/") else "file"
+            name = name.rstrip("/")
+            if not name or "/" in name:
+                continue
+            match = ENTRY_DETAILS_PATTERN.search("".join(details))
+            entries.append({"name": name,
+                            "type": entry_type,
+                            "size": parse_size(match.group("size")) if match else None,
+                            "modify": parse_date(match.group("date")) if match else None})
+        return entries
+
+
+def parse_listing(url, html_data):
+    """
+    Entries of an index page, as dicts with name, type (file or dir), size and modify time
+    """
+    parser = ListingParser(url)
+    parser.feed(html_data)
+    parser.close()
+    return parser.entries()
+
+
+_listings = {}
+_in_flight = {}
+_lock = threading.Lock()
+
+
+def get_cached(key, list_function, ttl=None):
+    """
+    Listing returned by `list_function()`, cached for `ttl` seconds (HTTP_LISTING_TTL by default).
+    Concurrent calls for the same key wait for a single call.
+    Listings that do not exist (None) are not cached.
+    """
+    ttl = settings.HTTP_LISTING_TTL if ttl is None else ttl
+    while True:
+        with _lock:
+            cached = _listings.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+            event = _in_flight.get(key)
+            if event is None:
+                event = _in_flight[key] = threading.Event()
+                break
+        # another thread is listing the same directory
+        if not event.wait(deadlines.remaining()):
+            raise deadlines.DeadlineExceeded()
+        with _lock:
+            cached = _listings.get(key)
+        if cached is not None:
+            return cached[1]
+        # not cached (missing directory, failed request or no TTL), list it again
+    try:
+        entries = list_function()
+        with _lock:
+            if ttl > 0 and entries is not None:
+                _listings[key] = (time.monotonic() + ttl, entries)
+                # drop the listings expiring first, so the cache does not grow forever
+                if len(_listings) > settings.HTTP_LISTING_CACHE_SIZE:
+                    for expired in sorted(_listings, key=lambda key: _listings[key][0])[
+                            :len(_listings) - settings.HTTP_LISTING_CACHE_SIZE]:
+                        del _listings[expired]
+        return entries
+    finally:
+        with _lock:
+            del _in_flight[key]
+        event.set()
+
+
+def list_url(url, ttl=None):
+    """
+    List an HTTP indexed directory, cached for `ttl` seconds (HTTP_LISTING_TTL by default).
+    Concurrent calls for the same URL wait for a single request.
+    Returns None if the directory does not exist.
+    """
+    from taskApi.utils import get_text_data
+
+    if not url.endswith("/"):
+        url += "/"
+
+    def list_function():
+        logger.debug("List directory %s", url)
+        html_data = get_text_data(url)
+        return parse_listing(url, html_data) if html_data else None
+
+    return get_cached(url, list_function, ttl)
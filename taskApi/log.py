@@ -0,0 +1,143 @@
+"""
+This file contains low overhead logging helpers for the taskApi app:
+a non-blocking queue based file handler, a structured (JSON) formatter,
+lazy summaries of large payloads and the logging of worker processes.
+"""
+import atexit
+import copy
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+
+class PayloadSummary:
+    """
+    Lazy summary of a payload (size and hash instead of the whole content),
+    only computed if the log record is actually emitted, i.e.:
+        logger.debug("Got text_data: %s", PayloadSummary(text_data))
+    """
+    __slots__ = ("payload",)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        payload = self.payload
+        if payload is None:
+            return "<None>"
+        if isinstance(payload, str):
+            payload = payload.encode(errors="replace")
+        if isinstance(payload, bytes):
+            digest = hashlib.blake2b(payload, digest_size=8).hexdigest()
+            return f"<{len(payload)} bytes blake2b:{digest}>"
+        if isinstance(payload, (dict, list, tuple, set)):
+            return f"<{type(payload).__name__} of {len(payload)} items>"
+        return f"<{type(payload).__name__}>"
+
+
+class QueueRotatingFileHandler(logging.handlers.QueueHandler):
+    """
+    Rotating file handler writing from a background thread, so logging
+    only costs putting the record into a queue on the calling thread.
+    Records are dropped (and counted) if the queue is full.
+    """
+
+    def __init__(self, filename, maxBytes=0, backupCount=0, queueSize=10000):
+        super().__init__(queue.Queue(maxsize=queueSize))
+        self.dropped = 0
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.file_handler = logging.handlers.RotatingFileHandler(
+            filename, maxBytes=maxBytes, backupCount=backupCount)
+        self.listener = None
+        self.start()
+        atexit.register(self.close)
+        # the listener thread is not copied to forked processes,
+        # i.e. the workers of a pre-forking server loading the app first
+        os.register_at_fork(after_in_child=self.restart)
+
+    def start(self):
+        self.listener = logging.handlers.QueueListener(
+            self.queue, self.file_handler, respect_handler_level=False)
+        self.listener.start()
+
+    def restart(self):
+        if self.listener is not None:
+            self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            self.start()
+
+    def setFormatter(self, fmt):
+        # records are formatted by the file handler, on the background thread
+        self.file_handler.setFormatter(fmt)
+
+    def prepare(self, record):
+        # merge the message arguments now, as they may change after the call,
+        # leaving the formatting (time, traceback...) to the background thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+            self.file_handler.close()
+        super().close()
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per log record
+    """
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record),
+                 "level": record.levelname,
+                 "logger": record.name,
+                 "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class ForwardingHandler(logging.Handler):
+    """
+    Handle the records of other processes with the loggers of this one
+    """
+
+    def emit(self, record):
+        logger = logging.getLogger(record.name)
+        if logger.isEnabledFor(record.levelno):
+            logger.handle(record)
+
+
+def start_worker_logging(mp_context):
+    """
+    Queue for the records of worker processes (see configure_worker_logging),
+    and the listener handling them in this process, to be stopped once done
+    """
+    log_queue = mp_context.Queue()
+    listener = logging.handlers.QueueListener(log_queue, ForwardingHandler())
+    listener.start()
+    return log_queue, listener
+
+
+def configure_worker_logging(log_queue, level):
+    """
+    Send the records of a worker process to its parent, instead of
+    configuring the file handlers of the settings once more
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
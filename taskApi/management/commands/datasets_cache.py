@@ -0,0 +1,98 @@
+"""
+Command used to inspect and garbage collect the local datasets cache
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from taskApi import blobs, cache, utils
+from taskApi.repositories import get_repository
+from taskPrj import settings
+
+
+class Command(BaseCommand):
+    help = 'Show the local datasets cache usage, evict datasets over the quota, pin or unpin datasets, ' \
+           'and garbage collect or verify the blob store'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'action', choices=['usage', 'evict', 'rebuild', 'pin', 'unpin', 'gc', 'verify', 'dedupe'],
+            help="usage: list the cached datasets, evict: remove datasets over the quota, "
+                 "rebuild: scan the datasets dir to fix the index, pin/unpin: datasets never evicted, "
+                 "gc: remove the unused blobs, verify: check the blobs hashes (removing the corrupted "
+                 "ones and their datasets), dedupe: move the datasets files to the blob store")
+        parser.add_argument(
+            'accessions', nargs='*', type=str,
+            help="Dataset accession numbers to pin or unpin")
+        parser.add_argument(
+            '-q', '--quota',
+            type=int, default=settings.DATASETS_CACHE_QUOTA,
+            help="Max. size of the cache in bytes")
+        parser.add_argument(
+            '-p', '--policy',
+            choices=cache.POLICIES, default=settings.DATASETS_CACHE_POLICY,
+            help="Evict the least recently (lru) or the least frequently (lfu) used datasets first")
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Only list the datasets to evict, or the blobs to remove")
+
+    def handle(self, *args, **options):
+        action = options['action']
+        if action == 'usage':
+            entries, total = cache.get_usage()
+            for key, entry in sorted(entries.items(), key=lambda item: -item[1]["size"]):
+                pinned = " pinned" if cache.is_pinned(key, entry) else ""
+                print(f"{key:<30} {entry['size'] / 1024 / 1024:>10.2f} MB "
+                      f"{entry['hits']:>8} hits{pinned}")
+            print(f"Total: {len(entries)} datasets, {total / 1024 / 1024:.2f} MB, "
+                  f"quota {options['quota'] / 1024 / 1024:.2f} MB")
+            if blobs.is_enabled():
+                count, size = blobs.get_usage()
+                print(f"Blob store: {count} blobs, {size / 1024 / 1024:.2f} MB")
+        elif action == 'rebuild':
+            total = cache.rebuild_index()
+            print(f"Total: {total / 1024 / 1024:.2f} MB")
+        elif action == 'evict':
+            if not options['quota'] and not options['dry_run']:
+                raise CommandError("No quota set, use --quota or DATASETS_CACHE_QUOTA")
+            evicted = cache.evict(options['quota'], options['policy'], dry_run=options['dry_run'])
+            for key in evicted:
+                print(key)
+            print(f"{'Would evict' if options['dry_run'] else 'Evicted'} {len(evicted)} datasets")
+        elif action in ('gc', 'verify', 'dedupe'):
+            if not blobs.is_enabled():
+                raise CommandError("The blob store is not enabled, set DATASETS_STORAGE=blobs")
+            if action == 'gc':
+                count, size = blobs.collect_garbage(dry_run=options['dry_run'])
+                print(f"{'Would remove' if options['dry_run'] else 'Removed'} {count} blobs, "
+                      f"{size / 1024 / 1024:.2f} MB")
+            elif action == 'verify':
+                corrupted = blobs.verify()
+                for digest, datasets in corrupted.items():
+                    print(f"Corrupted blob {digest}: {', '.join(cache.get_key(*dataset) for dataset in datasets)}")
+                    if options['dry_run']:
+                        continue
+                    # the datasets are downloaded again when next requested
+                    for prefix, accession in datasets:
+                        cache.discard(prefix, accession)
+                    blobs.remove(digest)
+                print(f"{len(corrupted)} corrupted blobs")
+            else:
+                cache.rebuild_index()
+                entries, total = cache.get_usage()
+                for key in entries:
+                    utils.store_dataset_blobs(*key.split("/", 1))
+                # shared files now count once
+                total = cache.rebuild_index()
+                count, size = blobs.get_usage()
+                print(f"{len(entries)} datasets, {total / 1024 / 1024:.2f} MB "
+                      f"stored as {count} blobs, {size / 1024 / 1024:.2f} MB")
+        else:
+            if not options['accessions']:
+                raise CommandError("Please provide at least one dataset accession number.")
+            for accession in options['accessions']:
+                repository = get_repository(accession)
+                if repository is None:
+                    print(f"Invalid accession code: {accession}")
+                    continue
+                cache.set_pinned(repository.prefix, accession, pinned=action == 'pin')
+                print(f"{accession} {action}ned")
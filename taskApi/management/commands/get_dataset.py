@@ -2,7 +2,7 @@
 Command used to get the dataset data from the repository API
 """
 from django.core.management.base import BaseCommand
-from taskApi.utils import get_dataset_data
+from taskApi.repositories import get_repository
 
 
 class Command(BaseCommand):
@@ -22,6 +22,10 @@ class Command(BaseCommand):
             return
 
         accession = options['accession'][0]
+        repository = get_repository(accession)
+        if repository is None:
+            print(f"Invalid accession code: {accession}")
+            return
         print(f"Getting Dataset data from {accession}")
-        get_dataset_data(accession)
+        repository.fetch(accession)
         print("Done.")
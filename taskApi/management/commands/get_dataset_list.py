@@ -3,7 +3,7 @@ Command used to get the datasets list from the dataset repository API
 """
 
 from django.core.management.base import BaseCommand
-from taskApi.utils import get_dataset_list
+from taskApi.repositories import get_dataset_list, get_repositories
 
 
 class Command(BaseCommand):
@@ -13,7 +13,7 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         ca = parser.add_argument(
             '-s', '--dataset_repository',
-            choices=['MetaboLights', 'Metabolomics-Workbench', 'MetaboBank'],
+            choices=[repository.name for repository in get_repositories()],
             nargs=1, type=str,
             help="<Required> Repository name, i.e.: MetaboLights | ")
 
@@ -31,5 +31,6 @@ class Command(BaseCommand):
         
         repository_name = options['dataset_repository'][0]
         print(f"Getting datasets list from {repository_name}")
-        get_dataset_list(repository_name)
-        print("Done.")
+        result = get_dataset_list(repository_name)
+        print(f"Done: {result['total']} datasets listed, "
+              f"{result['new']} new, {result['removed']} removed.")
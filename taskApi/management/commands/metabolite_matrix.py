@@ -0,0 +1,46 @@
+"""
+Command used to build the study-by-metabolite matrix
+"""
+from django.core.management.base import BaseCommand
+
+from taskApi import cache, matrix, similarity, utils
+from taskApi.repositories import get_repository_by_prefix
+
+
+class Command(BaseCommand):
+    help = 'Build the study-by-metabolite matrix, optionally storing first the metabolites ' \
+           'of every dataset in the local cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--backfill',
+            action='store_true',
+            help="Parse every dataset in the local cache to store its metabolites and signature")
+
+    def handle(self, *args, **options):
+        if options['backfill']:
+            cache.rebuild_index()
+            entries, total = cache.get_usage()
+            changed = 0
+            for key in sorted(entries):
+                prefix, accession = key.split("/", 1)
+                repository = get_repository_by_prefix(prefix)
+                # skip the datasets cached without their metabolites
+                if repository is None or not repository.is_complete(accession, "metabolites"):
+                    continue
+                components = tuple(component for component in ("metadata", "metabolites")
+                                   if repository.is_complete(accession, component))
+                try:
+                    dataset = repository.parse(accession, components)
+                except Exception as exc:
+                    print(f"Could not parse {accession}: {exc}")
+                    continue
+                changed += utils.sync_dataset_metabolites(
+                    prefix, repository.name, accession,
+                    dataset.get("Title"), dataset.get("Metabolites", []))
+                similarity.update_signature(accession, dataset.get("Metabolites", []))
+            print(f"{changed} of {len(entries)} datasets with new metabolites")
+        metabolite_matrix = matrix.MetaboliteMatrix(matrix.build(rebuild=True))
+        print(f"{metabolite_matrix.count_studies()} studies, "
+              f"{metabolite_matrix.count_metabolites()} metabolites, "
+              f"{len(metabolite_matrix.indices)} entries")
@@ -0,0 +1,107 @@
+"""
+Command used to prefetch (warm) the local cache for many datasets at once
+"""
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+
+from taskApi.models import Dataset
+from taskApi.repositories import (get_repositories, get_repository,
+                                  get_repository_by_name)
+from taskApi.utils import get_dataset_size
+from taskPrj import settings
+
+
+class Command(BaseCommand):
+    help = 'Prefetch datasets data into the local cache, using parallel workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'accessions', nargs='*', type=str,
+            help="Dataset accession numbers, i.e.: MTBLSxxx, STxxx, MTBKxxx")
+        parser.add_argument(
+            '-f', '--file',
+            type=str,
+            help="File with one accession number per line, use '-' to read from stdin")
+        parser.add_argument(
+            '-s', '--dataset_repository',
+            choices=[repository.name for repository in get_repositories()],
+            type=str,
+            help="Warm all the datasets of a repository, as listed by get_dataset_list")
+        parser.add_argument(
+            '-w', '--workers',
+            type=int, default=settings.WARM_CACHE_WORKERS,
+            help="Number of parallel workers")
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help="Download again datasets already in the local cache")
+
+    def read_accessions(self, options):
+        accessions = list(options['accessions'])
+        if options['file'] == '-':
+            accessions += sys.stdin.read().split()
+        elif options['file']:
+            with open(options['file']) as f:
+                accessions += f.read().split()
+        if options['dataset_repository']:
+            repository = get_repository_by_name(options['dataset_repository'])
+            accessions += Dataset.objects.filter(
+                repository__accession_template=f"{repository.prefix}xxx", available=True
+            ).order_by("accession").values_list("accession", flat=True)
+        # remove duplicates, keeping the order
+        return list(dict.fromkeys(accessions))
+
+    def warm_dataset(self, repository, accession):
+        # paced by the upstream rate limits, shared with the API requests
+        repository.fetch(accession)
+        return get_dataset_size(repository.prefix, accession)
+
+    def handle(self, *args, **options):
+        accessions = self.read_accessions(options)
+        if not accessions:
+            print("Please provide at least one dataset accession number.")
+            return
+
+        # skip invalid and already complete datasets,
+        # so an interrupted run can be resumed just running it again
+        pending = []
+        skipped = 0
+        for accession in accessions:
+            repository = get_repository(accession)
+            if repository is None:
+                print(f"Invalid accession code: {accession}")
+            elif not options['force'] and repository.is_fresh(accession):
+                skipped += 1
+            else:
+                pending.append((repository, accession))
+        print(f"Warming {len(pending)} datasets, {skipped} already in cache")
+
+        done = failed = total_bytes = 0
+        start = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=max(1, options['workers']))
+        try:
+            futures = {executor.submit(self.warm_dataset, repository, accession): accession
+                       for repository, accession in pending}
+            for future in as_completed(futures):
+                accession = futures[future]
+                try:
+                    total_bytes += future.result()
+                    done += 1
+                    print(f"[{done + failed}/{len(pending)}] {accession}")
+                except Exception as exc:
+                    failed += 1
+                    print(f"[{done + failed}/{len(pending)}] {accession} failed: {exc}")
+        except KeyboardInterrupt:
+            print("Interrupted, run the command again to resume.")
+            executor.shutdown(wait=True, cancel_futures=True)
+        else:
+            executor.shutdown(wait=True)
+
+        elapsed = max(time.monotonic() - start, 1e-6)
+        print(f"Done: {done} datasets, {failed} failed, "
+              f"{total_bytes / 1024 / 1024:.2f} MB in {elapsed:.1f}s "
+              f"({done / elapsed:.2f} datasets/s, "
+              f"{total_bytes / 1024 / 1024 / elapsed:.2f} MB/s)")
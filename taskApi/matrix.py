@@ -0,0 +1,532 @@
+"""
+This file contains the study-by-metabolite matrix of the taskApi app.
+The metabolites of every parsed dataset are stored (in a background thread)
+in the DatasetMetabolite table (and its signature, see similarity.py), and a
+sparse matrix of the studies (rows) by metabolites (columns) is kept as numpy
+arrays in METABOLITE_MATRIX_DIR, memory-mapped by every process. The matrix
+is built once from the table; then every dataset stored is appended to the
+delta of the current version, read by every process over the arrays, and
+merged into a new version once it holds METABOLITE_MATRIX_MERGE_SIZE entries.
+Queries are vectorised over it: studies reporting a metabolite, top
+metabolites, co-occurrence.
+"""
+import fcntl
+import json
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db import close_old_connections
+
+from taskApi import similarity, utils
+from taskApi.models import DatasetMetabolite, Metabolite, normalize_metabolite_name
+from taskApi.repositories import get_repository_name
+from taskPrj import settings
+
+logger = logging.getLogger(__name__)
+
+ARRAYS = ("indptr", "indices", "rows", "t_indptr", "t_indices", "study_repositories")
+# datasets whose fetch time stored by this process is remembered
+RECORDED_SIZE = 10000
+
+# parsed datasets waiting to be stored, and the fetch time of the ones stored by this process
+_pending = queue.Queue(maxsize=settings.METABOLITE_MATRIX_QUEUE_SIZE)
+_recorded = OrderedDict()
+_recorded_lock = threading.Lock()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def record(repository, accession, dataset):
+    """
+    Queue the metabolites of a parsed dataset to be stored,
+    once per process and version of the local copy
+    """
+    fetched_at = utils.get_dataset_fetched_at(repository.prefix, accession, "metabolites")
+    with _recorded_lock:
+        if fetched_at is None or _recorded.get(accession) == fetched_at:
+            return
+        _recorded[accession] = fetched_at
+        _recorded.move_to_end(accession)
+        while len(_recorded) > RECORDED_SIZE:
+            _recorded.popitem(last=False)
+    try:
+        _pending.put_nowait((repository.prefix, repository.name, accession,
+                             dataset.get("Title"), dataset.get("Metabolites", [])))
+    except queue.Full:
+        logger.debug("Metabolites queue full, skip Dataset %s", accession)
+        forget(accession)
+        return
+    start_worker()
+
+
+def forget(accession):
+    with _recorded_lock:
+        _recorded.pop(accession, None)
+
+
+def store(prefix, repository_name, accession, title, metabolites):
+    """
+    Store the metabolites of a parsed dataset, and its signature for the similar
+    datasets search, adding them to the matrix
+    """
+    utils.sync_dataset_metabolites(prefix, repository_name, accession, title, metabolites)
+    similarity.update_signature(accession, metabolites)
+    if append(accession, metabolites) >= settings.METABOLITE_MATRIX_MERGE_SIZE:
+        merge()
+
+
+def run_worker():
+    while True:
+        item = _pending.get()
+        try:
+            store(*item)
+        except Exception as exc:
+            logger.exception(exc)
+            # try again next time the dataset is parsed
+            forget(item[2])
+        finally:
+            close_old_connections()
+
+
+def start_worker():
+    global _worker
+    if _worker is not None:
+        return
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=run_worker, name="metabolite-matrix", daemon=True)
+            _worker.start()
+
+
+def get_version_dir(version):
+    return os.path.join(settings.METABOLITE_MATRIX_DIR, version)
+
+
+def get_pointer_path():
+    return os.path.join(settings.METABOLITE_MATRIX_DIR, "current.json")
+
+
+def read_pointer():
+    """
+    Current version, and number of entries of its delta. None if not built yet.
+    """
+    try:
+        with open(get_pointer_path()) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_pointer(pointer):
+    with open(f"{get_pointer_path()}.tmp", "w") as f:
+        json.dump(pointer, f)
+    os.replace(f"{get_pointer_path()}.tmp", get_pointer_path())
+
+
+@contextmanager
+def lock_matrix():
+    """
+    Lock the current version and its delta, across processes
+    """
+    os.makedirs(settings.METABOLITE_MATRIX_DIR, exist_ok=True)
+    with open(os.path.join(settings.METABOLITE_MATRIX_DIR, ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def append(accession, metabolites):
+    """
+    Append the metabolites of a dataset to the delta of the current version,
+    replacing its previous ones. Returns the number of entries of the delta.
+    """
+    # first spelling of every name
+    names = {normalize_metabolite_name(name)[:255]: name.strip()[:255]
+             for name in reversed(list(metabolites)) if name}
+    line = json.dumps({"accession": accession, "metabolites": list(names.values())})
+    with lock_matrix():
+        pointer = read_pointer()
+        if pointer is None:
+            # not built yet, the build reads it from the table
+            return 0
+        with open(os.path.join(get_version_dir(pointer["version"]), "delta.jsonl"), "a") as f:
+            f.write(f"{line}\n")
+        pointer["delta_entries"] += 1
+        write_pointer(pointer)
+    return pointer["delta_entries"]
+
+
+def read_delta(version_dir, entries):
+    """
+    First entries of the delta of a version
+    """
+    delta = []
+    if not entries:
+        return delta
+    with open(os.path.join(version_dir, "delta.jsonl")) as f:
+        for line in f:
+            delta.append(json.loads(line))
+            if len(delta) == entries:
+                break
+    return delta
+
+
+def write_version(accessions, metabolites, rows, columns):
+    """
+    Write a new version of the matrix from its entries (rows and columns of the
+    given accessions and metabolite names), leaving out the unused ones. Returns
+    the new version.
+    """
+    import numpy as np
+
+    study_rows, rows = np.unique(np.asarray(rows, dtype=np.int64), return_inverse=True)
+    accessions = np.asarray(accessions, dtype=str)[study_rows]
+    metabolite_columns, columns = np.unique(np.asarray(columns, dtype=np.int64), return_inverse=True)
+    metabolites = np.asarray(metabolites, dtype=str)[metabolite_columns]
+    rows = rows.astype(np.int32)
+    columns = columns.astype(np.int32)
+
+    # studies by metabolites (CSR) and its transpose (CSC), for the metabolite lookups
+    order = np.lexsort((columns, rows))
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=len(accessions)))))
+    t_order = np.lexsort((rows, columns))
+    t_indptr = np.concatenate(([0], np.cumsum(np.bincount(columns, minlength=len(metabolites)))))
+
+    # adapter names, the same ones given to record() and the views
+    repositories = [get_repository_name(accession) or "" for accession in accessions.tolist()]
+    repository_names = sorted(set(repositories))
+    repository_index = {name: i for i, name in enumerate(repository_names)}
+    study_repositories = np.array([repository_index[repository] for repository in repositories],
+                                  dtype=np.int16)
+
+    arrays = {"indptr": indptr.astype(np.int64),
+              "indices": columns[order],
+              "rows": rows[order],
+              "t_indptr": t_indptr.astype(np.int64),
+              "t_indices": rows[t_order],
+              "study_repositories": study_repositories}
+    os.makedirs(settings.METABOLITE_MATRIX_DIR, exist_ok=True)
+    version_dir = tempfile.mkdtemp(prefix=f"{time.time() * 1000:.0f}.", dir=settings.METABOLITE_MATRIX_DIR)
+    version = os.path.basename(version_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(version_dir, f"{name}.npy"), array)
+    with open(os.path.join(version_dir, "labels.json"), "w") as f:
+        json.dump({"accessions": accessions.tolist(),
+                   "repositories": repository_names,
+                   "metabolites": metabolites.tolist()}, f)
+    open(os.path.join(version_dir, "delta.jsonl"), "w").close()
+    logger.debug("Written metabolite matrix %s: %d studies, %d metabolites, %d entries",
+                 version, len(accessions), len(metabolites), len(rows))
+    return version
+
+
+def switch_version(version, delta_entries=0):
+    """
+    Switch to a new version, then remove the previous ones
+    (processes still using them keep their memory maps)
+    """
+    write_pointer({"version": version, "delta_entries": delta_entries})
+    for name in os.listdir(settings.METABOLITE_MATRIX_DIR):
+        if name != version and os.path.isdir(get_version_dir(name)):
+            shutil.rmtree(get_version_dir(name), ignore_errors=True)
+
+
+def build(rebuild=False):
+    """
+    Build the matrix from the DatasetMetabolite table, if not built yet
+    (or always with rebuild), returning the dir of its current version
+    """
+    import numpy as np
+
+    # the datasets stored meanwhile wait to be appended to the new version
+    with lock_matrix():
+        pointer = read_pointer()
+        if pointer is not None and not rebuild:
+            # just built by another process
+            return get_version_dir(pointer["version"])
+        start = time.monotonic()
+        pairs = np.array(list(DatasetMetabolite.objects.values_list("dataset_id", "metabolite_id")
+                              .iterator(chunk_size=10000)), dtype=object).reshape(-1, 2)
+        accessions, rows = np.unique(pairs[:, 0].astype(str), return_inverse=True)
+        metabolite_ids, columns = np.unique(pairs[:, 1].astype(np.int64), return_inverse=True)
+        names = dict(Metabolite.objects.filter(datasets__isnull=False).distinct()
+                     .values_list("id", "name"))
+        metabolites = [names[metabolite_id] or "" for metabolite_id in metabolite_ids.tolist()]
+        version = write_version(accessions, metabolites, rows, columns)
+        switch_version(version)
+    logger.debug("Built metabolite matrix %s from %d entries in %.3fs",
+                 version, len(pairs), time.monotonic() - start)
+    return get_version_dir(version)
+
+
+def merge():
+    """
+    Merge the delta of the current version into a new version, unless merged
+    by another process meanwhile
+    """
+    start = time.monotonic()
+    with lock_matrix():
+        pointer = read_pointer()
+        if pointer is None or pointer["delta_entries"] < settings.METABOLITE_MATRIX_MERGE_SIZE:
+            return
+    version_dir = get_version_dir(pointer["version"])
+    metabolite_matrix = MetaboliteMatrix(version_dir).apply(
+        read_delta(version_dir, pointer["delta_entries"]))
+    rows, columns = metabolite_matrix.get_entries()
+    version = write_version(metabolite_matrix.accessions + metabolite_matrix.new_accessions,
+                            metabolite_matrix.metabolites + metabolite_matrix.new_metabolites,
+                            rows, columns)
+    with lock_matrix():
+        current = read_pointer()
+        if current["version"] != pointer["version"]:
+            shutil.rmtree(get_version_dir(version), ignore_errors=True)
+            return
+        # the entries appended while merging go on in the delta of the new version
+        delta = read_delta(version_dir, current["delta_entries"])[pointer["delta_entries"]:]
+        with open(os.path.join(get_version_dir(version), "delta.jsonl"), "a") as f:
+            f.writelines(f"{json.dumps(entry)}\n" for entry in delta)
+        switch_version(version, len(delta))
+    logger.debug("Merged %d entries into metabolite matrix %s in %.3fs",
+                 pointer["delta_entries"], version, time.monotonic() - start)
+
+
+class MetaboliteMatrix:
+    """
+    Memory-mapped version of the matrix, with its delta applied over it
+    """
+
+    def __init__(self, version_dir):
+        import numpy as np
+
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(version_dir, f"{name}.npy"), mmap_mode="r"))
+        with open(os.path.join(version_dir, "labels.json")) as f:
+            labels = json.load(f)
+        self.accessions = labels["accessions"]
+        self.repositories = labels["repositories"]
+        self.metabolites = labels["metabolites"]
+        self.study_rows = {accession: row for row, accession in enumerate(self.accessions)}
+        self.columns = {normalize_metabolite_name(name): column
+                        for column, name in enumerate(self.metabolites)}
+        # delta: studies and metabolites added, studies replaced, and its entries
+        self.new_accessions = []
+        self.new_metabolites = []
+        self.new_study_rows = {}
+        self.new_columns = {}
+        self.replaced = np.zeros(len(self.accessions), dtype=bool)
+        self.delta_rows = np.zeros(0, dtype=np.int32)
+        self.delta_columns = np.zeros(0, dtype=np.int32)
+        self.all_study_repositories = self.study_repositories
+
+    def apply(self, delta):
+        """
+        Copy of the matrix with the delta entries applied, the last entry of a
+        study replacing its metabolites
+        """
+        import numpy as np
+
+        metabolite_matrix = MetaboliteMatrix.__new__(MetaboliteMatrix)
+        metabolite_matrix.__dict__.update(self.__dict__)
+        metabolite_matrix.repositories = list(self.repositories)
+        metabolite_matrix.new_accessions = list(self.new_accessions)
+        metabolite_matrix.new_metabolites = list(self.new_metabolites)
+        metabolite_matrix.new_study_rows = dict(self.new_study_rows)
+        metabolite_matrix.new_columns = dict(self.new_columns)
+        metabolite_matrix.replaced = self.replaced.copy()
+        latest = {entry["accession"]: entry["metabolites"] for entry in delta}
+        if not latest:
+            return metabolite_matrix
+        # the previous delta entries of the studies replaced
+        replaced = [metabolite_matrix.get_row(accession) for accession in latest]
+        keep = ~np.isin(self.delta_rows, [row for row in replaced if row is not None])
+        rows, columns = [self.delta_rows[keep]], [self.delta_columns[keep]]
+        new_repositories = []
+        for accession, names in latest.items():
+            row = metabolite_matrix.get_row(accession)
+            if row is None:
+                row = len(self.accessions) + len(metabolite_matrix.new_accessions)
+                metabolite_matrix.new_accessions.append(accession)
+                metabolite_matrix.new_study_rows[accession] = row
+                repository = get_repository_name(accession) or ""
+                if repository not in metabolite_matrix.repositories:
+                    metabolite_matrix.repositories.append(repository)
+                new_repositories.append(metabolite_matrix.repositories.index(repository))
+            elif row < len(self.accessions):
+                metabolite_matrix.replaced[row] = True
+            study_columns = []
+            for name in names:
+                column = metabolite_matrix.get_column(name)
+                if column is None:
+                    column = len(self.metabolites) + len(metabolite_matrix.new_metabolites)
+                    metabolite_matrix.new_metabolites.append(name)
+                    metabolite_matrix.new_columns[normalize_metabolite_name(name)] = column
+                study_columns.append(column)
+            rows.append(np.full(len(study_columns), row, dtype=np.int32))
+            columns.append(np.array(study_columns, dtype=np.int32))
+        metabolite_matrix.delta_rows = np.concatenate(rows)
+        metabolite_matrix.delta_columns = np.concatenate(columns)
+        metabolite_matrix.all_study_repositories = np.concatenate(
+            (self.all_study_repositories, np.array(new_repositories, dtype=np.int16)))
+        return metabolite_matrix
+
+    def get_entries(self):
+        """
+        Rows and columns of all the entries, the delta ones included
+        """
+        import numpy as np
+
+        keep = ~self.replaced[self.rows]
+        return (np.concatenate((self.rows[keep], self.delta_rows)),
+                np.concatenate((self.indices[keep], self.delta_columns)))
+
+    def count_studies(self):
+        return len(self.accessions) + len(self.new_accessions)
+
+    def count_metabolites(self):
+        return len(self.metabolites) + len(self.new_metabolites)
+
+    def get_row(self, accession):
+        row = self.study_rows.get(accession)
+        return self.new_study_rows.get(accession) if row is None else row
+
+    def get_column(self, name):
+        column = self.columns.get(normalize_metabolite_name(name))
+        return self.new_columns.get(normalize_metabolite_name(name)) if column is None else column
+
+    def get_metabolite(self, column):
+        if column < len(self.metabolites):
+            return self.metabolites[column]
+        return self.new_metabolites[column - len(self.metabolites)]
+
+    def get_repository_index(self, repository):
+        """
+        Index of a repository name, -1 if no study of the repository, None for all of them
+        """
+        if repository is None:
+            return None
+        return self.repositories.index(repository) if repository in self.repositories else -1
+
+    def get_studies(self, column, repository=None):
+        """
+        Rows of the studies reporting a metabolite
+        """
+        import numpy as np
+
+        studies = self.delta_rows[self.delta_columns == column]
+        if column < len(self.metabolites):
+            base_studies = self.t_indices[self.t_indptr[column]:self.t_indptr[column + 1]]
+            studies = np.concatenate((base_studies[~self.replaced[base_studies]], studies))
+        repository_index = self.get_repository_index(repository)
+        if repository_index is not None:
+            studies = studies[self.all_study_repositories[studies] == repository_index]
+        return studies
+
+    def get_counts(self, column):
+        """
+        Number of studies reporting a metabolite, by repository
+        """
+        import numpy as np
+
+        counts = np.bincount(self.all_study_repositories[self.get_studies(column)],
+                             minlength=len(self.repositories))
+        return dict(zip(self.repositories, counts.tolist()))
+
+    def get_column_counts(self, studies=None, repository=None):
+        """
+        Number of studies reporting every metabolite, among the given studies
+        (rows) or of a repository
+        """
+        import numpy as np
+
+        repository_index = self.get_repository_index(repository)
+        counts = np.zeros(self.count_metabolites(), dtype=np.int64)
+        if studies is None and repository_index is None and not self.replaced.any():
+            counts[:len(self.metabolites)] = np.diff(self.t_indptr)
+            counts += np.bincount(self.delta_columns, minlength=len(counts))
+            return counts
+        mask = np.ones(self.count_studies(), dtype=bool)
+        if studies is not None:
+            mask[:] = False
+            mask[studies] = True
+        if repository_index is not None:
+            mask &= self.all_study_repositories == repository_index
+        base_mask = mask[:len(self.accessions)] & ~self.replaced
+        counts[:len(self.metabolites)] = np.bincount(self.indices[base_mask[self.rows]],
+                                                     minlength=len(self.metabolites))
+        counts += np.bincount(self.delta_columns[mask[self.delta_rows]], minlength=len(counts))
+        return counts
+
+    def top(self, counts, k):
+        """
+        Columns of the k highest counts, highest first
+        """
+        import numpy as np
+
+        k = min(k, np.count_nonzero(counts))
+        if k == 0:
+            return []
+        columns = np.argpartition(-counts, k - 1)[:k]
+        return columns[np.argsort(-counts[columns], kind="stable")].tolist()
+
+
+_matrix = None
+_matrix_pointer = None
+_base = None
+_building = threading.Lock()
+
+
+def start_build():
+    """
+    Build the matrix in the background, if not being built by this process
+    """
+    if not _building.acquire(blocking=False):
+        return
+
+    def run_build():
+        try:
+            build()
+        except Exception as exc:
+            logger.exception(exc)
+        finally:
+            _building.release()
+            close_old_connections()
+
+    threading.Thread(target=run_build, name="metabolite-matrix-build", daemon=True).start()
+
+
+def get_matrix():
+    """
+    Current matrix, with its delta. None while it is built for the first time,
+    in the background.
+    """
+    global _matrix, _matrix_pointer
+    pointer = read_pointer()
+    if pointer is None:
+        start_build()
+        return None
+    if pointer != _matrix_pointer:
+        try:
+            _matrix = load(pointer)
+        except FileNotFoundError:
+            # replaced meanwhile by another process
+            pointer = read_pointer()
+            _matrix = load(pointer)
+        _matrix_pointer = pointer
+    return _matrix
+
+
+def load(pointer):
+    """
+    Version of the matrix with its delta, reusing its arrays if already loaded
+    """
+    global _base
+    version_dir = get_version_dir(pointer["version"])
+    if _matrix_pointer is None or pointer["version"] != _matrix_pointer["version"]:
+        _base = MetaboliteMatrix(version_dir)
+    return _base.apply(read_delta(version_dir, pointer["delta_entries"]))
@@ -0,0 +1,271 @@
+"""
+This file contains the runtime metrics for the taskApi app.
+Metrics are kept in memory by each process (not aggregated across the
+workers, every worker is scraped) and exposed at /metrics using the
+Prometheus text format.
+"""
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from taskPrj import settings
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, math.inf)
+
+_registry = []
+# stage durations of the current request, for the Server-Timing header, also
+# added by the background fetches started by the request
+_server_timings = contextvars.ContextVar("server_timings", default=None)
+_server_timings_lock = threading.Lock()
+# observations kept to be replayed in another process, None to observe them right away
+_recorded = contextvars.ContextVar("recorded", default=None)
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric:
+    """
+    Base class for metrics, with values by label
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        values = ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs)
+        return "{" + values + "}"
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            lines += self.samples()
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        return [f"{self.name}{self.format_labels(key)} {value}"
+                for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    @contextmanager
+    def track_in_progress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self):
+        return [f"{self.name}{self.format_labels(key)} {value}"
+                for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, stage=None, **labels):
+        """
+        Observe the duration of a block of code, also reported
+        as `stage` in the Server-Timing header of the current request
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            recorded = _recorded.get()
+            if recorded is not None:
+                recorded.append((self.name, elapsed, labels, stage))
+            else:
+                self.observe(elapsed, **labels)
+                if stage:
+                    add_server_timing(stage, elapsed)
+
+    def samples(self):
+        lines = []
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else f"{bound}"
+                lines.append(
+                    f"{self.name}_bucket{self.format_labels(key, ('le', le))} {cumulative}")
+            lines.append(f"{self.name}_sum{self.format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{self.format_labels(key)} {cumulative}")
+        return lines
+
+
+def render_metrics():
+    lines = []
+    for metric in _registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def add_server_timing(stage, elapsed):
+    timings = _server_timings.get()
+    if timings is not None:
+        with _server_timings_lock:
+            timings[stage] = timings.get(stage, 0) + elapsed
+
+
+@contextmanager
+def recording():
+    """
+    Record the durations timed within a block instead of observing them,
+    i.e. in a worker process, to be replayed by the parent one:
+        with recording() as observations:
+            parse(...)
+        replay(observations)
+    """
+    observations = []
+    token = _recorded.set(observations)
+    try:
+        yield observations
+    finally:
+        _recorded.reset(token)
+
+
+def replay(observations):
+    """
+    Observe the durations recorded by `recording`
+    """
+    histograms = {metric.name: metric for metric in _registry if isinstance(metric, Histogram)}
+    for name, elapsed, labels, stage in observations:
+        histograms[name].observe(elapsed, **labels)
+        if stage:
+            add_server_timing(stage, elapsed)
+
+
+class MetricsMiddleware:
+    """
+    Count requests and their duration by view, adding a Server-Timing
+    header with the stages timed during the request if enabled
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _server_timings.set({})
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+            elapsed = time.perf_counter() - start
+            match = request.resolver_match
+            view = match.view_name if match else "unknown"
+            HTTP_REQUESTS.inc(view=view, status=response.status_code)
+            HTTP_REQUEST_SECONDS.observe(elapsed, view=view)
+            if settings.METRICS_SERVER_TIMING:
+                # background fetches started by the request may still add stages
+                with _server_timings_lock:
+                    stages = list(_server_timings.get().items())
+                timings = [f"{stage};dur={duration * 1000:.1f}" for stage, duration in stages]
+                timings.append(f"total;dur={elapsed * 1000:.1f}")
+                response["Server-Timing"] = ", ".join(timings)
+            return response
+        finally:
+            _server_timings.reset(token)
+
+
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "HTTP requests by view and status code",
+    ("view", "status"))
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_seconds", "HTTP requests duration by view",
+    ("view",))
+DATASET_FETCH_SECONDS = Histogram(
+    "dataset_fetch_seconds", "Time spent downloading a dataset by repository",
+    ("repository",))
+DATASET_FETCHES_IN_FLIGHT = Gauge(
+    "dataset_fetches_in_flight", "Datasets being downloaded by repository",
+    ("repository",))
+DATASET_PARSE_SECONDS = Histogram(
+    "dataset_parse_seconds", "Time spent parsing dataset files by file type",
+    ("file_type",))
+DATASET_CACHE_REQUESTS = Counter(
+    "dataset_cache_requests_total", "Dataset lookups by repository and cache result (hit, miss, stale, revalidate, pending)",
+    ("repository", "result"))
+DATASET_CACHE_BYTES = Gauge(
+    "dataset_cache_bytes", "Size of the local datasets cache, as last accounted by this process",
+    ())
+DATASET_CACHE_EVICTIONS = Counter(
+    "dataset_cache_evictions_total", "Datasets evicted from the local cache by repository prefix",
+    ("prefix",))
+DATASET_SHARED_TRANSFERS = Counter(
+    "dataset_shared_transfers_total", "Datasets copied from (download) or to (upload) the shared storage by repository",
+    ("repository", "direction"))
+UPSTREAM_REQUEST_SECONDS = Histogram(
+    "upstream_request_seconds", "Time spent on upstream requests by host",
+    ("host",))
+UPSTREAM_BYTES = Counter(
+    "upstream_bytes_downloaded_total", "Bytes downloaded from upstream by host",
+    ("host",))
+FTP_CONNECT_SECONDS = Histogram(
+    "ftp_connect_seconds", "Time spent on FTP login handshakes by host",
+    ("host",))
+RESPONSE_ENCODE_SECONDS = Histogram(
+    "response_encode_seconds", "Time spent encoding JSON responses by view",
+    ("view",))
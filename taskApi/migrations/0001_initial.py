@@ -0,0 +1,75 @@
+# Generated by Django 4.2.20 on 2026-10-19 15:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+import taskApi.models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Dataset',
+            fields=[
+                ('accession', models.CharField(default='', max_length=50, primary_key=True, serialize=False)),
+                ('title', models.CharField(blank=True, max_length=100, null=True)),
+                ('description', models.TextField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DatasetRepository',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, max_length=100, null=True)),
+                ('accession_template', models.CharField(blank=True, max_length=10, null=True)),
+                ('repository_website', models.CharField(blank=True, max_length=250, null=True)),
+            ],
+            options={
+                'verbose_name': 'Dataset-Repository',
+                'verbose_name_plural': 'Dataset-Repositories',
+            },
+        ),
+        migrations.CreateModel(
+            name='Metabolite',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, max_length=100, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DatasetRepositoryFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(blank=True, max_length=255, null=True)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('repository', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='taskApi.datasetrepository')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DatasetMetabolite',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dataset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='taskApi.dataset')),
+                ('metabolite', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='taskApi.metabolite')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DatasetFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(blank=True, null=True, upload_to=taskApi.models.dataset_files_folder)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('dataset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='taskApi.dataset')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='dataset',
+            name='repository',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='taskApi.datasetrepository'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.20 on 2026-10-19 15:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taskApi', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataset',
+            name='available',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='dataset',
+            name='last_synced',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
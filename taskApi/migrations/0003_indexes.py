@@ -0,0 +1,37 @@
+# Generated by Django 4.2.20 on 2026-10-19 15:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taskApi', '0002_dataset_catalog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataset',
+            name='metabolites',
+            field=models.ManyToManyField(blank=True, related_name='datasets', through='taskApi.DatasetMetabolite', to='taskApi.metabolite'),
+        ),
+        migrations.AddField(
+            model_name='metabolite',
+            name='normalized_name',
+            field=models.CharField(editable=False, max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='dataset',
+            name='title',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='metabolite',
+            name='name',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='dataset',
+            index=models.Index(fields=['repository', 'available'], name='dataset_repository_available'),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Backfills Metabolite.normalized_name, then merges the metabolites (and the
+# repositories) left duplicated, before 0005 makes them unique.
+
+from django.db import migrations
+
+
+def normalize_metabolite_name(name):
+    # as in taskApi.models at the time of this migration
+    return " ".join(str(name).split()).casefold()
+
+
+def merge_metabolites(apps, schema_editor):
+    Metabolite = apps.get_model("taskApi", "Metabolite")
+    DatasetMetabolite = apps.get_model("taskApi", "DatasetMetabolite")
+    # first metabolite of every normalized name, and the duplicates to merge into it
+    kept = {}
+    duplicates = {}
+    for metabolite in Metabolite.objects.order_by("id").iterator(chunk_size=2000):
+        normalized = normalize_metabolite_name(metabolite.name or "")[:255]
+        if normalized in kept:
+            duplicates[metabolite.id] = kept[normalized]
+            continue
+        kept[normalized] = metabolite.id
+        if metabolite.normalized_name != normalized:
+            metabolite.normalized_name = normalized
+            metabolite.save(update_fields=["normalized_name"])
+    duplicate_ids = list(duplicates)
+    for i in range(0, len(duplicate_ids), 500):
+        batch = duplicate_ids[i:i + 500]
+        for metabolite_id in batch:
+            DatasetMetabolite.objects.filter(metabolite_id=metabolite_id).update(
+                metabolite_id=duplicates[metabolite_id])
+        Metabolite.objects.filter(id__in=batch).delete()
+    # the same metabolite twice in a dataset, once merged
+    seen = set()
+    repeated = []
+    for pair in DatasetMetabolite.objects.order_by("id").values_list(
+            "id", "dataset_id", "metabolite_id").iterator(chunk_size=10000):
+        if pair[1:] in seen:
+            repeated.append(pair[0])
+        else:
+            seen.add(pair[1:])
+    for i in range(0, len(repeated), 500):
+        DatasetMetabolite.objects.filter(id__in=repeated[i:i + 500]).delete()
+
+
+def merge_repositories(apps, schema_editor):
+    DatasetRepository = apps.get_model("taskApi", "DatasetRepository")
+    DatasetRepositoryFile = apps.get_model("taskApi", "DatasetRepositoryFile")
+    Dataset = apps.get_model("taskApi", "Dataset")
+    kept = {}
+    for repository in DatasetRepository.objects.exclude(accession_template=None).order_by("id"):
+        if repository.accession_template not in kept:
+            kept[repository.accession_template] = repository.id
+            continue
+        Dataset.objects.filter(repository_id=repository.id).update(
+            repository_id=kept[repository.accession_template])
+        DatasetRepositoryFile.objects.filter(repository_id=repository.id).update(
+            repository_id=kept[repository.accession_template])
+        repository.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taskApi', '0003_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_metabolites, migrations.RunPython.noop),
+        migrations.RunPython(merge_repositories, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.20 on 2026-10-19 15:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taskApi', '0004_merge_duplicates'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='datasetrepository',
+            name='accession_template',
+            field=models.CharField(blank=True, max_length=10, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='metabolite',
+            name='normalized_name',
+            field=models.CharField(editable=False, max_length=255, unique=True),
+        ),
+        migrations.AddConstraint(
+            model_name='datasetmetabolite',
+            constraint=models.UniqueConstraint(fields=('dataset', 'metabolite'), name='unique_dataset_metabolite'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.20 on 2026-10-19 15:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taskApi', '0005_unique_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatasetSignature',
+            fields=[
+                ('dataset', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='taskApi.dataset')),
+                ('signature', models.BinaryField()),
+                ('metabolites', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DatasetSignatureBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.BigIntegerField()),
+                ('dataset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='taskApi.dataset')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['bucket'], name='signature_bucket')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='datasetsignaturebucket',
+            constraint=models.UniqueConstraint(fields=('dataset', 'bucket'), name='unique_dataset_signature_bucket'),
+        ),
+    ]
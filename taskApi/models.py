@@ -2,6 +2,8 @@
 This module contains the models for the taskApi app. 
 """
 
+from functools import lru_cache
+
 from django.contrib.auth import get_user_model
 from django.db import models
 
@@ -17,23 +19,37 @@ User = get_user_model()
 
 
 def dataset_files_folder(instance, filename):
-    accession_prefix = str(instance.dataset.repository.accession_prefix())
-    accession = str(instance.dataset.pk)
+    from taskApi.registry import get_repository_info
+
+    accession = str(instance.dataset_id)
+    # prefix from the registry, not to query the dataset and its repository
+    repository_info = get_repository_info(accession)
+    if repository_info is not None:
+        accession_prefix = get_accession_prefix(repository_info["accession_template"])
+    else:
+        accession_prefix = instance.dataset.repository.accession_prefix()
     return '/'.join(['datasets', accession_prefix, accession, filename])
 
 
+@lru_cache(maxsize=None)
+def get_accession_prefix(accession_template):
+    return f'{accession_template.replace("x", "")}'
+
+
 class DatasetRepository(models.Model):
     """
     DatasetRepository
     Store dataset repository information
     """
     name = models.CharField(max_length=100, blank=True, null=True)
-    accession_template = models.CharField(max_length=10, blank=True, null=True)
+    # unique, datasets and adapters look up their repository by prefix
+    accession_template = models.CharField(
+        max_length=10, blank=True, null=True, unique=True)
     repository_website = models.CharField(
         max_length=250, blank=True, null=True)
 
     def accession_prefix(self):
-        return f'{self.accession_template.replace("x", "")}'
+        return get_accession_prefix(self.accession_template)
 
     def __str__(self):
         return f'{self.name}'
@@ -56,6 +72,12 @@ class DatasetRepositoryFile(models.Model):
         return f'{self.repository} - {self.filename}'
 
 
+class DatasetQuerySet(models.QuerySet):
+
+    def with_repository(self):
+        return self.select_related("repository")
+
+
 class Dataset(models.Model):
     """
     Dataset
@@ -64,12 +86,25 @@ class Dataset(models.Model):
     repository = models.ForeignKey(DatasetRepository, on_delete=models.CASCADE)
     accession = models.CharField(max_length=50, blank=False,
                                  default='', primary_key=True)
-    title = models.CharField(max_length=100, blank=True, null=True)
+    title = models.CharField(max_length=255, blank=True, null=True, db_index=True)
     description = models.TextField(blank=True, null=True)
+    # False once the dataset is no longer listed by its repository
+    available = models.BooleanField(default=True)
+    last_synced = models.DateTimeField(blank=True, null=True)
+    metabolites = models.ManyToManyField(
+        "Metabolite", through="DatasetMetabolite", related_name="datasets", blank=True)
+
+    objects = DatasetQuerySet.as_manager()
 
     def __str__(self):
         return f'{self.title}'
 
+    class Meta:
+        indexes = [
+            # available datasets of a repository (catalog sync, warm_cache)
+            models.Index(fields=["repository", "available"], name="dataset_repository_available"),
+        ]
+
 
 class DatasetFile(models.Model):
     """
@@ -85,7 +120,37 @@ class DatasetFile(models.Model):
         return f'{self.dataset.accession}'
 
     def __str__(self):
-        return f'{self.dataset} - {self.file}'
+        # dataset_id, not to query the dataset for every file
+        return f'{self.dataset_id} - {self.file}'
+
+
+def normalize_metabolite_name(name):
+    """
+    Case and whitespace insensitive form of a metabolite name
+    """
+    return " ".join(str(name).split()).casefold()
+
+
+class MetaboliteManager(models.Manager):
+
+    def get_or_create_names(self, names, batch_size=500):
+        """
+        Get the metabolites of many names at once, creating the missing ones,
+        as normalized name: metabolite id
+        """
+        # first spelling of every name
+        names = {normalize_metabolite_name(name)[:255]: name.strip()[:255]
+                 for name in reversed(list(names)) if name}
+        self.bulk_create(
+            [Metabolite(name=name, normalized_name=normalized)
+             for normalized, name in names.items()],
+            batch_size=batch_size, ignore_conflicts=True)
+        normalized_names = list(names)
+        ids = {}
+        for i in range(0, len(normalized_names), batch_size):
+            ids.update(self.filter(normalized_name__in=normalized_names[i:i + batch_size])
+                       .values_list("normalized_name", "id"))
+        return ids
 
 
 class Metabolite(models.Model):
@@ -93,7 +158,14 @@ class Metabolite(models.Model):
     Metabolite
     Store metabolite names
     """
-    name = models.CharField(max_length=100, blank=True, null=True)
+    name = models.CharField(max_length=255, blank=True, null=True)
+    normalized_name = models.CharField(max_length=255, unique=True, editable=False)
+
+    objects = MetaboliteManager()
+
+    def save(self, *args, **kwargs):
+        self.normalized_name = normalize_metabolite_name(self.name or "")[:255]
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f'{self.name}'
@@ -108,4 +180,46 @@ class DatasetMetabolite(models.Model):
     metabolite = models.ForeignKey(Metabolite, on_delete=models.CASCADE)
 
     def __str__(self):
-        return f'{self.dataset} - {self.metabolite}'
+        return f'{self.dataset_id} - {self.metabolite_id}'
+
+    class Meta:
+        constraints = [
+            # also the index of the dataset lookups, the metabolite ones use the FK index
+            models.UniqueConstraint(fields=["dataset", "metabolite"],
+                                    name="unique_dataset_metabolite"),
+        ]
+
+
+class DatasetSignature(models.Model):
+    """
+    DatasetSignature
+    MinHash signature of the metabolites of a dataset, to search similar datasets
+    """
+    dataset = models.OneToOneField(Dataset, on_delete=models.CASCADE, primary_key=True)
+    signature = models.BinaryField()
+    metabolites = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.dataset_id}'
+
+
+class DatasetSignatureBucket(models.Model):
+    """
+    DatasetSignatureBucket
+    LSH bucket of each band of a dataset signature, datasets sharing
+    a bucket being candidates to be similar
+    """
+    dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE)
+    bucket = models.BigIntegerField()
+
+    def __str__(self):
+        return f'{self.dataset_id} - {self.bucket}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["dataset", "bucket"],
+                                    name="unique_dataset_signature_bucket"),
+        ]
+        indexes = [
+            models.Index(fields=["bucket"], name="signature_bucket"),
+        ]
@@ -0,0 +1,168 @@
+"""
+This file contains the dataset parsing backends for the taskApi app.
+Datasets are parsed in the calling thread ("inline") or, to keep the pandas
+CPU work off the request threads, in a pool of worker processes ("process")
+with a bounded number of pending tasks and a timeout per task.
+"""
+import atexit
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from taskApi.log import configure_worker_logging, start_worker_logging
+from taskApi.metrics import recording, replay
+from taskPrj import settings
+
+logger = logging.getLogger(__name__)
+
+# separator of the packed lists, never found in file names or metabolite names
+SEPARATOR = "\x00"
+
+
+class ParseUnavailable(Exception):
+    """
+    The dataset can not be parsed right now
+    """
+
+    def __init__(self, accession, retry_after):
+        self.accession = accession
+        self.retry_after = retry_after
+        super().__init__(f"Parsing unavailable: {accession}, retry after {retry_after:.0f}s")
+
+
+class ParseQueueFull(ParseUnavailable):
+    pass
+
+
+class ParseTimeout(ParseUnavailable):
+    pass
+
+
+def init_worker(log_queue, log_level):
+    """
+    Load Django in the worker processes, the parsing functions need the app models.
+    Their records are logged by the parent process.
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "taskPrj.settings")
+    import django
+    from django.conf import settings as django_settings
+
+    django_settings.LOGGING_CONFIG = None
+    configure_worker_logging(log_queue, log_level)
+    django.setup()
+
+
+def pack(dataset):
+    """
+    Join the lists of strings, a single string is much cheaper to send
+    between processes than thousands of small ones. Other lists are sent unchanged.
+    """
+    return {key: (len(value), SEPARATOR.join(value))
+            if isinstance(value, list) and all(isinstance(item, str) for item in value) else value
+            for key, value in dataset.items()}
+
+
+def unpack(dataset):
+    return {key: (value[1].split(SEPARATOR) if value[0] else []) if isinstance(value, tuple) else value
+            for key, value in dataset.items()}
+
+
+def run_packed(function, prefix, accession, components):
+    """
+    Parse a dataset in a worker process, returning it packed with the
+    durations timed meanwhile, replayed in the parent process metrics
+    """
+    with recording() as observations:
+        dataset = function(prefix, accession, components)
+    return pack(dataset), observations
+
+
+class ProcessParser:
+    """
+    Pool of parsing processes, with at most `queue_size` tasks pending or running
+    """
+
+    def __init__(self, workers, queue_size, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.executor = None
+        self.log_queue = self.log_listener = None
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                # spawn, forking a process with running threads is unsafe
+                mp_context = multiprocessing.get_context("spawn")
+                if self.log_queue is None:
+                    self.log_queue, self.log_listener = start_worker_logging(mp_context)
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers, initializer=init_worker,
+                    initargs=(self.log_queue, settings.LOG_LEVEL), mp_context=mp_context)
+            return self.executor
+
+    def reset(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def parse(self, function, prefix, accession, components):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise ParseQueueFull(accession, self.timeout)
+        try:
+            future = self.get_executor().submit(run_packed, function, prefix, accession, components)
+        except Exception:
+            self.slots.release()
+            raise
+        # the slot is only freed once the task finishes, so tasks
+        # timed out but still running keep counting against the queue
+        future.add_done_callback(lambda future: self.slots.release())
+        try:
+            dataset, observations = future.result(timeout=self.timeout)
+            replay(observations)
+            return unpack(dataset)
+        except FutureTimeoutError:
+            future.cancel()
+            logger.debug("Parse timeout for Dataset %s", accession)
+            raise ParseTimeout(accession, self.timeout)
+        except BrokenProcessPool as exc:
+            # a worker died (i.e. out of memory), start a new pool for the next tasks
+            logger.exception(exc)
+            self.reset()
+            raise
+
+    def close(self):
+        self.reset()
+        if self.log_listener is not None:
+            self.log_listener.stop()
+            self.log_listener = None
+
+
+_process_parser = None
+_process_parser_lock = threading.Lock()
+
+
+def get_process_parser():
+    global _process_parser
+    with _process_parser_lock:
+        if _process_parser is None:
+            _process_parser = ProcessParser(
+                settings.PARSE_WORKERS, settings.PARSE_QUEUE_SIZE, settings.PARSE_TIMEOUT)
+            atexit.register(_process_parser.close)
+        return _process_parser
+
+
+def parse(function, prefix, accession, components):
+    """
+    Parse the given components of a dataset with one of the
+    utils.parse_dataset_data_* functions, using the configured backend
+    """
+    if settings.PARSE_BACKEND == "process":
+        return get_process_parser().parse(function, prefix, accession, components)
+    return function(prefix, accession, components)
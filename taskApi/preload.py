@@ -0,0 +1,29 @@
+"""
+This file contains the preloading of the taskApi app, to be run once in the
+master process of a pre-forking server (i.e. gunicorn --preload) so that
+workers start with the heavy modules imported and the repositories registry
+loaded, sharing their memory pages.
+"""
+import logging
+
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+def preload():
+    import pandas
+    import requests
+
+    from taskApi import registry, repositories, throttling
+
+    throttling.get_upstream_errors()
+    try:
+        registry.get_registry()
+    except Exception as exc:
+        # i.e. database not migrated yet, loaded later by the workers
+        logger.exception(exc)
+        registry.invalidate()
+    # database connections must not be shared with the forked workers
+    connections.close_all()
+    logger.debug("Preloaded taskApi modules and the repositories registry")
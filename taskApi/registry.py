@@ -0,0 +1,88 @@
+"""
+This file contains the in-memory registry of the dataset repositories for the taskApi app.
+Names, accession templates and expected files of every DatasetRepository are
+loaded from the database once, and reloaded after any of them is saved (or
+every REPOSITORY_REGISTRY_TTL seconds, for changes saved by other processes).
+"""
+import re
+import threading
+import time
+
+from taskApi.models import DatasetRepository, DatasetRepositoryFile
+from taskPrj import settings
+
+_registry = None
+_loaded_at = 0
+_lock = threading.Lock()
+
+
+def load():
+    """
+    Repositories by accession prefix, and the precompiled accession matcher
+    """
+    repositories = {}
+    for repository in DatasetRepository.objects.exclude(accession_template=None):
+        repositories[repository.accession_prefix()] = {
+            "id": repository.id,
+            "name": repository.name,
+            "accession_template": repository.accession_template,
+            "repository_website": repository.repository_website,
+            "files": [],
+        }
+    ids = {info["id"]: info for info in repositories.values()}
+    for repository_id, filename in DatasetRepositoryFile.objects.values_list(
+            "repository_id", "filename"):
+        if repository_id in ids and filename:
+            ids[repository_id]["files"].append(filename)
+    # longest prefixes first, so a shorter prefix never shadows a longer one
+    prefixes = sorted((prefix for prefix in repositories if prefix), key=len, reverse=True)
+    matcher = re.compile(
+        rf"^({'|'.join(re.escape(prefix) for prefix in prefixes)})\w+") if prefixes else None
+    return repositories, matcher
+
+
+def get_registry():
+    global _registry, _loaded_at
+    registry = _registry
+    if registry is None or time.monotonic() - _loaded_at > settings.REPOSITORY_REGISTRY_TTL:
+        with _lock:
+            if _registry is registry:
+                _registry = load()
+                _loaded_at = time.monotonic()
+            registry = _registry
+    return registry
+
+
+def invalidate(**kwargs):
+    """
+    Drop the registry, to be reloaded on next use. Connected to the model signals.
+    """
+    global _registry
+    with _lock:
+        _registry = None
+
+
+def get_repository_info(accession):
+    """
+    Repository of an accession code, as a dict, None if unknown
+    """
+    repositories, matcher = get_registry()
+    match = matcher.match(accession) if matcher and accession else None
+    return repositories[match.group(1)] if match else None
+
+
+def get_repository_info_by_prefix(prefix):
+    return get_registry()[0].get(prefix)
+
+
+def get_repository_id(prefix, name):
+    """
+    Id of the DatasetRepository of an accession prefix, created if missing
+    (which drops the registry, see signals.py)
+    """
+    repository_info = get_repository_info_by_prefix(prefix)
+    if repository_info is not None:
+        return repository_info["id"]
+    repository, created = DatasetRepository.objects.get_or_create(
+        accession_template=f"{prefix}xxx", defaults={"name": name})
+    return repository.id
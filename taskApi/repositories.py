@@ -0,0 +1,454 @@
+"""
+This file contains the dataset repository adapters for the taskApi app.
+Each repository (MetaboLights, Metabolomics-Workbench, MetaboBank) is
+registered once at startup and resolved from the accession code.
+"""
+import contextvars
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from taskApi import cache, deadlines, parsing, storage, utils
+from taskApi.metrics import (DATASET_FETCH_SECONDS, DATASET_FETCHES_IN_FLIGHT,
+                             DATASET_SHARED_TRANSFERS)
+from taskPrj import settings
+
+logger = logging.getLogger(__name__)
+
+
+class RepositoryAdapter:
+    """
+    Base class for dataset repositories
+    """
+    name = None
+    prefix = None
+    host = None
+    # max. number of datasets fetched at the same time from the repository
+    max_concurrent_fetches = 4
+    # seconds a local copy of a dataset is considered fresh, None means forever
+    cache_ttl = None
+    # components (see utils.DATASET_COMPONENTS) also downloaded by the files of each one
+    shared_components = {}
+
+    def __init__(self):
+        self.fetch_slots = threading.BoundedSemaphore(
+            self.max_concurrent_fetches)
+        # background downloads, queued once the repository is busy
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrent_fetches,
+                                           thread_name_prefix=f"fetch-{self.prefix}")
+        # downloads queued or running in the background, as (accession, components): future
+        self.fetching = {}
+        self.fetching_lock = threading.Lock()
+
+    def __str__(self):
+        return f'{self.name}'
+
+    def fetch(self, accession, components=("files",)):
+        """
+        Download the files of some components of a dataset (all its files by
+        default) into the local cache. Files are downloaded into a staging
+        dir first, so a local copy being served is only replaced once all
+        the new files were downloaded.
+        A newer copy in the shared storage, if any, is used instead of the repository.
+        Gives up after DATASET_FETCH_TIMEOUT seconds.
+        """
+        with deadlines.deadline(settings.DATASET_FETCH_TIMEOUT):
+            return self.fetch_components(accession, self.get_fetched_components(components))
+
+    def fetch_components(self, accession, components):
+        # the files of the other components are kept
+        replaces = None if "files" in components else \
+            lambda relative_path: self.get_component(accession, relative_path) in components
+        marked = ("files",) if "files" in components else components
+        parent_dir = os.path.dirname(utils.get_dataset_dir(self.prefix, accession))
+        os.makedirs(parent_dir, exist_ok=True)
+        # the next version of the dataset
+        staging_dir = tempfile.mkdtemp(prefix=f".{accession}.", dir=parent_dir)
+        result = fetched_at = None
+        committed = False
+        try:
+            if storage.is_enabled():
+                fetched_at = self.fetch_shared(accession, staging_dir, marked)
+            if fetched_at is None:
+                if not self.fetch_slots.acquire(timeout=deadlines.get_timeout(0)):
+                    raise deadlines.DeadlineExceeded()
+                try:
+                    with DATASET_FETCHES_IN_FLIGHT.track_in_progress(repository=self.name), \
+                            DATASET_FETCH_SECONDS.time("fetch", repository=self.name):
+                        result = self.fetch_files(accession, staging_dir, components)
+                finally:
+                    self.fetch_slots.release()
+            # all files were downloaded without errors
+            utils.commit_dataset(staging_dir, self.prefix, accession, marked, fetched_at, replaces)
+            committed = True
+        finally:
+            # unless it is now the current version
+            if not committed:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+        if fetched_at is None and storage.is_enabled():
+            self.upload_shared(accession, marked)
+        cache.record_fetch(self.prefix, accession)
+        return result
+
+    def get_fetched_components(self, components):
+        """
+        Components downloaded fetching the given ones
+        """
+        fetched = set(utils.get_components(components))
+        for component in list(fetched):
+            fetched.update(self.shared_components.get(component, ()))
+        return utils.get_components(fetched)
+
+    def get_component(self, accession, relative_path):
+        """
+        Component of a local file of a dataset
+        """
+        return "files"
+
+    def get_component_selector(self, accession, component):
+        """
+        Function telling if a local file belongs to a component of a dataset
+        (or to one fetched along with it), None for all the files
+        """
+        if component == "files":
+            return None
+        components = self.get_fetched_components((component, ))
+        return lambda relative_path: self.get_component(accession, relative_path) in components
+
+    def fetch_shared(self, accession, staging_dir, components=("files",)):
+        """
+        Copy some components of a dataset from the shared storage, if all of them
+        are newer than the local copy and not expired, each from its own index or
+        the one of all the files, whichever is newer. Returns their download
+        time, as component: time, None if not copied.
+        """
+        try:
+            local_fetched_at = self.get_fetched_at(accession, components)
+            indexes = {}
+            for component in components:
+                candidates = [storage.get_index(self.prefix, accession, candidate)
+                              for candidate in {component, "files"}]
+                candidates = [index for index in candidates
+                              if storage.is_usable(index, local_fetched_at, self.cache_ttl)]
+                if not candidates:
+                    return None
+                indexes[component] = max(candidates, key=lambda index: index["fetched_at"])
+            logger.debug("Get Dataset %s %s from the shared storage", accession, components)
+            for component, index in indexes.items():
+                storage.download(index, staging_dir, self.get_component_selector(accession, component))
+            DATASET_SHARED_TRANSFERS.inc(repository=self.name, direction="download")
+            return {component: index["fetched_at"] for component, index in indexes.items()}
+        except Exception as exc:
+            # download it from the repository instead
+            logger.exception(exc)
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            os.makedirs(staging_dir, exist_ok=True)
+            return None
+
+    def upload_shared(self, accession, components=("files",)):
+        """
+        Copy some components of a dataset just downloaded from the repository
+        to the shared storage
+        """
+        local_base_dir = os.path.realpath(utils.get_dataset_dir(self.prefix, accession))
+        for component in components:
+            try:
+                storage.upload(self.prefix, accession, local_base_dir,
+                               os.path.getmtime(os.path.join(local_base_dir,
+                                                             utils.get_marker_name(component))),
+                               component, self.get_component_selector(accession, component))
+                DATASET_SHARED_TRANSFERS.inc(repository=self.name, direction="upload")
+            except Exception as exc:
+                # the local copy is still served, other nodes will download it again
+                logger.exception(exc)
+
+    def fetch_files(self, accession, local_base_dir=None, components=("files",)):
+        raise NotImplementedError
+
+    def fetch_async(self, accession, components=("files",)):
+        """
+        Download some components of a dataset in the background, returning
+        a future of the download. Calls for the same components while it is
+        queued or running get the same future.
+        """
+        key = (accession, self.get_fetched_components(components))
+        with self.fetching_lock:
+            future = self.fetching.get(key)
+            if future is not None:
+                return future
+            # in a copy of the current context, so the request gets the fetch timings
+            future = self.fetching[key] = self.executor.submit(
+                contextvars.copy_context().run, self.run_fetch, *key)
+        # outside of the lock, the callback runs right away if the future is done
+        future.add_done_callback(lambda done: self.forget_fetch(key, done))
+        return future
+
+    def run_fetch(self, accession, components):
+        try:
+            # not bound by the deadline of the request, see DATASET_FETCH_TIMEOUT
+            with deadlines.detached():
+                return self.fetch(accession, components)
+        except Exception as exc:
+            # logged here, the requests waiting for it may be gone
+            logger.exception(exc)
+            raise (exc)
+
+    def forget_fetch(self, key, future):
+        with self.fetching_lock:
+            if self.fetching.get(key) is future:
+                del self.fetching[key]
+
+    def revalidate(self, accession, components=("files",)):
+        """
+        Refresh some components of a dataset in the background, serving the
+        stale local copy meanwhile
+        """
+        logger.debug("Revalidate Dataset %s %s", accession, components)
+        return self.fetch_async(accession, components)
+
+    def parse(self, accession, components=("files",)):
+        """
+        Parse some components of the local copy of a dataset (all of them by default) into a dict
+        """
+        raise NotImplementedError
+
+    def read_abundances(self, accession):
+        """
+        Metabolite names, sample names and abundances (metabolites by samples)
+        of the local copy of a dataset
+        """
+        raise NotImplementedError
+
+    def list_files(self, accession):
+        """
+        List the files of a dataset available in the local cache
+        """
+        local_base_dir = utils.get_dataset_dir(self.prefix, accession)
+        if not os.path.isdir(local_base_dir):
+            return []
+        return sorted(filename for filename in os.listdir(local_base_dir)
+                      if not utils.is_dataset_marker(filename))
+
+    def catalog(self):
+        """
+        List all the studies available in the repository, as accession: title
+        """
+        raise NotImplementedError
+
+    def download_filename(self, accession, filetype="metadata"):
+        """
+        Name of the local file to download for a type of data
+        """
+        raise NotImplementedError
+
+    def download_component(self, filetype="metadata"):
+        """
+        Component of a dataset with the local file to download for a type of data
+        """
+        return filetype
+
+    def is_complete(self, accession, component="files"):
+        return utils.is_dataset_complete(self.prefix, accession, component)
+
+    def record_access(self, accession):
+        cache.record_access(self.prefix, accession)
+
+    def get_fetched_at(self, accession, components=("files",)):
+        """
+        Download time of the oldest of some components of a dataset, None if any is missing
+        """
+        fetched_at = [utils.get_dataset_fetched_at(self.prefix, accession, component)
+                      for component in components]
+        return None if None in fetched_at else min(fetched_at)
+
+    def is_fresh(self, accession, components=("files",)):
+        """
+        Check if some components of the local copy of a dataset are complete and not expired
+        """
+        return self.get_staleness(accession, components) == 0
+
+    def get_staleness(self, accession, components=("files",)):
+        """
+        Seconds since some components of the local copy of a dataset expired,
+        0 if still fresh and None if there is no complete local copy of them
+        """
+        fetched_at = self.get_fetched_at(accession, components)
+        if fetched_at is None:
+            return None
+        if self.cache_ttl is None:
+            return 0
+        return max(0, time.time() - fetched_at - self.cache_ttl)
+
+    def is_usable_stale(self, accession, max_staleness, components=("files",)):
+        """
+        Check if some components of the local copy of a dataset expired at
+        most `max_staleness` seconds ago (None means no limit)
+        """
+        staleness = self.get_staleness(accession, components)
+        if staleness is None:
+            return False
+        return max_staleness is None or staleness <= max_staleness
+
+
+_repositories = {}
+_accession_matcher = None
+
+
+def register(adapter_class):
+    """
+    Register a repository adapter, to be used as class decorator
+    """
+    global _accession_matcher
+    adapter = adapter_class()
+    _repositories[adapter.prefix] = adapter
+    # longest prefixes first, so a shorter prefix never shadows a longer one
+    prefixes = sorted(_repositories, key=len, reverse=True)
+    _accession_matcher = re.compile(
+        rf"^({'|'.join(re.escape(prefix) for prefix in prefixes)})\w+")
+    return adapter_class
+
+
+def get_repositories():
+    return list(_repositories.values())
+
+
+def get_repository(accession):
+    """
+    Guess the repository from the accession code
+    """
+    match = _accession_matcher.match(accession) if accession else None
+    if match is None:
+        return None
+    return _repositories[match.group(1)]
+
+
+def get_repository_name(accession):
+    """
+    Name of the repository of an accession code, as used by the API (None if unknown)
+    """
+    repository = get_repository(accession)
+    return repository.name if repository is not None else None
+
+
+def get_repository_by_prefix(prefix):
+    return _repositories.get(prefix)
+
+
+def get_repository_by_name(name):
+    for repository in _repositories.values():
+        if repository.name == name:
+            return repository
+    return None
+
+
+def get_dataset_list(repository_name):
+    """
+    Synchronize the local catalog of datasets with a repository
+    """
+    repository = get_repository_by_name(repository_name)
+    datasets = repository.catalog()
+    return utils.sync_dataset_list(repository.prefix, repository.name, datasets)
+
+
+@register
+class MetaboLightsAdapter(RepositoryAdapter):
+    name = "MetaboLights"
+    prefix = settings.MTBLS_ACC_PREFIX
+    host = settings.MTBLS_FTP_URL
+    max_concurrent_fetches = settings.MTBLS_MAX_CONCURRENT_FETCHES
+    cache_ttl = settings.MTBLS_CACHE_TTL
+
+    def fetch_files(self, accession, local_base_dir=None, components=("files",)):
+        return utils.get_dataset_files_mtbls(self.prefix, accession, local_base_dir, components)
+
+    def get_component(self, accession, relative_path):
+        return utils.get_component_mtbls(accession, relative_path)
+
+    def parse(self, accession, components=("files",)):
+        return parsing.parse(utils.parse_dataset_data_mtbls, self.prefix, accession, components)
+
+    def read_abundances(self, accession):
+        return utils.get_abundances_maf(utils.get_maf_filename_mtbls(
+            os.path.realpath(utils.get_dataset_dir(self.prefix, accession))))
+
+    def catalog(self):
+        return utils.get_dataset_list_mtbls()
+
+    def download_filename(self, accession, filetype="metadata"):
+        if filetype == "metabolites":
+            for filename in self.list_files(accession):
+                if utils.MTBLS_MAF_FILE_PATTERN.match(filename):
+                    return filename
+            return None
+        elif filetype == "rawdata":
+            return settings.MTBLS_FNAME_RESULT_FILES
+        return settings.MTBLS_FNAME_INVESTIGATION
+
+
+@register
+class MetabolomicsWorkbenchAdapter(RepositoryAdapter):
+    name = "Metabolomics-Workbench"
+    prefix = settings.MTWB_ACC_PREFIX
+    host = urlparse(settings.MTWB_REST_BASE_URL).netloc
+    max_concurrent_fetches = settings.MTWB_MAX_CONCURRENT_FETCHES
+    cache_ttl = settings.MTWB_CACHE_TTL
+    # the .json file holds all of them
+    shared_components = {"metadata": ("metabolites", "rawdata"),
+                         "metabolites": ("metadata", "rawdata"),
+                         "rawdata": ("metadata", "metabolites")}
+
+    def fetch_files(self, accession, local_base_dir=None, components=("files",)):
+        return utils.get_dataset_files_mtwb(self.prefix, accession, local_base_dir, components)
+
+    def get_component(self, accession, relative_path):
+        return utils.get_component_mtwb(accession, relative_path)
+
+    def parse(self, accession, components=("files",)):
+        return parsing.parse(utils.parse_dataset_data_mtwb, self.prefix, accession, components)
+
+    def read_abundances(self, accession):
+        return utils.get_abundances_mtwb(os.path.join(
+            utils.get_dataset_dir(self.prefix, accession), accession + settings.MTWB_FNAME_JSON_SUFIX))
+
+    def catalog(self):
+        return utils.get_dataset_list_mtwb()
+
+    def download_filename(self, accession, filetype="metadata"):
+        return accession + settings.MTWB_FNAME_MWTAB_SUFIX
+
+    def download_component(self, filetype="metadata"):
+        return "files"
+
+
+@register
+class MetaboBankAdapter(RepositoryAdapter):
+    name = "MetaboBank"
+    prefix = settings.MTBK_ACC_PREFIX
+    host = urlparse(settings.MTBK_BASE_URL).netloc
+    max_concurrent_fetches = settings.MTBK_MAX_CONCURRENT_FETCHES
+    cache_ttl = settings.MTBK_CACHE_TTL
+
+    def fetch_files(self, accession, local_base_dir=None, components=("files",)):
+        return utils.get_dataset_files_mtbk(self.prefix, accession, local_base_dir, components)
+
+    def get_component(self, accession, relative_path):
+        return utils.get_component_mtbk(accession, relative_path)
+
+    def parse(self, accession, components=("files",)):
+        return parsing.parse(utils.parse_dataset_data_mtbk, self.prefix, accession, components)
+
+    def read_abundances(self, accession):
+        return utils.get_abundances_maf(utils.get_maf_filename_mtbk(
+            os.path.realpath(utils.get_dataset_dir(self.prefix, accession))))
+
+    def catalog(self):
+        return utils.get_dataset_list_mtbk()
+
+    def download_filename(self, accession, filetype="metadata"):
+        return accession + settings.MTBK_IDF_FILE_PREFIX + settings.MTBK_FILES_SUFIX
@@ -0,0 +1,97 @@
+"""
+This file contains the parsed sections store of the taskApi app.
+The metabolites and raw data files of a dataset are written once per version
+of the local copy into a file per section in DATASETS_SECTIONS_DIR: a header
+(version and number of items), the offset of every item, and the items as
+JSON, so reading a page costs the same whatever the size of the dataset.
+"""
+import json
+import logging
+import os
+import struct
+import tempfile
+
+from taskApi import utils
+from taskPrj import settings
+
+logger = logging.getLogger(__name__)
+
+# fetched_at of the local copy parsed, and number of items
+HEADER = struct.Struct("<dq")
+OFFSET = struct.Struct("<q")
+
+
+def get_sections_dir(prefix, accession):
+    return os.path.join(settings.DATASETS_SECTIONS_DIR, prefix, accession)
+
+
+def get_section_path(prefix, accession, section):
+    return os.path.join(get_sections_dir(prefix, accession), f"{section}.bin")
+
+
+def write(path, fetched_at, items):
+    """
+    Write the items of a section, replacing the previous version at once
+    """
+    data = [json.dumps(item).encode("utf-8") for item in items]
+    offsets = [0]
+    for item in data:
+        offsets.append(offsets[-1] + len(item))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, staging_path = tempfile.mkstemp(prefix=".", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(fetched_at, len(data)))
+            f.write(struct.pack(f"<{len(offsets)}q", *offsets))
+            f.writelines(data)
+        os.replace(staging_path, path)
+    except Exception as exc:
+        logger.exception(exc)
+        os.remove(staging_path)
+        raise (exc)
+
+
+def read(path, fetched_at, start, size):
+    """
+    Items of a section from start (at most size of them), and the number of
+    items. None if not written yet for this version of the local copy.
+    """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return None
+        version, count = HEADER.unpack(header)
+        if version != fetched_at:
+            return None
+        start = min(start, count)
+        stop = min(start + size, count)
+        f.seek(HEADER.size + start * OFFSET.size)
+        offsets = struct.unpack(f"<{stop - start + 1}q", f.read((stop - start + 1) * OFFSET.size))
+        f.seek(HEADER.size + (count + 1) * OFFSET.size + offsets[0])
+        data = f.read(offsets[-1] - offsets[0])
+    items = [json.loads(data[begin - offsets[0]:end - offsets[0]])
+             for begin, end in zip(offsets, offsets[1:])]
+    return items, count
+
+
+def get_page(repository, accession, section, start, size, parse):
+    """
+    One page of a section of the local copy of a dataset, and the number of
+    items. Written first with the dataset parsed by parse() if not yet (or
+    after it was downloaded again).
+    """
+    fetched_at = utils.get_dataset_fetched_at(
+        repository.prefix, accession, utils.DATASET_FIELDS[section])
+    path = get_section_path(repository.prefix, accession, section)
+    page = read(path, fetched_at, start, size) if fetched_at is not None else None
+    if page is None:
+        items = parse().get(section, [])
+        logger.debug("Write section %s of Dataset %s: %d items", section, accession, len(items))
+        if fetched_at is not None:
+            write(path, fetched_at, items)
+        page = items[start:start + size], len(items)
+    return page
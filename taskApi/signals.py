@@ -0,0 +1,29 @@
+"""
+This file contains the signal handlers for the taskApi app.
+"""
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from taskApi import registry
+from taskApi.models import DatasetRepository, DatasetRepositoryFile
+from taskPrj import settings
+
+
+@receiver(connection_created)
+def set_sqlite_pragmas(sender, connection, **kwargs):
+    """
+    Tune every new SQLite connection: WAL lets readers go on while
+    the catalog is written, see SQLITE_PRAGMAS in settings
+    """
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+
+
+@receiver([post_save, post_delete], sender=DatasetRepository)
+@receiver([post_save, post_delete], sender=DatasetRepositoryFile)
+def invalidate_repository_registry(sender, **kwargs):
+    registry.invalidate()
@@ -0,0 +1,128 @@
+"""
+This file contains the similar datasets search of the taskApi app.
+A MinHash signature of the metabolites of every parsed dataset is stored,
+split in SIMILARITY_BANDS bands hashed into LSH buckets: datasets sharing
+a bucket are the candidates to be similar, ranked by the Jaccard index of
+their metabolites estimated from the signatures, without comparing every
+pair of datasets.
+"""
+import hashlib
+import logging
+from functools import lru_cache
+
+from django.db import transaction
+
+from taskApi.models import (DatasetSignature, DatasetSignatureBucket,
+                            normalize_metabolite_name)
+from taskApi.repositories import get_repository_name
+from taskPrj import settings
+
+logger = logging.getLogger(__name__)
+
+# hash functions of the signatures, the same for every process
+SEED = 538
+# metabolites hashed at once, to bound the memory used by large datasets
+CHUNK_SIZE = 4096
+
+
+@lru_cache(maxsize=None)
+def get_hash_functions(permutations):
+    """
+    Multipliers (odd) and increments of the multiply-shift hash functions
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(SEED)
+    multipliers = rng.integers(1, 2 ** 63, size=permutations, dtype=np.uint64) | np.uint64(1)
+    increments = rng.integers(0, 2 ** 63, size=permutations, dtype=np.uint64)
+    return multipliers[:, None], increments[:, None]
+
+
+def hash_name(name):
+    return int.from_bytes(hashlib.blake2b(
+        normalize_metabolite_name(name).encode(), digest_size=8).digest(), "little")
+
+
+def get_signature(metabolites):
+    """
+    MinHash signature of a list of metabolite names, None if empty
+    """
+    import numpy as np
+
+    hashes = np.array(sorted({hash_name(name) for name in metabolites if name}), dtype=np.uint64)
+    if not len(hashes):
+        return None
+    multipliers, increments = get_hash_functions(settings.SIMILARITY_PERMUTATIONS)
+    signature = np.full(settings.SIMILARITY_PERMUTATIONS, np.iinfo(np.uint32).max, dtype=np.uint64)
+    for i in range(0, len(hashes), CHUNK_SIZE):
+        # wraps around 2**64, the high 32 bits being the hash value
+        values = (multipliers * hashes[None, i:i + CHUNK_SIZE] + increments) >> np.uint64(32)
+        np.minimum(signature, values.min(axis=1), out=signature)
+    return signature.astype(np.uint32)
+
+
+def get_buckets(signature):
+    """
+    LSH bucket of every band of a signature
+    """
+    bands = signature.reshape(settings.SIMILARITY_BANDS, -1)
+    return [int.from_bytes(hashlib.blake2b(
+        i.to_bytes(2, "little") + band.tobytes(), digest_size=8).digest(), "little", signed=True)
+        for i, band in enumerate(bands)]
+
+
+def update_signature(accession, metabolites):
+    """
+    Store the signature of a dataset and its buckets, returning False if unchanged
+    """
+    signature = get_signature(metabolites)
+    data = signature.tobytes() if signature is not None else None
+    current = DatasetSignature.objects.filter(dataset_id=accession).values_list(
+        "signature", flat=True).first()
+    if current is not None and bytes(current) == data:
+        return False
+    logger.debug("Update signature of Dataset %s", accession)
+    with transaction.atomic():
+        DatasetSignatureBucket.objects.filter(dataset_id=accession).delete()
+        if signature is None:
+            DatasetSignature.objects.filter(dataset_id=accession).delete()
+            return True
+        DatasetSignature.objects.update_or_create(
+            dataset_id=accession,
+            defaults={"signature": data, "metabolites": len(set(metabolites))})
+        DatasetSignatureBucket.objects.bulk_create(
+            [DatasetSignatureBucket(dataset_id=accession, bucket=bucket)
+             for bucket in get_buckets(signature)],
+            ignore_conflicts=True)
+    return True
+
+
+def find_similar(accession, metabolites, k):
+    """
+    Up to `k` datasets with the most similar metabolites, with their estimated Jaccard index
+    """
+    import numpy as np
+
+    signature = get_signature(metabolites)
+    if signature is None:
+        return []
+    candidates = set(DatasetSignatureBucket.objects.filter(bucket__in=get_buckets(signature))
+                     .exclude(dataset_id=accession).values_list("dataset_id", flat=True))
+    if not candidates:
+        return []
+    # skip signatures computed with other SIMILARITY_PERMUTATIONS
+    rows = [row for row in DatasetSignature.objects.filter(dataset_id__in=candidates).values_list(
+        "dataset_id", "signature", "metabolites", "dataset__title")
+        if len(row[1]) == signature.nbytes]
+    if not rows:
+        return []
+    signatures = np.frombuffer(b"".join(bytes(row[1]) for row in rows), dtype=np.uint32).reshape(
+        len(rows), -1)
+    similarities = (signatures == signature).mean(axis=1)
+    order = np.argsort(-similarities, kind="stable")[:k]
+    return [{"accession": rows[i][0],
+             "title": rows[i][3],
+             "repository": get_repository_name(rows[i][0]),
+             "metabolites": rows[i][2],
+             "similarity": round(float(similarities[i]), 4)}
+            for i in order.tolist()]
@@ -0,0 +1,122 @@
+"""
+This file contains the shared datasets storage for the taskApi app.
+With DATASETS_SHARED_STORAGE set (any Django storage backend, i.e. S3 with
+django-storages), the datasets downloaded by a node are uploaded to it, and
+the other nodes copy them into their local cache (DATASETS_DIR, kept under
+DATASETS_CACHE_QUOTA) instead of downloading them from the repository again.
+Every upload is a new version of the dataset files, listed by an index
+written last, so nodes never copy a dataset partially uploaded or mixing
+files of two versions. Each component of a dataset has its own index
+(index.json holding all the files), so the parts fetched alone are shared too.
+"""
+import json
+import logging
+import os
+import shutil
+import time
+
+from django.core.files import File
+from django.core.files.base import ContentFile
+
+from taskApi import deadlines
+from taskPrj import settings
+
+logger = logging.getLogger(__name__)
+
+STORAGE_ALIAS = "datasets"
+
+
+def is_enabled():
+    return bool(settings.DATASETS_SHARED_STORAGE)
+
+
+def get_storage():
+    from django.core.files.storage import storages
+    return storages[STORAGE_ALIAS]
+
+
+def get_index_name(prefix, accession, component="files"):
+    """
+    Index of the shared copy of a component of a dataset, index.json for all its files
+    """
+    if component == "files":
+        return f"{prefix}/{accession}/index.json"
+    return f"{prefix}/{accession}/index.{component}.json"
+
+
+def get_index(prefix, accession, component="files"):
+    """
+    Version, fetch time and files (as relative path: storage name) of the
+    shared copy of a component of a dataset, None if not available
+    """
+    storage = get_storage()
+    name = get_index_name(prefix, accession, component)
+    if not storage.exists(name):
+        return None
+    with storage.open(name, "rb") as f:
+        return json.load(f)
+
+
+def save(storage, name, content):
+    # overwrite, some backends (FileSystemStorage) rename the new file otherwise
+    if storage.exists(name):
+        storage.delete(name)
+    return storage.save(name, content)
+
+
+def upload(prefix, accession, local_base_dir, fetched_at, component="files", selects=None):
+    """
+    Copy the files of a component of a dataset (the ones for which `selects(relative_path)`
+    is true, all of them by default) to the shared storage, as a new version
+    """
+    storage = get_storage()
+    version = f"{fetched_at * 1000:.0f}.{component}"
+    logger.debug("Upload Dataset %s version %s to the shared storage", accession, version)
+    files = {}
+    for root, dirs, filenames in os.walk(local_base_dir):
+        for filename in filenames:
+            relative_path = os.path.relpath(os.path.join(root, filename), local_base_dir)
+            if relative_path.startswith(settings.DATASET_COMPLETE_MARKER):
+                continue
+            if selects is not None and not selects(relative_path):
+                continue
+            with open(os.path.join(root, filename), "rb") as f:
+                files[relative_path] = save(
+                    storage, f"{prefix}/{accession}/{version}/{relative_path}", File(f))
+    previous = get_index(prefix, accession, component)
+    save(storage, get_index_name(prefix, accession, component), ContentFile(json.dumps(
+        {"version": version, "fetched_at": fetched_at, "files": files}).encode()))
+    # remove the previous version, nodes still copying it fall back to the repository
+    if previous and previous["version"] != version:
+        for name in previous["files"].values():
+            try:
+                storage.delete(name)
+            except Exception as exc:
+                logger.exception(exc)
+
+
+def download(index, local_base_dir, selects=None):
+    """
+    Copy the files of a version of a dataset from the shared storage, only
+    the ones for which `selects(relative_path)` is true if given
+    """
+    storage = get_storage()
+    for relative_path, name in index["files"].items():
+        if selects is not None and not selects(relative_path):
+            continue
+        deadlines.check()
+        local_path = os.path.join(local_base_dir, relative_path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with storage.open(name, "rb") as source, open(local_path, "wb") as target:
+            shutil.copyfileobj(source, target)
+
+
+def is_usable(index, local_fetched_at, cache_ttl):
+    """
+    Check if the shared copy of a dataset is newer than the local one and not expired
+    """
+    if index is None:
+        return False
+    if local_fetched_at is not None and index["fetched_at"] <= local_fetched_at:
+        return False
+    return cache_ttl is None or time.time() - index["fetched_at"] <= cache_ttl
@@ -1,3 +1,1221 @@
+import ftplib
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import posixpath
+import queue
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, connection, transaction
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from benchmarks import fixtures, servers
+from taskApi import (abundances, blobs, cache, deadlines, ftp, listing, matrix, parsing, registry,
+                     similarity, throttling, utils)
+from taskApi.deadlines import DeadlineExceeded
+from taskApi.models import (Dataset, DatasetMetabolite, DatasetRepository, DatasetRepositoryFile,
+                            Metabolite)
+from taskApi import admin, log, repositories, sections, storage
+from taskApi.repositories import get_repository
+from taskApi.throttling import CircuitOpenError, SharedState
+from taskPrj import settings
+
+
+class StandInTestCase(TestCase):
+    """
+    Runs against local stand-ins of the repositories (see benchmarks), with the
+    datasets cache and the upstreams state in a temporary dir
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.remote_dir = tempfile.mkdtemp()
+        fixtures.make_repository_tree(cls.remote_dir, studies=2, maf_files=1, rows=20,
+                                      samples=3, raw_files=5)
+        cls.conditions = servers.NetworkConditions()
+        cls.http_server = servers.start(servers.StandInHTTPServer(cls.remote_dir, cls.conditions))
+        cls.ftp_server = servers.start(servers.StandInFTPServer(cls.remote_dir, cls.conditions))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.http_server.shutdown()
+        cls.ftp_server.shutdown()
+        shutil.rmtree(cls.remote_dir, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, ignore_errors=True)
+        datasets_dir = os.path.join(work_dir, "datasets")
+        self.patch(mock.patch.multiple(
+            settings,
+            DATASETS_DIR=datasets_dir,
+            DATASETS_CACHE_INDEX=os.path.join(datasets_dir, ".cache_index.json"),
+            DATASETS_BLOBS_DIR=os.path.join(datasets_dir, ".blobs"),
+            DATASETS_COLUMNAR_DIR=os.path.join(datasets_dir, ".columnar"),
+            DATASETS_SECTIONS_DIR=os.path.join(datasets_dir, ".sections"),
+            METABOLITE_MATRIX_DIR=os.path.join(datasets_dir, ".matrix"),
+            UPSTREAM_STATE_DIR=os.path.join(work_dir, "upstreams"),
+            UPSTREAM_RATE_LIMIT=0,
+            MTBLS_FTP_URL="127.0.0.1",
+            MTBLS_FTP_PORT=self.ftp_server.server_address[1],
+            MTBLS_REMOTE_URL=f"{self.http_server.url}/{fixtures.MTBLS_DIR}/",
+            MTWB_REST_BASE_URL=self.http_server.url,
+            MTBK_BASE_URL=f"{self.http_server.url}/public/metabobank"))
+        self.patch(mock.patch.object(cache, "_index", SharedState(settings.DATASETS_CACHE_INDEX)))
+        self.patch(mock.patch.object(ftp, "_mtbls_pool", None))
+        self.patch(mock.patch.dict(throttling._upstreams, clear=True))
+        self.patch(mock.patch.dict(listing._listings, clear=True))
+        # the repositories of the previous tests were rolled back
+        registry.invalidate()
+        self.addCleanup(registry.invalidate)
+        # the metabolites are stored by a background thread, not in the test transaction
+        self.record = self.patch(mock.patch("taskApi.matrix.record"))
+
+    def patch(self, patcher):
+        patched = patcher.start()
+        self.addCleanup(patcher.stop)
+        return patched
+
+    def get_unreachable_url(self):
+        """
+        MetaboBank URL of a port nothing listens to
+        """
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            return f"http://127.0.0.1:{s.getsockname()[1]}/public/metabobank"
+
+    def remove_remote_file(self, *path):
+        """
+        Remove a file of the stand-in repositories, restored after the test
+        """
+        path = os.path.join(self.remote_dir, *path)
+        backup_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, backup_dir, ignore_errors=True)
+        backup = os.path.join(backup_dir, os.path.basename(path))
+        shutil.move(path, backup)
+        self.addCleanup(shutil.move, backup, path)
+
+
+class LogTests(TestCase):
+
+    def setUp(self):
+        logs_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, logs_dir, ignore_errors=True)
+        self.filename = os.path.join(logs_dir, "test.log")
+        self.handler = log.QueueRotatingFileHandler(self.filename, queueSize=10)
+        self.addCleanup(self.handler.close)
+        self.logger = logging.getLogger("taskApi.tests.log")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def read_lines(self):
+        self.handler.close()
+        with open(self.filename) as f:
+            return f.read().splitlines()
+
+    def test_arguments_merged_when_logged(self):
+        self.handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        names = ["Glucose"]
+        self.logger.debug("Got %d metabolites: %s", len(names), names)
+        names.append("Alanine")
+        self.logger.info("Done")
+        self.assertEqual(self.read_lines(), ["DEBUG Got 1 metabolites: ['Glucose']", "INFO Done"])
+
+    def test_dropped_if_queue_full(self):
+        full_queue = queue.Queue(maxsize=1)
+        full_queue.put_nowait(None)
+        with mock.patch.object(self.handler, "queue", full_queue):
+            for i in range(3):
+                self.logger.debug("Record %d", i)
+        self.assertEqual(self.handler.dropped, 3)
+        self.logger.debug("Record %d", 3)
+        self.assertEqual(self.read_lines(), ["Record 3"])
+
+    def test_json_format(self):
+        self.handler.setFormatter(log.JsonFormatter())
+        try:
+            raise ValueError("Invalid")
+        except ValueError as exc:
+            self.logger.exception(exc)
+        entry = json.loads(self.read_lines()[0])
+        self.assertEqual((entry["level"], entry["logger"], entry["message"]),
+                         ("ERROR", "taskApi.tests.log", "Invalid"))
+        self.assertIn("ValueError: Invalid", entry["exception"])
+
+    def test_payload_summary(self):
+        self.assertEqual(str(log.PayloadSummary(None)), "<None>")
+        self.assertEqual(str(log.PayloadSummary("abc")), str(log.PayloadSummary(b"abc")))
+        self.assertRegex(str(log.PayloadSummary(b"abc")), r"^<3 bytes blake2b:[0-9a-f]{16}>$")
+        self.assertEqual(str(log.PayloadSummary({"a": 1, "b": 2})), "<dict of 2 items>")
+        self.logger.setLevel(logging.INFO)
+        with mock.patch.object(log.PayloadSummary, "__str__", return_value="<summary>") as summarize:
+            self.logger.debug("Got %s", log.PayloadSummary(b"abc"))
+            # not summarized, the record is not emitted
+            summarize.assert_not_called()
+            self.logger.info("Got %s", log.PayloadSummary(b"abc"))
+            summarize.assert_called_once()
+
+    def test_worker_records_forwarded(self):
+        log_queue, listener = log.start_worker_logging(multiprocessing.get_context("spawn"))
+        # as sent by configure_worker_logging in a worker process
+        record = self.logger.makeRecord(self.logger.name, logging.DEBUG, __file__, 0,
+                                        "Parsed %s", ("MTBLS1",), None)
+        with self.assertLogs(self.logger.name, "DEBUG") as logs:
+            logging.handlers.QueueHandler(log_queue).handle(record)
+            # handles the records left in the queue
+            listener.stop()
+        self.assertEqual(logs.output, ["DEBUG:taskApi.tests.log:Parsed MTBLS1"])
+
+
+class RepositoryAdaptersTests(TestCase):
+
+    def test_dispatch_by_accession(self):
+        for accession, name in (("MTBLS1", "MetaboLights"), ("ST000001", "Metabolomics-Workbench"),
+                                ("MTBKS1", "MetaboBank")):
+            repository = get_repository(accession)
+            self.assertEqual(repository.name, name)
+            self.assertTrue(accession.startswith(repository.prefix))
+            self.assertIs(repositories.get_repository_by_name(name), repository)
+            self.assertIs(repositories.get_repository_by_prefix(repository.prefix), repository)
+            self.assertEqual(repositories.get_repository_name(accession), name)
+        for accession in ("XYZ1", "MTBLS", "mtbls1", "", None):
+            self.assertIsNone(get_repository(accession))
+        self.assertIsNone(repositories.get_repository_by_name("Unknown"))
+
+    def test_longest_prefix_first(self):
+        self.addCleanup(setattr, repositories, "_accession_matcher", repositories._accession_matcher)
+        with mock.patch.dict(repositories._repositories):
+            @repositories.register
+            class LongerPrefixAdapter(repositories.RepositoryAdapter):
+                name = "Longer"
+                prefix = "MTBLSX"
+
+            self.assertEqual(get_repository("MTBLSX1").name, "Longer")
+            self.assertEqual(get_repository("MTBLS1").name, "MetaboLights")
+
+    def test_unknown_accession(self):
+        response = self.client.get("/api/dataset/XYZ1/")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {"detail": "Invalid accession code: XYZ1"})
+
+
+class CompletionMarkersTests(StandInTestCase):
+
+    def test_complete_dataset_is_marked(self):
+        repository = get_repository("MTBKS1")
+        repository.fetch("MTBKS1", ("metabolites", ))
+        self.assertTrue(repository.is_complete("MTBKS1", "metabolites"))
+        self.assertFalse(repository.is_complete("MTBKS1", "rawdata"))
+
+    def test_missing_required_file_is_not_marked(self):
+        self.remove_remote_file(fixtures.MTBK_DIR, "MTBKS2", "MTBKS2.maf.0.txt")
+        self.remove_remote_file(fixtures.MTBLS_DIR, "MTBLS2", "m_MTBLS2_maf_0.tsv")
+        for accession in ("MTBKS2", "MTBLS2"):
+            repository = get_repository(accession)
+            with self.assertRaises(FileNotFoundError):
+                repository.fetch(accession, ("metabolites", ))
+            self.assertFalse(repository.is_complete(accession, "metabolites"))
+
+    def test_unknown_dataset_is_not_cached(self):
+        for accession in ("MTBKS9", "ST000009", "MTBLS9"):
+            response = self.client.get(f"/api/dataset/{accession}/")
+            self.assertEqual(response.status_code, 404)
+            repository = get_repository(accession)
+            self.assertIsNone(utils.get_dataset_cached_at(repository.prefix, accession))
+            self.assertFalse(os.path.exists(utils.get_dataset_dir(repository.prefix, accession)))
+
+
+class CacheEvictionTests(StandInTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # the same metabolites file as MTBKS1
+        fixtures.make_mtbk_study(cls.remote_dir, "MTBKS3", rows=20, samples=3, raw_files=5, seed=1)
+
+    def fetch(self, *accessions):
+        for accession in accessions:
+            get_repository(accession).fetch(accession, ("metabolites", ))
+
+    def assertCached(self, accession, cached=True):
+        repository = get_repository(accession)
+        self.assertEqual(repository.is_complete(accession, "metabolites"), cached)
+        self.assertEqual(os.path.exists(utils.get_dataset_dir(repository.prefix, accession)), cached)
+
+    def test_evict_least_recently_used(self):
+        self.fetch("MTBKS1", "MTBKS2", "ST000001")
+        entries, total = cache.get_usage()
+        self.assertEqual(set(entries), {"MTBK/MTBKS1", "MTBK/MTBKS2", "ST/ST000001"})
+        self.assertEqual(cache.evict(quota=total - 1, policy="lru"), ["MTBK/MTBKS1"])
+        self.assertCached("MTBKS1", False)
+        self.assertCached("MTBKS2")
+        self.assertCached("ST000001")
+        self.assertEqual(cache.get_usage()[1], total - entries["MTBK/MTBKS1"]["size"])
+
+    def test_pinned_datasets_are_kept(self):
+        self.fetch("MTBKS1", "MTBKS2")
+        cache.set_pinned("MTBK", "MTBKS1")
+        self.assertEqual(cache.evict(quota=0), ["MTBK/MTBKS2"])
+        self.assertCached("MTBKS1")
+        self.assertCached("MTBKS2", False)
+
+    def test_quota_evicts_on_fetch(self):
+        self.fetch("MTBKS1")
+        entries, total = cache.get_usage()
+        with mock.patch.object(settings, "DATASETS_CACHE_QUOTA", total + 1):
+            self.fetch("MTBKS2")
+        self.assertEqual(set(cache.get_usage()[0]), {"MTBK/MTBKS2"})
+        self.assertCached("MTBKS1", False)
+
+    def test_evicted_dataset_is_fetched_again(self):
+        self.fetch("MTBKS1")
+        cache.evict(quota=0)
+        self.fetch("MTBKS1")
+        self.assertCached("MTBKS1")
+        self.assertEqual(set(cache.get_usage()[0]), {"MTBK/MTBKS1"})
+
+    def test_shared_blobs_count_once(self):
+        with mock.patch.object(settings, "DATASETS_STORAGE", "blobs"):
+            self.fetch("MTBKS1", "MTBKS3")
+            entries, total = cache.get_usage()
+            self.assertEqual(total, blobs.get_usage()[1])
+            self.assertLess(total, sum(entry["size"] for entry in entries.values()))
+            # the blobs MTBKS3 shares with MTBKS1 are kept
+            cache.discard("MTBK", "MTBKS1")
+            self.assertEqual(cache.get_usage()[1], blobs.get_usage()[1])
+            self.assertCached("MTBKS3")
+            dataset = get_repository("MTBKS3").parse("MTBKS3", ("metabolites", ))
+            self.assertEqual(len(dataset["Metabolites"]), 20)
+
+
+    def test_blobs_read_only_and_linked_again(self):
+        self.patch(mock.patch.object(settings, "DATASETS_STORAGE", "blobs"))
+        self.fetch("MTBKS1")
+        manifest = blobs.read_manifest("MTBK", "MTBKS1")
+        local_base_dir = utils.get_dataset_dir("MTBK", "MTBKS1")
+        usage = blobs.get_usage()
+        self.assertEqual(usage[0], len(set(manifest.values())))
+        for relative_path, digest in manifest.items():
+            local_path = os.path.join(local_base_dir, relative_path)
+            # the dataset file is the blob
+            self.assertTrue(os.path.samefile(local_path, blobs.get_blob_path(digest)))
+            self.assertEqual(stat.S_IMODE(os.stat(local_path).st_mode), 0o444)
+        # downloaded again, the same blobs
+        self.fetch("MTBKS1")
+        self.assertEqual(blobs.read_manifest("MTBK", "MTBKS1"), manifest)
+        self.assertEqual(blobs.get_usage(), usage)
+        for relative_path, digest in manifest.items():
+            self.assertTrue(os.path.samefile(os.path.join(local_base_dir, relative_path),
+                                             blobs.get_blob_path(digest)))
+
+
+class StaleWhileRevalidateTests(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.repository = get_repository("MTBKS1")
+        self.repository.fetch("MTBKS1", ("metadata", ))
+        self.version_dir = os.path.realpath(utils.get_dataset_dir("MTBK", "MTBKS1"))
+        self.fetched_at = utils.get_dataset_fetched_at("MTBK", "MTBKS1", "metadata")
+        # every local copy expired
+        self.patch(mock.patch.object(self.repository, "cache_ttl", 0))
+
+    def test_stale_copy_served_while_revalidating(self):
+        revalidations = []
+        revalidate = self.repository.revalidate
+
+        def record_revalidation(*args):
+            revalidations.append(revalidate(*args))
+            return revalidations[-1]
+
+        with mock.patch.object(self.repository, "revalidate", record_revalidation):
+            response = self.client.get("/api/dataset/MTBKS1/", {"fields": "Title"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Title", response.json())
+        self.assertEqual(len(revalidations), 1)
+        revalidations[0].result(timeout=30)
+        # the new version replaced the stale one at once, which is kept for the readers still using it
+        self.assertGreater(utils.get_dataset_fetched_at("MTBK", "MTBKS1", "metadata"), self.fetched_at)
+        self.assertNotEqual(os.path.realpath(utils.get_dataset_dir("MTBK", "MTBKS1")), self.version_dir)
+        self.assertTrue(os.path.isdir(self.version_dir))
+
+    def test_stale_copy_served_if_upstream_fails(self):
+        self.patch(mock.patch.multiple(settings, DATASETS_STALE_WHILE_REVALIDATE=0,
+                                       MTBK_BASE_URL=self.get_unreachable_url()))
+        response = self.client.get("/api/dataset/MTBKS1/", {"fields": "Title"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(utils.get_dataset_fetched_at("MTBK", "MTBKS1", "metadata"), self.fetched_at)
+        # nothing to serve without a local copy
+        response = self.client.get("/api/dataset/MTBKS2/", {"fields": "Title"})
+        self.assertEqual(response.status_code, 503)
+
+    def test_expired_copy_not_served_past_the_limits(self):
+        self.patch(mock.patch.multiple(settings, DATASETS_STALE_WHILE_REVALIDATE=0,
+                                       DATASETS_STALE_IF_ERROR=0))
+        response = self.client.get("/api/dataset/MTBKS1/", {"fields": "Title"})
+        self.assertEqual(response.status_code, 200)
+        # downloaded again within the request
+        self.assertGreater(utils.get_dataset_fetched_at("MTBK", "MTBKS1", "metadata"), self.fetched_at)
+
+
+class CircuitBreakerTests(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.patch(mock.patch.multiple(settings, UPSTREAM_FAILURE_THRESHOLD=2,
+                                       UPSTREAM_RESET_TIMEOUT=0.2))
+        self.upstream = throttling.get_upstream("http://upstream.test")
+
+    def call(self, error=None):
+        with self.upstream.call():
+            if error is not None:
+                raise error
+
+    def call_failing(self):
+        with self.assertRaises(ConnectionError):
+            self.call(ConnectionError())
+
+    def get_circuit(self):
+        with self.upstream.state.update() as state:
+            return state.get("circuit", {})
+
+    def test_circuit_opens_after_consecutive_failures(self):
+        self.call_failing()
+        self.call()
+        self.call_failing()
+        self.assertIsNone(self.get_circuit()["opened_at"])
+        self.call_failing()
+        self.assertIsNotNone(self.get_circuit()["opened_at"])
+        with self.assertRaises(CircuitOpenError) as raised:
+            self.call()
+        self.assertGreater(raised.exception.retry_after, 0)
+
+    def test_half_open_trial_closes_or_reopens_the_circuit(self):
+        self.call_failing()
+        self.call_failing()
+        time.sleep(0.2)
+        # a failed trial opens it again
+        self.call_failing()
+        with self.assertRaises(CircuitOpenError):
+            self.call()
+        time.sleep(0.2)
+        self.call()
+        self.assertEqual(self.get_circuit(), {"failures": 0, "opened_at": None})
+        self.call()
+
+    def test_other_errors_are_not_failures(self):
+        for error in (FileNotFoundError(), DeadlineExceeded(), ValueError()):
+            with self.assertRaises(type(error)):
+                self.call(error)
+        self.assertEqual(self.get_circuit(), {})
+
+    def test_unreachable_repository_fails_fast(self):
+        self.patch(mock.patch.object(settings, "MTBK_BASE_URL", self.get_unreachable_url()))
+        for i in range(2):
+            self.assertEqual(self.client.get("/api/dataset/MTBKS1/").status_code, 503)
+        with mock.patch("requests.get") as get:
+            response = self.client.get("/api/dataset/MTBKS1/")
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+        get.assert_not_called()
+
+
+class MetaboliteMatrixTests(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.patch(mock.patch.multiple(matrix, _matrix=None, _matrix_pointer=None, _base=None))
+        self.patch(mock.patch.object(settings, "METABOLITE_MATRIX_MERGE_SIZE", 2))
+        self.store("MTBLS1", ["Glucose", "L-Alanine", "Citrate"])
+        self.store("MTBLS2", ["glucose", "L-Alanine"])
+        self.store("MTBKS1", ["Glucose", "Lactate"])
+
+    def store(self, accession, metabolites):
+        repository = get_repository(accession)
+        matrix.store(repository.prefix, repository.name, accession, f"Study {accession}", metabolites)
+
+    def get_counts(self, *names):
+        response = self.client.get("/api/metabolites/counts/", {"name": names})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_pending_until_built(self):
+        with mock.patch.object(matrix, "start_build") as start_build:
+            response = self.client.get("/api/metabolites/top/")
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+        start_build.assert_called_once_with()
+
+    def test_queries(self):
+        matrix.build()
+        self.assertEqual(self.get_counts("GLUCOSE", "Unknown"), {
+            "studies": 3,
+            "results": [{"name": "Glucose", "studies": 3,
+                         "repositories": {"MetaboBank": 1, "MetaboLights": 2}},
+                        {"name": "Unknown", "studies": 0,
+                         "repositories": {"MetaboBank": 0, "MetaboLights": 0}}]})
+        response = self.client.get("/api/metabolites/top/", {"k": 2})
+        self.assertEqual(response.json()["results"], [{"name": "Glucose", "studies": 3},
+                                                      {"name": "L-Alanine", "studies": 2}])
+        response = self.client.get("/api/metabolites/top/", {"repository": "MetaboBank"})
+        self.assertCountEqual(response.json()["results"], [{"name": "Glucose", "studies": 1},
+                                                           {"name": "Lactate", "studies": 1}])
+        response = self.client.get("/api/metabolites/cooccurrence/", {"name": "L-Alanine"})
+        self.assertEqual(response.json(), {
+            "name": "L-Alanine", "repository": None, "studies": 2,
+            "results": [{"name": "Glucose", "studies": 2, "jaccard": 0.6667},
+                        {"name": "Citrate", "studies": 1, "jaccard": 0.5}]})
+        response = self.client.get("/api/metabolites/cooccurrence/", {"name": "Unknown"})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get("/api/metabolites/top/", {"k": "x"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_stored_datasets_merged_into_new_version(self):
+        matrix.build()
+        version = matrix.read_pointer()["version"]
+        # replaces the metabolites of MTBKS1
+        self.store("MTBKS1", ["Lactate", "Pyruvate"])
+        self.assertEqual(matrix.read_pointer(), {"version": version, "delta_entries": 1})
+        self.assertEqual(self.get_counts("Glucose", "Pyruvate")["results"][0]["studies"], 2)
+        self.assertEqual(self.get_counts("Pyruvate")["results"][0]["studies"], 1)
+        self.store("MTBKS2", ["Pyruvate"])
+        pointer = matrix.read_pointer()
+        self.assertNotEqual(pointer["version"], version)
+        self.assertEqual(pointer["delta_entries"], 0)
+        self.assertEqual(os.listdir(settings.METABOLITE_MATRIX_DIR).count(version), 0)
+        counts = self.get_counts("Glucose", "Pyruvate")
+        self.assertEqual(counts["studies"], 4)
+        self.assertEqual([result["studies"] for result in counts["results"]], [2, 2])
+        # the same as built from the table
+        matrix.build(rebuild=True)
+        self.assertEqual(self.get_counts("Glucose", "Pyruvate"), counts)
+
+
+class SimilarDatasetsTests(StandInTestCase):
+
+    def store(self, accession, metabolites):
+        repository = get_repository(accession)
+        utils.sync_dataset_metabolites(repository.prefix, repository.name, accession,
+                                       f"Study {accession}", metabolites)
+        return similarity.update_signature(accession, metabolites)
+
+    def test_most_similar_first(self):
+        metabolites = [f"Metabolite {i}" for i in range(40)]
+        self.assertTrue(self.store("MTBLS1", metabolites))
+        self.assertFalse(self.store("MTBLS1", metabolites[::-1]))
+        # Jaccard index of 36 / 44 and 30 / 50
+        self.store("MTBLS2", metabolites[:36] + [f"Other {i}" for i in range(4)])
+        self.store("ST000001", metabolites[:30] + [f"Other {i}" for i in range(10)])
+        self.store("MTBKS1", [f"Other {i}" for i in range(40)])
+        results = similarity.find_similar("MTBLS1", metabolites, 10)
+        self.assertEqual([result["accession"] for result in results][:2], ["MTBLS2", "ST000001"])
+        self.assertAlmostEqual(results[0]["similarity"], 36 / 44, delta=0.1)
+        self.assertEqual(results[0]["repository"], "MetaboLights")
+        self.assertEqual(results[0]["metabolites"], 40)
+        self.assertEqual(results[0]["title"], "Study MTBLS2")
+        self.assertNotIn("MTBKS1", [result["accession"] for result in results])
+        self.assertEqual(similarity.find_similar("MTBLS1", [], 10), [])
+
+    def test_similar_view(self):
+        repository = get_repository("MTBKS1")
+        repository.fetch("MTBKS1", ("metabolites", ))
+        metabolites = repository.parse("MTBKS1", ("metabolites", ))["Metabolites"]
+        self.store("MTBKS1", metabolites)
+        self.store("MTBLS2", metabolites)
+        response = self.client.get("/api/dataset/MTBKS1/similar/", {"k": 5})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            "accession": "MTBKS1",
+            "metabolites": len(set(metabolites)),
+            "results": [{"accession": "MTBLS2", "title": "Study MTBLS2", "repository": "MetaboLights",
+                         "metabolites": len(set(metabolites)), "similarity": 1.0}]})
+        self.assertEqual(self.client.get("/api/dataset/MTBKS9/similar/").status_code, 404)
+
+
+class AbundancesTests(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.patch(mock.patch.dict(abundances._loaded, clear=True))
+        self.names, self.values = self.read_maf("MTBKS1")
+
+    def read_maf(self, accession):
+        """
+        Metabolite names and abundances of the identified rows of a stand-in MAF file
+        """
+        with open(os.path.join(self.remote_dir, fixtures.MTBK_DIR, accession,
+                               f"{accession}.maf.0.txt")) as f:
+            rows = [line.rstrip("\n").split("\t") for line in f][1:]
+        start = len(fixtures.MAF_COLUMNS)
+        name = fixtures.MAF_COLUMNS.index("metabolite_identification")
+        rows = [row for row in rows if row[name]]
+        return [row[name] for row in rows], [[float(value) for value in row[start:]] for row in rows]
+
+    def get_abundances(self, **params):
+        response = self.client.get("/api/dataset/MTBKS1/abundances/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_slice(self):
+        abundances_slice = self.get_abundances(
+            metabolite=[self.names[3].upper(), self.names[1], "Unknown"],
+            sample=["sample_2", "sample_0"])
+        self.assertEqual(abundances_slice["count"], 2)
+        self.assertEqual(abundances_slice["missing"], ["Unknown"])
+        self.assertEqual(abundances_slice["samples"], ["sample_2", "sample_0"])
+        self.assertEqual(abundances_slice["metabolites"], [self.names[1], self.names[3]])
+        for values, row in zip(abundances_slice["values"], (1, 3)):
+            self.assertEqual(len(values), 2)
+            self.assertAlmostEqual(values[0], self.values[row][2], places=3)
+            self.assertAlmostEqual(values[1], self.values[row][0], places=3)
+
+    def test_pages(self):
+        abundances_page = self.get_abundances(page=2, page_size=8)
+        self.assertEqual(abundances_page["count"], len(self.names))
+        self.assertEqual(abundances_page["has_next"], len(self.names) > 16)
+        self.assertEqual(abundances_page["samples"], ["sample_0", "sample_1", "sample_2"])
+        self.assertEqual(abundances_page["metabolites"], self.names[8:16])
+        self.assertEqual(len(abundances_page["values"]), len(self.names[8:16]))
+        for values, expected in zip(abundances_page["values"], self.values[8:16]):
+            for value, expected_value in zip(values, expected):
+                self.assertAlmostEqual(value, expected_value, places=3)
+
+    def test_unknown_sample_not_found(self):
+        response = self.client.get("/api/dataset/MTBKS1/abundances/", {"sample": ["sample_9"]})
+        self.assertEqual(response.status_code, 404)
+
+    def test_extracted_once_per_version(self):
+        self.get_abundances(page_size=1)
+        columnar_dir = abundances.get_columnar_dir("MTBK", "MTBKS1")
+        self.assertIn(columnar_dir, abundances._loaded)
+        with mock.patch.object(abundances, "extract", wraps=abundances.extract) as extract:
+            self.get_abundances(page_size=1)
+            # downloaded again, a new version
+            abundances._loaded.clear()
+            cache.discard("MTBK", "MTBKS1")
+            self.get_abundances(page_size=1)
+        extract.assert_called_once()
+        self.assertEqual(abundances.read_labels(columnar_dir)["fetched_at"],
+                         utils.get_dataset_fetched_at("MTBK", "MTBKS1", "metabolites"))
+        self.assertEqual(abundances._extracting, {})
+
+    def test_downloaded_again_while_extracting(self):
+        self.get_abundances(page_size=1)
+        abundances._loaded.clear()
+        shutil.rmtree(abundances.get_columnar_dir("MTBK", "MTBKS1"))
+        repository = get_repository("MTBKS1")
+        fetched_at = utils.get_dataset_fetched_at("MTBK", "MTBKS1", "metabolites")
+        # the version read once, a newer one afterwards
+        versions = iter([fetched_at])
+        with mock.patch.object(utils, "get_dataset_fetched_at",
+                               side_effect=lambda *args: next(versions, fetched_at + 1)):
+            abundance_matrix = abundances.get_matrix(repository, "MTBKS1")
+        self.assertIsNotNone(abundance_matrix)
+        self.assertEqual(abundance_matrix.metabolites, self.names)
+
+    def test_non_finite_values_none(self):
+        repository = get_repository("MTBKS1")
+        self.patch(mock.patch.object(
+            type(repository), "read_abundances",
+            return_value=(["a", "b"], ["sample_0", "sample_1"],
+                          [[1.5, float("inf")], [float("nan"), float("-inf")]])))
+        self.patch(mock.patch.object(utils, "get_dataset_fetched_at", return_value=1))
+        abundance_matrix = abundances.get_matrix(repository, "MTBKS1")
+        self.assertEqual(abundance_matrix.get_slice([0, 1], [0, 1]), [[1.5, None], [None, None]])
+
+
+class DeadlineTests(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.patch(mock.patch.object(settings, "DATASET_REQUEST_TIMEOUT", 0.2))
+        self.repository = get_repository("MTBKS1")
+        # the downloads left in the background
+        self.fetches = []
+        fetch_async = self.repository.fetch_async
+
+        def record_fetch(*args):
+            self.fetches.append(fetch_async(*args))
+            return self.fetches[-1]
+
+        self.patch(mock.patch.object(self.repository, "fetch_async", record_fetch))
+
+    def set_latency(self, latency):
+        self.conditions.latency = latency
+        self.addCleanup(setattr, self.conditions, "latency", 0.0)
+
+    def wait_fetches(self):
+        for future in self.fetches:
+            future.result(timeout=30)
+
+    def test_partial_dataset(self):
+        self.repository.fetch("MTBKS1", ("metadata", ))
+        self.set_latency(0.5)
+        response = self.client.get("/api/dataset/MTBKS1/")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response["Retry-After"], "1")
+        dataset = response.json()
+        self.assertCountEqual(dataset["pending"], ["metabolites", "rawdata"])
+        self.assertEqual(dataset["Title"], "Synthetic study MTBKS1")
+        self.assertNotIn("Metabolites", dataset)
+        self.wait_fetches()
+        # finished in the background
+        response = self.client.get("/api/dataset/MTBKS1/")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("pending", response.json())
+        self.assertTrue(response.json()["Metabolites"])
+
+    def test_nothing_ready(self):
+        self.set_latency(0.5)
+        for path in ("/api/dataset/MTBKS1/", "/api/dataset/MTBKS1/metabolites/",
+                     "/api/dataset/MTBKS1/abundances/"):
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response["Retry-After"], "1")
+            self.assertIn("still in progress", response.json()["detail"])
+        self.wait_fetches()
+        self.assertEqual(self.client.get("/api/dataset/MTBKS1/metabolites/").status_code, 200)
+
+
+class RepositoryRegistryTests(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.repository = DatasetRepository.objects.create(
+            name="MetaboLights", accession_template="MTBLSxxx")
+        DatasetRepositoryFile.objects.create(repository=self.repository, filename="i_Investigation.txt")
+
+    def test_loaded_once(self):
+        self.assertEqual(registry.get_repository_info("MTBLS1")["files"], ["i_Investigation.txt"])
+        with self.assertNumQueries(0):
+            self.assertEqual(registry.get_repository_info("MTBLS2")["name"], "MetaboLights")
+            self.assertIsNone(registry.get_repository_info("ST000001"))
+            self.assertEqual(registry.get_repository_id("MTBLS", "MetaboLights"), self.repository.id)
+
+    def test_reloaded_once_saved_or_deleted(self):
+        registry.get_registry()
+        self.repository.name = "EBI MetaboLights"
+        self.repository.save()
+        self.assertEqual(registry.get_repository_info("MTBLS1")["name"], "EBI MetaboLights")
+        DatasetRepositoryFile.objects.create(repository=self.repository, filename="s_Sample.txt")
+        self.assertEqual(len(registry.get_repository_info("MTBLS1")["files"]), 2)
+        self.repository.delete()
+        self.assertIsNone(registry.get_repository_info("MTBLS1"))
+
+    def test_missing_repository_created(self):
+        registry.get_registry()
+        repository_id = registry.get_repository_id("ST", "Metabolomics-Workbench")
+        self.assertEqual(DatasetRepository.objects.get(id=repository_id).accession_template, "STxxx")
+        self.assertEqual(registry.get_repository_info("ST000001")["id"], repository_id)
+        utils.sync_dataset_metabolites("ST", "Metabolomics-Workbench", "ST000001", "Title", ["Glucose"])
+        self.assertEqual(Dataset.objects.get(accession="ST000001").repository_id, repository_id)
+        self.assertEqual(DatasetRepository.objects.count(), 2)
+
+
+class SectionsTests(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.repository = get_repository("MTBKS1")
+        self.repository.fetch("MTBKS1", ("metabolites", "rawdata"))
+        self.dataset = self.repository.parse("MTBKS1", ("metabolites", "rawdata"))
+
+    def test_pages(self):
+        for section, field in (("metabolites", "Metabolites"), ("rawdata", "Rawdata")):
+            items = self.dataset[field]
+            for page in (1, 2):
+                response = self.client.get(f"/api/dataset/MTBKS1/{section}/",
+                                           {"page": page, "page_size": 3})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json(), {
+                    "accession": "MTBKS1", "count": len(items), "page": page, "page_size": 3,
+                    "has_next": page * 3 < len(items), "results": items[(page - 1) * 3:page * 3]})
+
+    def test_page_bounds(self):
+        items = self.dataset["Metabolites"]
+        self.patch(mock.patch.object(settings, "DATASET_MAX_PAGE_SIZE", 4))
+        for params, page, page_size, results in (
+                ({"page": 0, "page_size": 0}, 1, 1, items[:1]),
+                ({"page": 2, "page_size": 100}, 2, 4, items[4:8]),
+                ({"page": 1000, "page_size": 3}, 1000, 3, [])):
+            response = self.client.get("/api/dataset/MTBKS1/metabolites/", params)
+            self.assertEqual(response.status_code, 200)
+            page_data = response.json()
+            self.assertEqual((page_data["page"], page_data["page_size"], page_data["results"]),
+                             (page, page_size, results))
+            self.assertEqual(page_data["count"], len(items))
+        self.assertFalse(page_data["has_next"])
+
+    def test_written_once_per_version(self):
+        path = sections.get_section_path("MTBK", "MTBKS1", "Metabolites")
+        self.client.get("/api/dataset/MTBKS1/metabolites/")
+        fetched_at = utils.get_dataset_fetched_at("MTBK", "MTBKS1", "metabolites")
+        self.assertEqual(sections.read(path, fetched_at, 0, 2),
+                         (self.dataset["Metabolites"][:2], len(self.dataset["Metabolites"])))
+        with mock.patch.object(self.repository, "parse", wraps=self.repository.parse) as parse:
+            self.client.get("/api/dataset/MTBKS1/metabolites/", {"page": 2})
+            parse.assert_not_called()
+            # downloaded again, a new version
+            cache.discard("MTBK", "MTBKS1")
+            self.assertEqual(self.client.get("/api/dataset/MTBKS1/metabolites/").status_code, 200)
+            parse.assert_called_once()
+        fetched_at = utils.get_dataset_fetched_at("MTBK", "MTBKS1", "metabolites")
+        self.assertIsNotNone(sections.read(path, fetched_at, 0, 2))
+
+    def test_details_first_page_from_store(self):
+        self.client.get("/api/dataset/MTBKS1/metabolites/")
+        with mock.patch.object(self.repository, "parse", wraps=self.repository.parse) as parse:
+            response = self.client.get("/api/dataset/MTBKS1/", {"page_size": 2})
+        self.assertEqual(response.status_code, 200)
+        dataset = response.json()
+        self.assertEqual(dataset["Metabolites"], self.dataset["Metabolites"][:2])
+        self.assertEqual(dataset["Metabolites_count"], len(self.dataset["Metabolites"]))
+        self.assertEqual(dataset["Rawdata"], self.dataset["Rawdata"][:2])
+        self.assertEqual(dataset["Rawdata_count"], len(self.dataset["Rawdata"]))
+        self.assertIn("Title", dataset)
+        # the metabolites were not parsed again, the raw data files once, to be stored
+        self.assertEqual([call.args for call in parse.call_args_list],
+                         [("MTBKS1", ("metadata", )), ("MTBKS1", ("rawdata", ))])
+
+    def test_bad_parameters(self):
+        for path, params in (("/api/dataset/MTBKS1/foo/", {}),
+                             ("/api/dataset/MTBKS1/metabolites/", {"page": "x"}),
+                             ("/api/dataset/MTBKS1/rawdata/", {"page_size": "x"}),
+                             ("/api/dataset/MTBKS1/", {"page_size": "x"})):
+            response = self.client.get(path, params)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("detail", response.json())
+
+
+class LazyFetchTests(StandInTestCase):
+
+    def test_only_requested_components_fetched(self):
+        response = self.client.get("/api/dataset/MTBKS1/", {"fields": "Title,Description"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json()), {"accession", "Title", "Description"})
+        repository = get_repository("MTBKS1")
+        self.assertTrue(repository.is_complete("MTBKS1", "metadata"))
+        self.assertFalse(repository.is_complete("MTBKS1", "metabolites"))
+        self.assertFalse(repository.is_complete("MTBKS1", "rawdata"))
+
+    def test_invalid_fields(self):
+        response = self.client.get("/api/dataset/MTBKS1/", {"fields": "Title,Foo"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"detail": "Invalid fields: Foo"})
+
+
+class MetricsTests(StandInTestCase):
+
+    def test_metrics_output(self):
+        self.assertEqual(self.client.get("/api/dataset/MTBKS1/").status_code, 200)
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        lines = response.content.decode().splitlines()
+        self.assertIn("# TYPE http_requests_total counter", lines)
+        self.assertTrue(any(line.startswith('dataset_fetch_seconds_count{repository="MetaboBank"}')
+                            for line in lines))
+        self.assertTrue(any(line.startswith('dataset_fetch_seconds_bucket{repository="MetaboBank",le="+Inf"}')
+                            for line in lines))
+
+    def test_metrics_restricted(self):
+        self.patch(mock.patch.multiple(settings, METRICS_ALLOWED_IPS=["10.0.0.5"], METRICS_TOKEN=""))
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.0.0.5").status_code, 200)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer ").status_code, 403)
+        self.patch(mock.patch.object(settings, "METRICS_TOKEN", "secret"))
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer other").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
+
+    def test_server_timing(self):
+        response = self.client.get("/api/dataset/MTBKS1/")
+        self.assertNotIn("Server-Timing", response)
+        self.patch(mock.patch.object(settings, "METRICS_SERVER_TIMING", True))
+        response = self.client.get("/api/dataset/MTBKS2/")
+        self.assertEqual(response.status_code, 200)
+        stages = dict(timing.split(";dur=") for timing in response["Server-Timing"].split(", "))
+        self.assertEqual(list(stages)[-1], "total")
+        self.assertTrue({"fetch", "parse", "encode"} <= set(stages))
+        for duration in stages.values():
+            self.assertGreaterEqual(float(duration), 0)
+
+
+class ParsingTests(StandInTestCase):
+
+    def test_pack_round_trip(self):
+        dataset = {"accession": "MTBKS1", "metabolites": ["a", "b c", ""], "empty": [],
+                   "blank": [""], "count": 3, "files": [{"name": "a.txt"}], "ids": [1, 2]}
+        packed = parsing.pack(dataset)
+        self.assertEqual(packed["metabolites"], (3, "a\x00b c\x00"))
+        self.assertEqual(packed["files"], [{"name": "a.txt"}])
+        self.assertEqual(parsing.unpack(packed), dataset)
+
+    def test_process_backend(self):
+        components = ("metadata", "metabolites", "rawdata")
+        repository = get_repository("MTBKS1")
+        repository.fetch("MTBKS1", components)
+        expected = utils.parse_dataset_data_mtbk("MTBK", "MTBKS1", components)
+        # the workers are spawned, they read the settings from the environment
+        self.patch(mock.patch.dict(os.environ, DATASETS_DIR=settings.DATASETS_DIR))
+        parser = parsing.ProcessParser(1, 2, 60)
+        self.addCleanup(parser.close)
+        dataset = parser.parse(utils.parse_dataset_data_mtbk, "MTBK", "MTBKS1", components)
+        self.assertEqual(dataset, expected)
+        self.assertTrue(dataset["Metabolites"])
+
+
+class ListingTests(StandInTestCase):
+
+    def test_apache_format(self):
+        html_data = """<html><body><h1>Index of /studies/MTBLS1</h1><pre>
+<a href="?C=N;O=D">Name</a>  <a href="?C=M;O=A">Last modified</a>  <a href="?C=S;O=A">Size</a>
+<a href="/studies/">Parent Directory</a>                             -
+<a href="FILES/">FILES/</a>                  2024-01-31 10:20    -
+<a href="a_MTBLS1.txt">a_MTBLS1.txt</a>     2024-01-31 10:20  1.5K
+<a href="m_MTBLS1%20v2.tsv">m_MTBLS1 v2.tsv</a>  2024-02-01 08:05:30  2M
+<a href="https://www.ebi.ac.uk/">EBI</a>
+</pre></body></html>"""
+        self.assertEqual(listing.parse_listing("https://host/studies/MTBLS1/", html_data), [
+            {"name": "FILES", "type": "dir", "size": None, "modify": "20240131102000"},
+            {"name": "a_MTBLS1.txt", "type": "file", "size": 1536, "modify": "20240131102000"},
+            {"name": "m_MTBLS1 v2.tsv", "type": "file", "size": 2 * 1024 ** 2, "modify": "20240201080530"}])
+
+    def test_nginx_format(self):
+        html_data = """<html><head><title>Index of /MTBKS1/</title></head><body><h1>Index of /MTBKS1/</h1><hr><pre>
+<a href="../">../</a>
+<a href="raw/">raw/</a>                                               31-Jan-2024 10:20       -
+<a href="/MTBKS1/MTBKS1.idf.txt">MTBKS1.idf.txt</a>                 31-Jan-2024 10:20:05    1234
+<a href="raw/MTBKS1.raw">MTBKS1.raw</a>                             31-Jan-2024 10:20    99
+<a href="MTBKS1.maf.txt">MTBKS1.maf.txt</a>
+</pre><hr></body></html>"""
+        self.assertEqual(listing.parse_listing("https://host/MTBKS1/", html_data), [
+            {"name": "raw", "type": "dir", "size": None, "modify": "20240131102000"},
+            {"name": "MTBKS1.idf.txt", "type": "file", "size": 1234, "modify": "20240131102005"},
+            {"name": "MTBKS1.maf.txt", "type": "file", "size": None, "modify": None}])
+
+    def test_list_url(self):
+        url = f"{self.http_server.url}/{fixtures.MTBLS_DIR}/MTBLS1"
+        local_dir = os.path.join(self.remote_dir, fixtures.MTBLS_DIR, "MTBLS1")
+        entries = listing.list_url(url)
+        self.assertEqual({(entry["name"], entry["type"]) for entry in entries},
+                         {(name, "dir" if os.path.isdir(os.path.join(local_dir, name)) else "file")
+                          for name in os.listdir(local_dir)})
+        for entry in entries:
+            if entry["type"] == "file":
+                self.assertEqual(entry["size"], os.path.getsize(os.path.join(local_dir, entry["name"])))
+        self.assertIsNone(listing.list_url(f"{self.http_server.url}/{fixtures.MTBLS_DIR}/MTBLS9"))
+
+    def test_cached_and_shared(self):
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def list_function():
+            calls.append(threading.current_thread().name)
+            started.set()
+            release.wait(5)
+            return [{"name": "a.txt"}]
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(listing.get_cached("key", list_function, 60)))
+                   for _ in range(3)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, [[{"name": "a.txt"}]] * 3)
+        self.assertEqual(listing.get_cached("key", list_function, 60), [{"name": "a.txt"}])
+        self.assertEqual(len(calls), 1)
+        # missing directories listed again
+        self.assertIsNone(listing.get_cached("missing", lambda: None, 60))
+        self.assertNotIn("missing", listing._listings)
+
+
+class SharedStorageTests(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        shared_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shared_dir, ignore_errors=True)
+        self.shared_storage = FileSystemStorage(location=shared_dir)
+        self.patch(mock.patch.object(settings, "DATASETS_SHARED_STORAGE",
+                                     "django.core.files.storage.FileSystemStorage"))
+        self.patch(mock.patch.object(storage, "get_storage", return_value=self.shared_storage))
+        self.repository = get_repository("MTBKS1")
+
+    def read_local_files(self):
+        """
+        Content of the files of the local copy of MTBKS1, as relative path: content
+        """
+        local_base_dir = os.path.realpath(utils.get_dataset_dir("MTBK", "MTBKS1"))
+        files = {}
+        for root, dirs, filenames in os.walk(local_base_dir):
+            for filename in filenames:
+                if filename.startswith(settings.DATASET_COMPLETE_MARKER):
+                    continue
+                with open(os.path.join(root, filename), "rb") as f:
+                    files[os.path.relpath(os.path.join(root, filename), local_base_dir)] = f.read()
+        return files
+
+    def fetch_from_other_node(self, components=("files",)):
+        """
+        Fetch MTBKS1 again, with the local copy removed and the repository unreachable
+        """
+        cache.discard("MTBK", "MTBKS1")
+        with mock.patch.object(settings, "MTBK_BASE_URL", self.get_unreachable_url()):
+            self.repository.fetch("MTBKS1", components)
+
+    def test_shared_between_nodes(self):
+        self.repository.fetch("MTBKS1")
+        files = self.read_local_files()
+        index = storage.get_index("MTBK", "MTBKS1")
+        self.assertEqual(set(index["files"]), set(files))
+        self.fetch_from_other_node()
+        self.assertEqual(self.read_local_files(), files)
+        self.assertTrue(self.repository.is_complete("MTBKS1", "files"))
+
+    def test_component_shared_alone(self):
+        self.repository.fetch("MTBKS1", ("metadata",))
+        self.assertIsNone(storage.get_index("MTBK", "MTBKS1"))
+        index = storage.get_index("MTBK", "MTBKS1", "metadata")
+        self.assertEqual(set(index["files"]), set(self.read_local_files()))
+        self.fetch_from_other_node(("metadata",))
+        self.assertTrue(self.repository.is_complete("MTBKS1", "metadata"))
+        self.assertFalse(self.repository.is_complete("MTBKS1", "metabolites"))
+
+    def test_new_version_replaces_previous(self):
+        self.repository.fetch("MTBKS1")
+        previous = storage.get_index("MTBK", "MTBKS1")
+        local_base_dir = os.path.realpath(utils.get_dataset_dir("MTBK", "MTBKS1"))
+        storage.upload("MTBK", "MTBKS1", local_base_dir, previous["fetched_at"] + 1)
+        index = storage.get_index("MTBK", "MTBKS1")
+        self.assertNotEqual(index["version"], previous["version"])
+        self.assertEqual(set(index["files"]), set(previous["files"]))
+        for name in previous["files"].values():
+            self.assertFalse(self.shared_storage.exists(name))
+        for name in index["files"].values():
+            self.assertTrue(self.shared_storage.exists(name))
+
+    def test_incomplete_shared_copy_downloaded_again(self):
+        self.repository.fetch("MTBKS1")
+        files = self.read_local_files()
+        index = storage.get_index("MTBK", "MTBKS1")
+        self.shared_storage.delete(next(iter(index["files"].values())))
+        cache.discard("MTBK", "MTBKS1")
+        with self.assertLogs("taskApi.repositories", "ERROR"):
+            self.repository.fetch("MTBKS1")
+        self.assertEqual(self.read_local_files(), files)
+        # and shared again
+        self.assertGreater(storage.get_index("MTBK", "MTBKS1")["fetched_at"], index["fetched_at"])
+
+
+class ModelsTests(TestCase):
+
+    def setUp(self):
+        self.repository = DatasetRepository.objects.create(
+            name="MetaboLights", accession_template="MTBLSxxx")
+
+    def create_datasets(self, start, stop):
+        Dataset.objects.bulk_create([Dataset(accession=f"MTBLS{i}", repository=self.repository,
+                                             title=f"Study {i}") for i in range(start, stop)])
+
+    def test_metabolite_names_normalized(self):
+        ids = Metabolite.objects.get_or_create_names(["Glucose", " glucose ", "L-Alanine", ""])
+        self.assertEqual(set(ids), {"glucose", "l-alanine"})
+        self.assertEqual(Metabolite.objects.get(id=ids["glucose"]).name, "Glucose")
+        self.assertEqual(Metabolite.objects.get_or_create_names(["GLUCOSE"]), {"glucose": ids["glucose"]})
+        self.assertEqual(Metabolite.objects.count(), 2)
+
+    def test_unique_constraints(self):
+        self.create_datasets(1, 2)
+        metabolite = Metabolite.objects.create(name="Glucose")
+        DatasetMetabolite.objects.create(dataset_id="MTBLS1", metabolite=metabolite)
+        for create in (lambda: DatasetMetabolite.objects.create(dataset_id="MTBLS1", metabolite=metabolite),
+                       lambda: Metabolite.objects.create(name=" GLUCOSE"),
+                       lambda: DatasetRepository.objects.create(accession_template="MTBLSxxx")):
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                create()
+
+    def test_dataset_changelist_queries(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "admin"))
+        queries = []
+        for start, stop in ((1, 3), (3, 10)):
+            self.create_datasets(start, stop)
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get("/admin/taskApi/dataset/")
+            self.assertEqual(response.status_code, 200)
+            queries.append(len(context))
+        # the same queries whatever the number of datasets listed
+        self.assertEqual(queries[0], queries[1])
+
+
+class AdminTests(TestCase):
+
+    def setUp(self):
+        repository = DatasetRepository.objects.create(name="MetaboLights", accession_template="MTBLSxxx")
+        Dataset.objects.bulk_create([Dataset(accession=f"MTBLS{i}", repository=repository,
+                                             description="a" * 100 + "z" * 400)
+                                     for i in range(10)])
+        Dataset.objects.filter(accession__in=["MTBLS1", "MTBLS2", "MTBLS3"]).update(available=False)
+        Dataset.objects.filter(accession__in=["MTBLS4", "MTBLS5"]).delete()
+
+    def get_count(self, queryset):
+        with CaptureQueriesContext(connection) as context:
+            count = admin.EstimatedCountPaginator(queryset.order_by("accession"), 10).count
+        return count, any("COUNT(" in query["sql"] for query in context.captured_queries)
+
+    def test_estimated_count(self):
+        with mock.patch.object(settings, "ADMIN_COUNT_ESTIMATE_THRESHOLD", 5):
+            # the last rowid, the rows deleted are still counted
+            self.assertEqual(self.get_count(Dataset.objects.all()), (10, False))
+            self.assertEqual(self.get_count(Dataset.objects.filter(available=True)), (5, True))
+        self.assertEqual(self.get_count(Dataset.objects.all()), (8, True))
+
+    def test_changelist_truncated_fields(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "admin"))
+        with mock.patch.object(settings, "ADMIN_COUNT_ESTIMATE_THRESHOLD", 5):
+            response = self.client.get("/admin/taskApi/dataset/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["cl"].result_count, 10)
+        self.assertContains(response, "a" * 100)
+        self.assertNotContains(response, "az")
+        dataset = response.context["cl"].result_list[0]
+        self.assertEqual(dataset.get_deferred_fields(), {"description"})
+        self.assertEqual(dataset.description_excerpt, "a" * 100)
+
+
+class CatalogSyncTests(TestCase):
+
+    def setUp(self):
+        # the repositories of the previous tests were rolled back
+        registry.invalidate()
+        self.addCleanup(registry.invalidate)
+        patcher = mock.patch.object(settings, "CATALOG_BATCH_SIZE", 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sync(self, datasets):
+        return utils.sync_dataset_list("MTBLS", "MetaboLights", datasets)
+
+    def get_catalog(self):
+        return {dataset.accession: (dataset.title, dataset.available)
+                for dataset in Dataset.objects.all()}
+
+    def test_added_updated_removed(self):
+        self.assertEqual(self.sync({"MTBLS1": "Study 1", "MTBLS2": "Study 2", "MTBLS3": "Study 3"}),
+                         {"total": 3, "new": 3, "removed": 0})
+        repository = DatasetRepository.objects.get()
+        self.assertEqual((repository.name, repository.accession_template), ("MetaboLights", "MTBLSxxx"))
+        self.assertEqual(self.sync({"MTBLS1": "Study one", "MTBLS3": "Study 3", "MTBLS4": "Study 4"}),
+                         {"total": 3, "new": 1, "removed": 1})
+        self.assertEqual(self.get_catalog(), {"MTBLS1": ("Study one", True),
+                                              "MTBLS2": ("Study 2", False),
+                                              "MTBLS3": ("Study 3", True),
+                                              "MTBLS4": ("Study 4", True)})
+        self.assertEqual(set(Dataset.objects.values_list("repository_id", flat=True)), {repository.id})
+
+    def test_removed_listed_again(self):
+        self.sync({"MTBLS1": "Study 1", "MTBLS2": "Study 2"})
+        self.sync({"MTBLS1": "Study 1"})
+        self.assertEqual(self.sync({"MTBLS1": "Study 1", "MTBLS2": "Study 2"}),
+                         {"total": 2, "new": 1, "removed": 0})
+        self.assertEqual(self.get_catalog(), {"MTBLS1": ("Study 1", True),
+                                              "MTBLS2": ("Study 2", True)})
+
+    def test_titles_kept_if_not_listed(self):
+        self.sync({"MTBLS1": "Study 1"})
+        self.sync({"MTBLS1": None, "MTBLS2": None})
+        self.assertEqual(self.get_catalog(), {"MTBLS1": ("Study 1", True),
+                                              "MTBLS2": (None, True)})
+
+
+class FTPConnectionPoolTests(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.pool = ftp.FTPConnectionPool("127.0.0.1", "anonymous", "", size=2, keepalive=0.05,
+                                          port=self.ftp_server.server_address[1])
+        self.addCleanup(self.pool.close)
+        # idle connections checked by the test
+        self.patch(mock.patch.object(self.pool, "start_keepalive"))
+        self.connect = self.patch(mock.patch.object(self.pool, "connect", wraps=self.pool.connect))
+        self.study_path = "/" + posixpath.join(*fixtures.MTBLS_DIR.split(os.sep), "MTBLS1")
+
+    def test_open_connections_bounded_while_checked(self):
+        for ftp_connection in [self.pool.acquire(), self.pool.acquire()]:
+            self.pool.release(ftp_connection)
+        time.sleep(0.05)
+        checking, checked = threading.Event(), threading.Event()
+        is_alive = self.pool.is_alive
+
+        def wait_is_alive(ftp_connection):
+            # only the first check waits
+            if not checking.is_set():
+                checking.set()
+                checked.wait(5)
+            return is_alive(ftp_connection)
+
+        with mock.patch.object(self.pool, "is_alive", wait_is_alive):
+            check = threading.Thread(target=self.pool.check_idle)
+            check.start()
+            self.assertTrue(checking.wait(5))
+            # one connection is being checked, the other one is still idle
+            borrowed = [self.pool.acquire()]
+            # no slot left, waits for the one being checked instead of connecting
+            borrow = threading.Thread(target=lambda: borrowed.append(self.pool.acquire()))
+            borrow.start()
+            borrow.join(0.2)
+            self.assertTrue(borrow.is_alive())
+            checked.set()
+            check.join(5)
+            borrow.join(5)
+        self.assertEqual(len(borrowed), 2)
+        self.assertEqual(self.connect.call_count, 2)
+        for ftp_connection in borrowed:
+            self.pool.release(ftp_connection)
+
+    def test_timeout_reset_on_release(self):
+        with deadlines.deadline(5):
+            with self.pool.connection() as ftp_connection:
+                self.assertLessEqual(ftp_connection.sock.gettimeout(), 5)
+        self.assertEqual(ftp_connection.sock.gettimeout(), settings.UPSTREAM_READ_TIMEOUT)
+        with self.pool.connection() as reused:
+            self.assertIs(reused, ftp_connection)
 
-# Create your tests here.
+    def test_list_dir(self):
+        local_path = os.path.join(self.remote_dir, fixtures.MTBLS_DIR, "MTBLS1")
+        expected = {}
+        for root, dirs, files in os.walk(local_path):
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                expected[os.path.relpath(path, local_path).replace(os.sep, "/")] = (
+                    "dir" if os.path.isdir(path) else "file")
+        self.assertIn("dir", expected.values())
+        with self.pool.connection() as ftp_connection:
+            entries = ftp.list_dir(ftp_connection, self.study_path, recursive=True)
+            self.assertEqual({entry["name"]: entry["type"] for entry in entries}, expected)
+            for entry in entries:
+                if entry["type"] == "file":
+                    self.assertEqual(entry["size"], os.path.getsize(os.path.join(local_path, entry["name"])))
+            # without MLSD, directories told from files changing into them
+            with mock.patch.object(ftp_connection, "mlsd",
+                                   side_effect=ftplib.error_perm("500 Unknown command")):
+                entries = ftp.list_dir(ftp_connection, self.study_path, recursive=True)
+            self.assertEqual({entry["name"]: entry["type"] for entry in entries}, expected)
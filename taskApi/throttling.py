@@ -0,0 +1,205 @@
+"""
+This file contains the upstream rate limiting and circuit breaking for the taskApi app.
+State is kept in small lock-protected files, so the limits are shared
+by all the threads and worker processes of a node.
+"""
+import fcntl
+import ftplib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from urllib.parse import urlparse
+
+from taskPrj import settings
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def get_upstream_errors():
+    """
+    Errors meaning the upstream server is unhealthy, not just a missing file.
+    requests is only imported on first use, it is slow to import.
+    """
+    import requests
+
+    return (requests.ConnectionError, requests.Timeout, requests.HTTPError,
+            ftplib.error_temp, ConnectionError, TimeoutError,
+            socket.gaierror, EOFError)
+
+
+class UpstreamUnavailable(Exception):
+    """
+    The upstream can not be queried right now
+    """
+
+    def __init__(self, host, retry_after):
+        self.host = host
+        self.retry_after = retry_after
+        super().__init__(f"Upstream unavailable: {host}, retry after {retry_after:.0f}s")
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    pass
+
+
+class RateLimitExceeded(UpstreamUnavailable):
+    pass
+
+
+class SharedState:
+    """
+    JSON state stored in a file, locked across threads and processes
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def update(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.lock, open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            content = f.read()
+            state = json.loads(content) if content else {}
+            yield state
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+
+
+class TokenBucket:
+    """
+    Allow `rate` calls per second on average, with bursts of up to `burst` calls
+    """
+
+    def __init__(self, rate, burst, max_wait):
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+
+    def take(self, state, host):
+        """
+        Take a token from the bucket state, returning the seconds to wait for it
+        """
+        if self.rate <= 0:
+            return 0
+        now = time.time()
+        tokens = min(self.burst, state.get("tokens", self.burst)
+                     + (now - state.get("updated", now)) * self.rate)
+        # tokens below zero are calls already waiting for their turn
+        wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+        if wait > self.max_wait:
+            raise RateLimitExceeded(host, wait)
+        state["tokens"] = tokens - 1
+        state["updated"] = now
+        return wait
+
+
+class CircuitBreaker:
+    """
+    Fail fast once an upstream had `threshold` consecutive errors,
+    letting a single trial call through every `reset_timeout` seconds
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+    def check(self, state, host):
+        opened_at = state.get("opened_at")
+        if opened_at is None:
+            return
+        now = time.time()
+        if now < opened_at + self.reset_timeout:
+            raise CircuitOpenError(host, opened_at + self.reset_timeout - now)
+        # half-open: this call is the trial, the others keep failing fast
+        logger.debug("Circuit half-open for %s", host)
+        state["opened_at"] = now
+
+    def is_clear(self, state):
+        """
+        True if there is no failure to forget on success
+        """
+        return not state.get("failures") and state.get("opened_at") is None
+
+    def record_success(self, state, host):
+        if state.get("opened_at") is not None:
+            logger.debug("Circuit closed for %s", host)
+        state["failures"] = 0
+        state["opened_at"] = None
+
+    def record_failure(self, state, host):
+        state["failures"] = state.get("failures", 0) + 1
+        if state["failures"] >= self.threshold:
+            logger.debug("Circuit open for %s", host)
+            state["opened_at"] = time.time()
+
+
+class Upstream:
+    """
+    Rate limit and circuit breaker of an upstream host,
+    sharing a single state file
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.state = SharedState(os.path.join(settings.UPSTREAM_STATE_DIR, f"{host}.json"))
+        self.bucket = TokenBucket(
+            rate=settings.UPSTREAM_RATE_LIMITS.get(host, settings.UPSTREAM_RATE_LIMIT),
+            burst=settings.UPSTREAM_RATE_BURST,
+            max_wait=settings.UPSTREAM_MAX_WAIT)
+        self.circuit = CircuitBreaker(
+            threshold=settings.UPSTREAM_FAILURE_THRESHOLD,
+            reset_timeout=settings.UPSTREAM_RESET_TIMEOUT)
+
+    @contextmanager
+    def call(self):
+        """
+        Wrap a call to the upstream, i.e.:
+            with get_upstream(url).call():
+                requests.get(url)
+        Only a block exiting normally is a success, upstream errors are failures
+        and other errors (a missing file, the deadline) record nothing.
+        """
+        # a single locked read-modify-write on entry, nothing written if the call is refused
+        with self.state.update() as state:
+            circuit = state.setdefault("circuit", {})
+            self.circuit.check(circuit, self.host)
+            wait = self.bucket.take(state.setdefault("bucket", {}), self.host)
+            clear = self.circuit.is_clear(circuit)
+        if wait:
+            logger.debug("Rate limit for %s, waiting %.2fs", self.host, wait)
+            time.sleep(wait)
+        try:
+            yield
+        except get_upstream_errors():
+            with self.state.update() as state:
+                self.circuit.record_failure(state.setdefault("circuit", {}), self.host)
+            raise
+        if not clear:
+            with self.state.update() as state:
+                self.circuit.record_success(state.setdefault("circuit", {}), self.host)
+
+
+_upstreams = {}
+_upstreams_lock = threading.Lock()
+
+
+def get_upstream(url_or_host):
+    """
+    Shared Upstream for the host of a URL
+    """
+    host = urlparse(url_or_host).netloc or url_or_host
+    upstream = _upstreams.get(host)
+    if upstream is None:
+        with _upstreams_lock:
+            upstream = _upstreams.setdefault(host, Upstream(host))
+    return upstream
@@ -33,6 +33,18 @@ urlpatterns = [
 
     path("dataset/<slug:accession>/",
          views.view_DatasetDetails, name='dataset_details'),
+    path("dataset/<slug:accession>/abundances/",
+         views.view_DatasetAbundances, name='dataset_abundances'),
+    path("dataset/<slug:accession>/similar/",
+         views.view_DatasetSimilar, name='dataset_similar'),
+    path("dataset/<slug:accession>/<slug:section>/",
+         views.view_DatasetSection, name='dataset_section'),
+    path("metabolites/counts/",
+         views.view_MetaboliteCounts, name='metabolite_counts'),
+    path("metabolites/top/",
+         views.view_MetaboliteTop, name='metabolite_top'),
+    path("metabolites/cooccurrence/",
+         views.view_MetaboliteCooccurrence, name='metabolite_cooccurrence'),
 
     # Swagger documentation
     re_path(
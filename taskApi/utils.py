@@ -1,26 +1,69 @@
 """
 This file contains utility functions for the taskApi app
 """
+import fcntl
 import ftplib
 import json
 import logging
 import os
 import re
-from html.parser import HTMLParser
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from urllib.parse import urlparse
 
-import pandas as pd
-import requests
+# pandas and requests are imported within the functions using them,
+# so loading this module (every worker boot, every manage.py call) stays fast
+from django.db import transaction
+from django.utils import timezone
 
+from taskApi import blobs, deadlines, registry
+from taskApi.ftp import get_mtbls_ftp_pool, list_dir
+from taskApi.listing import get_cached, list_url
+from taskApi.log import PayloadSummary
+from taskApi.metrics import (DATASET_PARSE_SECONDS, UPSTREAM_BYTES,
+                             UPSTREAM_REQUEST_SECONDS)
+from taskApi.models import (Dataset, DatasetMetabolite, DatasetRepository,
+                            DatasetRepositoryFile, Metabolite)
+from taskApi.throttling import get_upstream
 from taskPrj import settings
 
 logger = logging.getLogger(__name__)
 
+# precompiled file name patterns
+MTBLS_METADATA_FILE_PATTERN = re.compile(r"([siam]).+\.((txt)|(tsv))")
+MTBLS_MAF_FILE_PATTERN = re.compile(r"(m_).+\.(tsv)")
+MTBLS_ACCESSION_PATTERN = re.compile(r"^MTBLS\d+$")
+MTBK_ACCESSION_PATTERN = re.compile(r"^MTBKS\d+$")
+# bytes read at once from the upstream responses
+UPSTREAM_CHUNK_SIZE = 64 * 1024
+
+# columns of a metabolite assignment file (MAF) before the abundance of every sample
+MAF_STANDARD_COLUMNS = {
+    "database_identifier", "chemical_formula", "smiles", "inchi", "metabolite_identification",
+    "mass_to_charge", "fragmentation", "modifications", "charge", "retention_time",
+    "chemical_shift", "multiplicity", "taxid", "species", "database", "database_version",
+    "reliability", "uri", "search_engine", "search_engine_score", "smallmolecule_abundance_sub",
+    "smallmolecule_abundance_stdev_sub", "smallmolecule_abundance_std_error_sub"}
+# keys of the Metabolomics Workbench MS_METABOLITE_DATA entries other than the samples
+MTWB_DATA_LABEL_KEYS = {"Metabolite", "RefMet_name"}
+
+# parts of a dataset fetched and marked complete independently: its metadata,
+# metabolites and raw data files list, or all its files (the ones to download too)
+DATASET_COMPONENTS = ("metadata", "metabolites", "rawdata", "files")
+# component of every field of a parsed dataset
+DATASET_FIELDS = {"Title": "metadata", "Description": "metadata", "analysis_id": "metadata",
+                  "Metabolites": "metabolites", "Rawdata": "rawdata"}
+
 
 def save_json_data(data, path, filename, createIfNotExist=True):
     """
     Save JSON data as *.json file
     """
-    logger.debug(f"Save JSON data to {path}/{filename}")
+    logger.debug("Save JSON data to %s/%s", path, filename)
     try:
         if path and createIfNotExist:
             os.makedirs(path, exist_ok=True)
@@ -37,12 +80,21 @@ def get_json_data(url):
     """
     Request JSON data from a URL
     """
-    logger.debug(f"Get JSON data from {url}")
+    import requests
+
+    logger.debug("Get JSON data from %s", url)
+    host = urlparse(url).netloc
     try:
-        with requests.get(url, stream=True) as req:
+        with get_upstream(url).call(), \
+                UPSTREAM_REQUEST_SECONDS.time("upstream", host=host), \
+                requests.get(url, stream=True, timeout=deadlines.get_upstream_timeouts()) as req:
             if req.status_code == 200:
-                logger.debug(f"Got request status: {req.status_code}")
-                return req.json()
+                logger.debug("Got request status: %s", req.status_code)
+                content = read_content(req)
+                UPSTREAM_BYTES.inc(len(content), host=host)
+                return json.loads(content)
+            if is_upstream_failure(req.status_code):
+                req.raise_for_status()
     except Exception as exc:
         logger.exception(exc)
         raise (exc)
@@ -52,22 +104,60 @@ def get_text_data(url):
     """
     Request text data from a URL
     """
-    logger.debug(f"Get text data from {url}")
+    import requests
+
+    logger.debug("Get text data from %s", url)
+    host = urlparse(url).netloc
     try:
-        with requests.get(url, stream=True) as req:
+        with get_upstream(url).call(), \
+                UPSTREAM_REQUEST_SECONDS.time("upstream", host=host), \
+                requests.get(url, stream=True, timeout=deadlines.get_upstream_timeouts()) as req:
             if req.status_code == 200:
-                logger.debug(f"Got request status: {req.status_code}")
-                return req.text
+                logger.debug("Got request status: %s", req.status_code)
+                content = read_content(req)
+                UPSTREAM_BYTES.inc(len(content), host=host)
+                return content.decode(req.encoding or "utf-8", errors="replace")
+            if is_upstream_failure(req.status_code):
+                req.raise_for_status()
     except Exception as exc:
         logger.exception(exc)
         raise (exc)
 
 
+def read_content(req):
+    """
+    Body of a streamed response, read in chunks to give up once the deadline is over
+    """
+    chunks = []
+    for chunk in req.iter_content(chunk_size=UPSTREAM_CHUNK_SIZE):
+        deadlines.check()
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def is_upstream_failure(status_code):
+    """
+    Check if an HTTP status means the upstream server is throttling or failing
+    """
+    return status_code == 429 or status_code >= 500
+
+
+def get_required_data(get_data, url):
+    """
+    Request the data of a file a dataset can not be complete without, raising
+    FileNotFoundError if missing (404, 403...), so the dataset is never marked complete
+    """
+    data = get_data(url)
+    if data is None:
+        raise FileNotFoundError(f"Could not download file {url}")
+    return data
+
+
 def save_text_data(data, path, filename, createIfNotExist=True):
     """
     Save text data as *.txt file
     """
-    logger.debug(f"Save text data to {path}/{filename}")
+    logger.debug("Save text data to %s/%s", path, filename)
     try:
         if path and createIfNotExist:
             os.makedirs(path, exist_ok=True)
@@ -81,134 +171,401 @@ def save_text_data(data, path, filename, createIfNotExist=True):
         raise (exc)
 
 
-class HTMLFilter(HTMLParser):
-    """"
-    Auxiliary class to parse html into plain text
+def get_dataset_dir(prefix, accession):
+    """
+    Local cache directory for a dataset, a link to its current version
+    """
+    return os.path.join(settings.DATASETS_DIR, prefix, accession)
+
+
+def get_marker_name(component="files"):
+    """
+    Marker file of a component of a dataset, the one of all the files
+    being DATASET_COMPLETE_MARKER
+    """
+    marker = settings.DATASET_COMPLETE_MARKER
+    if component != "files":
+        marker = f"{marker}.{component}"
+    return marker
+
+
+def get_marker_path(prefix, accession, component="files"):
+    return os.path.join(get_dataset_dir(prefix, accession), get_marker_name(component))
+
+
+def is_dataset_marker(relative_path):
+    return relative_path.startswith(settings.DATASET_COMPLETE_MARKER)
+
+
+def get_components(components):
+    """
+    Components fetched (or parsed) for the given ones, all of them for "files"
+    """
+    if "files" in components:
+        return DATASET_COMPONENTS
+    return tuple(component for component in DATASET_COMPONENTS if component in components)
+
+
+def is_dataset_complete(prefix, accession, component="files"):
+    """
+    Check if all the files of a dataset component were already downloaded
+    """
+    return get_dataset_fetched_at(prefix, accession, component) is not None
+
+
+def get_dataset_fetched_at(prefix, accession, component="files"):
+    """
+    Timestamp of the last complete download of a dataset component, None if never downloaded
+    """
+    fetched_at = None
+    for marker_component in {component, "files"}:
+        try:
+            mtime = os.path.getmtime(get_marker_path(prefix, accession, marker_component))
+        except FileNotFoundError:
+            continue
+        fetched_at = mtime if fetched_at is None else max(fetched_at, mtime)
+    return fetched_at
+
+
+def get_dataset_cached_at(prefix, accession):
+    """
+    Timestamp of the last download of any component of a dataset, None if never downloaded
+    """
+    fetched_at = [get_dataset_fetched_at(prefix, accession, component)
+                  for component in DATASET_COMPONENTS]
+    return max((value for value in fetched_at if value is not None), default=None)
+
+
+@contextmanager
+def lock_dataset(prefix, accession):
     """
-    text = ""
+    Lock the versions of a dataset, across threads and processes
+    """
+    lock_path = os.path.join(settings.DATASETS_DIR, prefix, f".{accession}.lock")
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def commit_dataset(staging_dir, prefix, accession, components=("files",), fetched_at=None,
+                   replaces=None):
+    """
+    Make the files downloaded into a staging dir (a sibling of the dataset dir)
+    the new version of a dataset, flagging the given components as complete.
+    `fetched_at` is their download time, as component: time, if not now (i.e. copied
+    from the shared storage).
+    Only the files of the current version for which `replaces(relative_path)` is true
+    are dropped if not downloaded again, all of them by default, the others being linked.
+    Readers switch to the new version at once, with an atomic rename of the dataset link,
+    and the previous version is removed DATASETS_RETIRE_GRACE seconds later.
+    """
+    dataset_dir = get_dataset_dir(prefix, accession)
+    parent_dir = os.path.dirname(dataset_dir)
+    with lock_dataset(prefix, accession):
+        current_dir = None
+        if os.path.islink(dataset_dir):
+            current_dir = os.path.realpath(dataset_dir)
+        elif os.path.isdir(dataset_dir):
+            # downloaded before the datasets were versioned, renamed to a version dir first
+            current_dir = tempfile.mkdtemp(prefix=f".{accession}.", dir=parent_dir)
+            os.rename(dataset_dir, current_dir)
+
+        staged = []
+        for root, dirs, files in os.walk(staging_dir):
+            for file in files:
+                staged.append(os.path.relpath(os.path.join(root, file), staging_dir))
+        for component in components:
+            marker_path = os.path.join(staging_dir, get_marker_name(component))
+            with open(marker_path, 'w') as f:
+                f.write("")
+            if fetched_at and component in fetched_at:
+                os.utime(marker_path, (fetched_at[component], fetched_at[component]))
+
+        # link the files (and markers) kept from the current version
+        kept = []
+        if current_dir is not None and os.path.isdir(current_dir):
+            for root, dirs, files in os.walk(current_dir):
+                for file in files:
+                    relative_path = os.path.relpath(os.path.join(root, file), current_dir)
+                    staged_path = os.path.join(staging_dir, relative_path)
+                    if os.path.exists(staged_path):
+                        continue
+                    if not is_dataset_marker(relative_path):
+                        if replaces is None or replaces(relative_path):
+                            continue
+                        kept.append(relative_path)
+                    os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+                    os.link(os.path.join(root, file), staged_path)
+
+        replaced_blobs = set()
+        if blobs.is_enabled():
+            previous = blobs.read_manifest(prefix, accession)
+            manifest = {relative_path: previous[relative_path]
+                        for relative_path in kept if relative_path in previous}
+            for relative_path in staged:
+                staged_path = os.path.join(staging_dir, relative_path)
+                manifest[relative_path], changed = blobs.store_file(staged_path, staged_path)
+            blobs.write_manifest(prefix, accession, manifest)
+            # collected once the previous version is removed
+            replaced_blobs = set(previous.values()) - set(manifest.values())
 
-    def handle_data(self, data):
-        self.text += data
+        # switch to the new version
+        link_path = os.path.join(parent_dir, f".{accession}.{uuid.uuid4().hex}.link")
+        os.symlink(os.path.basename(staging_dir), link_path)
+        os.replace(link_path, dataset_dir)
+        try:
+            if current_dir is not None:
+                retire_version(current_dir, replaced_blobs)
+            remove_leftover_versions(prefix, accession, (current_dir, staging_dir))
+        except Exception as exc:
+            # the new version is already served
+            logger.exception(exc)
 
 
-def get_dataset_data(prefix, accession):
+_retired = []
+_retired_condition = threading.Condition()
+_retirer = None
+
+
+def retire_version(version_dir, replaced_blobs=()):
     """
-    Guess the repository from the accession code
-    and process calling the corresponding function
+    Remove a replaced version of a dataset once the requests reading it are done,
+    and the blobs only it used
     """
-    if prefix == settings.MTBLS_ACC_PREFIX:
-        # reposiroty is MetaboLights
-        get_dataset_files_mtbls(prefix, accession)
-    elif prefix == settings.MTWB_ACC_PREFIX:
-        # reposiroty is Metabolomics-Workbench
-        return get_dataset_files_mtwb(prefix, accession)
-    elif prefix == settings.MTBK_ACC_PREFIX:
-        # reposiroty is Metabobank
-        return get_dataset_files_mtbk(prefix, accession)
-    else:
-        logger.debug(f"Dataset repository not found: {accession}")
+    global _retirer
+    # retirement time, for remove_leftover_versions
+    os.utime(version_dir)
+    with _retired_condition:
+        _retired.append((time.time() + settings.DATASETS_RETIRE_GRACE, version_dir, replaced_blobs))
+        if _retirer is None:
+            _retirer = threading.Thread(target=remove_retired_versions,
+                                        name="datasets-retire", daemon=True)
+            _retirer.start()
+        _retired_condition.notify()
+
 
+def remove_retired_versions():
+    while True:
+        with _retired_condition:
+            while not _retired or _retired[0][0] > time.time():
+                _retired_condition.wait(_retired[0][0] - time.time() if _retired else None)
+            remove_at, version_dir, replaced_blobs = _retired.pop(0)
+        logger.debug("Remove replaced version %s", version_dir)
+        shutil.rmtree(version_dir, ignore_errors=True)
+        if replaced_blobs:
+            blobs.collect_garbage(replaced_blobs)
 
-def get_dataset_files_mtbls(prefix, accession):
+
+def remove_leftover_versions(prefix, accession, keep=()):
+    """
+    Remove the versions of a dataset replaced more than DATASETS_RETIRE_GRACE seconds ago
+    and never removed, i.e. by a process stopped meanwhile (their blobs are left to
+    `datasets_cache gc`)
+    """
+    parent_dir = os.path.join(settings.DATASETS_DIR, prefix)
+    for name in os.listdir(parent_dir):
+        path = os.path.join(parent_dir, name)
+        if not name.startswith(f".{accession}.") or path in keep \
+                or os.path.islink(path) or not os.path.isdir(path):
+            continue
+        # staging dirs of the downloads in progress have no markers yet
+        if not any(is_dataset_marker(filename) for filename in os.listdir(path)):
+            continue
+        if time.time() - os.path.getmtime(path) > settings.DATASETS_RETIRE_GRACE:
+            logger.debug("Remove leftover version %s", path)
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def store_dataset_blobs(prefix, accession):
+    """
+    Link the files of a dataset downloaded before DATASETS_STORAGE=blobs to the blob store
+    """
+    local_base_dir = get_dataset_dir(prefix, accession)
+    manifest = {}
+    for root, dirs, files in os.walk(local_base_dir):
+        for file in files:
+            relative_path = os.path.relpath(os.path.join(root, file), local_base_dir)
+            if not is_dataset_marker(relative_path):
+                manifest[relative_path], changed = blobs.store_file(
+                    os.path.join(root, file), os.path.join(root, file))
+    blobs.write_manifest(prefix, accession, manifest)
+    return manifest
+
+
+def get_dataset_size(prefix, accession):
+    """
+    Size in bytes of the local dataset files
+    """
+    size = 0
+    for root, dirs, files in os.walk(get_dataset_dir(prefix, accession)):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+    return size
+
+
+def get_dataset_files_mtbls(prefix, accession, local_base_dir=None, components=("files",)):
     """
     Get a list of datasets from MetaboLights
     https://ftp.ebi.ac.uk/pub/databases/metabolights/studies/public/
+    Only the files of the given components (see DATASET_COMPONENTS)
     """
+    components = get_components(components)
+    local_base_dir = local_base_dir or get_dataset_dir(prefix, accession)
+
+    if components == ("metadata",):
+        # the investigation file name is known, no need to list the study dir
+        get_file_mtbls(accession, settings.MTBLS_FNAME_INVESTIGATION, local_base_dir)
+        return
+
     mtbls_ftp_dataset_path = os.path.join(
         settings.MTBLS_FTP_BASE_DIR, accession)
-    local_base_dir = os.path.join(settings.DATASETS_DIR, prefix, accession)
-
     logger.debug(
-        f"Getting dataset from: {settings.MTBLS_FTP_URL}{settings.MTBLS_FTP_BASE_DIR}")
+        "Getting dataset from: %s%s", settings.MTBLS_FTP_URL, settings.MTBLS_FTP_BASE_DIR)
     try:
-        ftp = ftplib.FTP(settings.MTBLS_FTP_URL,
-                         settings.MTBLS_FTP_USER, settings.MTBLS_FTP_USER_PASS)
-        logger.debug(f"Connected: {settings.MTBLS_FTP_URL}")
-        ftp.cwd(mtbls_ftp_dataset_path)
-        logger.debug(f"Current directory: {mtbls_ftp_dataset_path}")
-        metadata_files = ftp.nlst()
-        for filename in metadata_files:
-            # get metadata files
-            match_files = re.match(r"([siam]).+\.((txt)|(tsv))", filename)
-            if match_files:
-                local_file_path = os.path.join(local_base_dir, filename)
-                url = os.path.join(settings.MTBLS_REMOTE_URL,
-                                   accession, filename)
-                with requests.get(url, stream=True) as req:
-                    if req.status_code == 404:
-                        logger.exception(f"Could not download file {url}")
-                        return None
-                    else:
-                        # create local dir if needed
-                        local_path = os.makedirs(os.path.dirname(
-                            local_file_path), exist_ok=True)
-                        with open(local_file_path, "w") as fd:
-                            fd.write(req.text)
+        # list metadata and result files (the listings are shared by the
+        # fetches of the other components of the dataset)
+        result_files = None
+        metadata_files = list_dir_mtbls(mtbls_ftp_dataset_path)
+        logger.debug("Listed directory: %s", mtbls_ftp_dataset_path)
+        if "rawdata" in components and any(entry["name"] == "FILES" for entry in metadata_files):
             # get result files, within FILES dir
-            if filename == "FILES":
-                logger.debug(
-                    f"Getting result files (within FILES dir) {settings.MTBLS_FTP_URL} : {settings.MTBLS_FTP_BASE_DIR}")
-                ftp.cwd(filename)
-                result_files = ftp.nlst()
-                local_file_path = os.path.join(
-                    local_base_dir, settings.MTBLS_FNAME_RESULT_FILES)
-                # create local dir if needed
-                local_path = os.makedirs(os.path.dirname(
-                    local_file_path), exist_ok=True)
-                with open(local_file_path, 'w') as f:
-                    for file in result_files:
-                        f.write(f"{file}\n")
-        ftp.quit()
+            logger.debug(
+                "Getting result files (within FILES dir) %s : %s",
+                settings.MTBLS_FTP_URL, mtbls_ftp_dataset_path)
+            result_files = list_dir_mtbls(
+                os.path.join(mtbls_ftp_dataset_path, "FILES"),
+                recursive=settings.MTBLS_FTP_RECURSIVE_FILES)
     except ftplib.all_errors as exc:
         logger.exception(exc)
         raise (exc)
 
+    # get metadata files, the investigation and a MAF file are required
+    filenames = [entry["name"] for entry in metadata_files
+                 if get_component_mtbls(accession, entry["name"]) in components]
+    for component in ("metadata", "metabolites"):
+        if component in components and not any(
+                get_component_mtbls(accession, filename) == component for filename in filenames):
+            raise FileNotFoundError(f"No {component} file in {mtbls_ftp_dataset_path}")
+    for filename in filenames:
+        get_file_mtbls(accession, filename, local_base_dir)
+    if result_files is not None:
+        local_file_path = os.path.join(
+            local_base_dir, settings.MTBLS_FNAME_RESULT_FILES)
+        # create local dir if needed
+        local_path = os.makedirs(os.path.dirname(
+            local_file_path), exist_ok=True)
+        with open(local_file_path, 'w') as f:
+            for entry in result_files:
+                if entry["type"] != "dir":
+                    f.write(f"{entry['name']}\n")
+
+
+def list_dir_mtbls(path, recursive=False):
+    """
+    List a dir of the MetaboLights FTP server using a pooled connection,
+    cached like the HTTP listings (see listing.get_cached)
+    """
+    def list_function():
+        with get_mtbls_ftp_pool().connection() as ftp:
+            return list_dir(ftp, path, recursive)
+
+    key = f"ftp://{settings.MTBLS_FTP_URL}{path}{'#recursive' if recursive else ''}"
+    return get_cached(key, list_function)
+
+
+def get_file_mtbls(accession, filename, local_base_dir):
+    """
+    Download a metadata file of a MetaboLights dataset
+    """
+    import requests
+
+    local_file_path = os.path.join(local_base_dir, filename)
+    url = os.path.join(settings.MTBLS_REMOTE_URL,
+                       accession, filename)
+    host = urlparse(url).netloc
+    content = None
+    with get_upstream(url).call(), \
+            UPSTREAM_REQUEST_SECONDS.time("upstream", host=host), \
+            requests.get(url, stream=True, timeout=deadlines.get_upstream_timeouts()) as req:
+        if is_upstream_failure(req.status_code):
+            req.raise_for_status()
+        if req.status_code == 200:
+            content = read_content(req)
+            UPSTREAM_BYTES.inc(len(content), host=host)
+            encoding = req.encoding or "utf-8"
+    # outside of the upstream call, the upstream answered
+    if content is None:
+        raise FileNotFoundError(
+            f"Could not download file {url}")
+    # create local dir if needed
+    local_path = os.makedirs(os.path.dirname(
+        local_file_path), exist_ok=True)
+    with open(local_file_path, "w") as fd:
+        fd.write(content.decode(encoding, errors="replace"))
+
+
+def get_component_mtbls(accession, filename):
+    """
+    Component of a MetaboLights dataset file, None if not a dataset file
+    """
+    if filename == settings.MTBLS_FNAME_INVESTIGATION:
+        return "metadata"
+    if filename == settings.MTBLS_FNAME_RESULT_FILES:
+        return "rawdata"
+    if MTBLS_MAF_FILE_PATTERN.match(filename):
+        return "metabolites"
+    if MTBLS_METADATA_FILE_PATTERN.match(filename):
+        return "files"
+    return None
+
 
-def get_dataset_files_mtwb(prefix, accession):
+def get_dataset_files_mtwb(prefix, accession, local_base_dir=None, components=("files",)):
     """
     Get a list of datasets from Metabolomics-Workbench
     base url :                  https://www.metabolomicsworkbench.org
     {accession}.mwtab.json:     https://www.metabolomicsworkbench.org/data/study_textformat_view.php?JSON=YES&STUDY_ID={study_id}&ANALYSIS_ID={analysis_id}&MODE=d
     {accession}.mwtab.txt:      https://www.metabolomicsworkbench.org/data/study_textformat_view.php?STUDY_ID={study_id}&ANALYSIS_ID={analysis_id}&MODE=d
+    The .json file holds the metadata and the metabolites, the .txt file is only for "files"
     """
-    local_base_dir = os.path.join(settings.DATASETS_DIR, prefix, accession)
-    logger.debug(f"Getting dataset from: {settings.MTWB_REST_BASE_URL}")
+    components = get_components(components)
+    local_base_dir = local_base_dir or get_dataset_dir(prefix, accession)
+    logger.debug("Getting dataset from: %s", settings.MTWB_REST_BASE_URL)
     try:
         # get ANALYSIS_ID
-        url = f"https://www.metabolomicsworkbench.org/rest/study/study_id/{accession}/analysis"
-        logger.debug(f"Get ANALYSIS_ID from: {url}")
-        json_data = get_json_data(url)
-        if json_data:
-            study_id = json_data["study_id"]
-            logger.debug(f"Got study_id: {study_id}")
-            analysis_id = json_data["analysis_id"]
-            logger.debug(f"Got analysis_id: {analysis_id}")
+        url = f"{settings.MTWB_REST_BASE_URL}/rest/study/study_id/{accession}/analysis"
+        logger.debug("Get ANALYSIS_ID from: %s", url)
+        json_data = get_required_data(get_json_data, url)
+        study_id = json_data["study_id"]
+        logger.debug("Got study_id: %s", study_id)
+        analysis_id = json_data["analysis_id"]
+        logger.debug("Got analysis_id: %s", analysis_id)
         # get STxxx.json file
-        url = f"https://www.metabolomicsworkbench.org/data/study_textformat_view.php?JSON=YES&STUDY_ID={study_id}&ANALYSIS_ID={analysis_id}&MODE=d"
-        logger.debug(f"Get STxxx.json file from : {url}")
-        json_data = get_json_data(url)
-        logger.debug(f"Got json_data: {json_data}")
-        if json_data:
-            local_filename = study_id + settings.MTWB_FNAME_JSON_SUFIX
-            logger.debug(
-                f"Save STxxx.json file to : {local_base_dir}/{local_filename}")
-            save_json_data(json_data, local_base_dir, local_filename)
+        url = f"{settings.MTWB_REST_BASE_URL}/data/study_textformat_view.php?JSON=YES&STUDY_ID={study_id}&ANALYSIS_ID={analysis_id}&MODE=d"
+        logger.debug("Get STxxx.json file from : %s", url)
+        json_data = get_required_data(get_json_data, url)
+        logger.debug("Got json_data: %s", PayloadSummary(json_data))
+        local_filename = study_id + settings.MTWB_FNAME_JSON_SUFIX
+        logger.debug(
+            "Save STxxx.json file to : %s/%s", local_base_dir, local_filename)
+        save_json_data(json_data, local_base_dir, local_filename)
+        if "files" not in components:
+            return
         # get STxxx.mwtab.txt file
-        url = f"https://www.metabolomicsworkbench.org/data/study_textformat_view.php?STUDY_ID={study_id}&ANALYSIS_ID={analysis_id}&MODE=d"
-        logger.debug(f"Get STxxx.mwtab.txt file from : {url}")
-        text_data = get_text_data(url)
-        logger.debug(f"Got text_data: {text_data}")
-        if text_data:
-            local_filename = study_id + settings.MTWB_FNAME_MWTAB_SUFIX
-            logger.debug(
-                f"Save STxxx.mwtab.txt file to : {local_base_dir}/{local_filename}")
-            save_text_data(text_data, local_base_dir, local_filename)
+        url = f"{settings.MTWB_REST_BASE_URL}/data/study_textformat_view.php?STUDY_ID={study_id}&ANALYSIS_ID={analysis_id}&MODE=d"
+        logger.debug("Get STxxx.mwtab.txt file from : %s", url)
+        text_data = get_required_data(get_text_data, url)
+        logger.debug("Got text_data: %s", PayloadSummary(text_data))
+        local_filename = study_id + settings.MTWB_FNAME_MWTAB_SUFIX
+        logger.debug(
+            "Save STxxx.mwtab.txt file to : %s/%s", local_base_dir, local_filename)
+        save_text_data(text_data, local_base_dir, local_filename)
     except Exception as exc:
         logger.exception(exc)
         raise (exc)
 
 
-def get_dataset_files_mtbk(prefix, accession):
+def get_dataset_files_mtbk(prefix, accession, local_base_dir=None, components=("files",)):
     """
     Get a list of datasets from Metabobank
     base url :                  https://ddbj.nig.ac.jp/public/metabobank
@@ -216,111 +573,113 @@ def get_dataset_files_mtbk(prefix, accession):
     {accession}.srdf.txt:       https://ddbj.nig.ac.jp/public/metabobank/study/{accession}/{accession}.sdrf.txt
     {accession}.filelist.txt:   https://ddbj.nig.ac.jp/public/metabobank/study/{accession}/{accession}.filelist.txt
     {accession}.maf.yyy.txt:    https://ddbj.nig.ac.jp/public/metabobank/study/{accession}/{accession}.maf.{*}.txt
+    Only the files of the given components (see DATASET_COMPONENTS)
     """
-    local_base_dir = os.path.join(settings.DATASETS_DIR, prefix, accession)
-    logger.debug(f"Getting dataset from: {settings.MTWB_REST_BASE_URL}")
+    components = get_components(components)
+    local_base_dir = local_base_dir or get_dataset_dir(prefix, accession)
+    logger.debug("Getting dataset from: %s", settings.MTBK_BASE_URL)
     try:
         # get xxx.idf.txt file
-        url = f"https://ddbj.nig.ac.jp/public/metabobank/study/{accession}/{accession}.idf.txt"
-        logger.debug(f"Get xxx.idf.txt file from : {url}")
-        text_data = get_text_data(url)
-        logger.debug(f"Got text_data: {text_data}")
-        if text_data:
+        if "metadata" in components:
+            url = f"{settings.MTBK_BASE_URL}/{settings.MTBK_STUDY_CONTEXT}/{accession}/{accession}.idf.txt"
+            logger.debug("Get xxx.idf.txt file from : %s", url)
+            text_data = get_required_data(get_text_data, url)
+            logger.debug("Got text_data: %s", PayloadSummary(text_data))
             local_filename = accession + settings.MTBK_IDF_FILE_PREFIX + settings.MTBK_FILES_SUFIX
             logger.debug(
-                f"Save xxx.idf.txt file to : {local_base_dir}/{local_filename}")
+                "Save xxx.idf.txt file to : %s/%s", local_base_dir, local_filename)
             save_text_data(text_data, local_base_dir, local_filename)
 
         # get xxx.srdf.txt file
-        url = f"https://ddbj.nig.ac.jp/public/metabobank/study/{accession}/{accession}.sdrf.txt"
-        logger.debug(f"Get xxx.srdf.txt file from : {url}")
-        text_data = get_text_data(url)
-        logger.debug(f"Got text_data: {text_data}")
-        if text_data:
+        if "files" in components:
+            url = f"{settings.MTBK_BASE_URL}/{settings.MTBK_STUDY_CONTEXT}/{accession}/{accession}.sdrf.txt"
+            logger.debug("Get xxx.srdf.txt file from : %s", url)
+            text_data = get_required_data(get_text_data, url)
+            logger.debug("Got text_data: %s", PayloadSummary(text_data))
             local_filename = accession + settings.MTBK_SDRF_FILE_PREFIX + settings.MTBK_FILES_SUFIX
             logger.debug(
-                f"Save xxx.srdf.txt file to : {local_base_dir}/{local_filename}")
+                "Save xxx.srdf.txt file to : %s/%s", local_base_dir, local_filename)
             save_text_data(text_data, local_base_dir, local_filename)
 
         # get xxx.filelist.txt file
-        url = f"https://ddbj.nig.ac.jp/public/metabobank/study/{accession}/{accession}.filelist.txt"
-        logger.debug(f"Get xxx.filelist.txt file from : {url}")
-        text_data = get_text_data(url)
-        logger.debug(f"Got text_data: {text_data}")
-        if text_data:
+        if "rawdata" in components:
+            url = f"{settings.MTBK_BASE_URL}/{settings.MTBK_STUDY_CONTEXT}/{accession}/{accession}.filelist.txt"
+            logger.debug("Get xxx.filelist.txt file from : %s", url)
+            text_data = get_required_data(get_text_data, url)
+            logger.debug("Got text_data: %s", PayloadSummary(text_data))
             local_filename = accession + \
                 settings.MTBK_FILELIST_FILE_PREFIX + settings.MTBK_FILES_SUFIX
             logger.debug(
-                f"Save xxx.filelist.txt file to : {local_base_dir}/{local_filename}")
+                "Save xxx.filelist.txt file to : %s/%s", local_base_dir, local_filename)
             save_text_data(text_data, local_base_dir, local_filename)
 
-        # get xxx.maf.yyy.txt files
-        url = f"https://ddbj.nig.ac.jp/public/metabobank/study/{accession}/"
-        logger.debug(f"Get xxx.maf.yyy.txt files from : {url}")
-        html_data = get_text_data(url)
-        logger.debug(f"Got html/text_data: {html_data}")
-        if text_data:
-            # use class HTMLParser o parse html to plain text
-            hf = HTMLFilter()
-            hf.feed(html_data)
-            text_data = hf.text
-            text_data = text_data.split()
-            # get all xxx.maf.yyy.txt files
-            filenames = []
-            for item in text_data:
-                if ".maf." in item:
-                    filenames.append(item.rsplit(".txt", 1)[
-                                     0]+settings.MTBK_FILES_SUFIX)
+        # get xxx.maf.yyy.txt files, listed in the study index page
+        if "metabolites" in components:
+            url = f"{settings.MTBK_BASE_URL}/{settings.MTBK_STUDY_CONTEXT}/{accession}/"
+            logger.debug("Get xxx.maf.yyy.txt files from : %s", url)
+            # a missing study dir is a mistyped (or removed) accession
+            entries = get_required_data(list_url, url)
+            filenames = [entry["name"] for entry in entries
+                         if entry["type"] == "file" and settings.MTBK_MAF_FILE_PREFIX + "." in entry["name"]
+                         and entry["name"].endswith(settings.MTBK_FILES_SUFIX)]
+            if not filenames:
+                raise FileNotFoundError(f"No xxx.maf.yyy.txt file in {url}")
             for filename in filenames:
                 # https://ddbj.nig.ac.jp/public/metabobank/study/{accession}/{filename}
-                url = f"https://ddbj.nig.ac.jp/public/metabobank/study/{accession}/{filename}"
-                logger.debug(f"Get xxx.maf.yyy.txt file from : {url}")
-                text_data = get_text_data(url)
-                logger.debug(f"Got text_data: {text_data}")
-                if text_data:
-                    logger.debug(
-                        f"Save xxx.maf.yyy.txt file to : {local_base_dir}/{filename}")
-                    save_text_data(text_data, local_base_dir, filename)
+                url = f"{settings.MTBK_BASE_URL}/{settings.MTBK_STUDY_CONTEXT}/{accession}/{filename}"
+                logger.debug("Get xxx.maf.yyy.txt file from : %s", url)
+                text_data = get_required_data(get_text_data, url)
+                logger.debug("Got text_data: %s", PayloadSummary(text_data))
+                logger.debug(
+                    "Save xxx.maf.yyy.txt file to : %s/%s", local_base_dir, filename)
+                save_text_data(text_data, local_base_dir, filename)
 
     except Exception as exc:
         logger.exception(exc)
         raise (exc)
 
 
-def parse_dataset_data(prefix, accession):
-    if prefix == settings.MTBLS_ACC_PREFIX:
-        # reposiroty is MetaboLights
-        return parse_dataset_data_mtbls(prefix, accession)
-    elif prefix == settings.MTWB_ACC_PREFIX:
-        # reposiroty is Metabolomics-Workbench
-        return parse_dataset_data_mtwb(prefix, accession)
-    elif prefix == settings.MTBK_ACC_PREFIX:
-        # eposiroty is Metabobank
-        return parse_dataset_data_mtbk(prefix, accession)
-    else:
-        logger.debug(f"Dataset repository not found: {accession}")
+def get_component_mtbk(accession, filename):
+    """
+    Component of a MetaboBank dataset file
+    """
+    if filename == accession + settings.MTBK_IDF_FILE_PREFIX + settings.MTBK_FILES_SUFIX:
+        return "metadata"
+    if filename == accession + settings.MTBK_FILELIST_FILE_PREFIX + settings.MTBK_FILES_SUFIX:
+        return "rawdata"
+    if settings.MTBK_MAF_FILE_PREFIX + "." in filename:
+        return "metabolites"
+    return "files"
 
 
-def parse_dataset_data_mtbls(prefix, accession):
+def parse_dataset_data_mtbls(prefix, accession, components=("files",)):
+    components = get_components(components)
     dataset = {}
     dataset["accession"] = accession
-    local_base_dir = os.path.join(settings.DATASETS_DIR, prefix, accession)
+    # resolved once, the dataset may switch to a new version meanwhile
+    local_base_dir = os.path.realpath(get_dataset_dir(prefix, accession))
     # get metadata parsing the investigation file
-    logger.debug(
-        f"Get metadata parsing the analysis file {accession} : {settings.MTBLS_FNAME_INVESTIGATION}")
-    dataset = get_metadata_mtbls(
-        os.path.join(local_base_dir, settings.MTBLS_FNAME_INVESTIGATION), dataset)
+    if "metadata" in components:
+        logger.debug(
+            "Get metadata parsing the analysis file %s : %s",
+            accession, settings.MTBLS_FNAME_INVESTIGATION)
+        dataset = get_metadata_mtbls(
+            os.path.join(local_base_dir, settings.MTBLS_FNAME_INVESTIGATION), dataset)
     # get raw data file names
-    logger.debug(
-        f"Get raw data file names from dir FILE {accession} : {settings.MTBLS_FNAME_RESULT_FILES}")
-    dataset = get_rawdata_filenames_mtbls(
-        os.path.join(local_base_dir, settings.MTBLS_FNAME_RESULT_FILES), dataset)
+    if "rawdata" in components:
+        logger.debug(
+            "Get raw data file names from dir FILE %s : %s",
+            accession, settings.MTBLS_FNAME_RESULT_FILES)
+        dataset = get_rawdata_filenames_mtbls(
+            os.path.join(local_base_dir, settings.MTBLS_FNAME_RESULT_FILES), dataset)
     # get metabolites names
-    logger.debug(f"Get metabolites names from m_*.tsv file {accession}")
-    dataset = get_metabolites_names_mtbls(local_base_dir, dataset)
+    if "metabolites" in components:
+        logger.debug("Get metabolites names from m_*.tsv file %s", accession)
+        dataset = get_metabolites_names_mtbls(local_base_dir, dataset)
     return dataset
 
 
+@DATASET_PARSE_SECONDS.time("parse", file_type="investigation")
 def get_metadata_mtbls(filename, dataset):
     try:
         with open(filename) as f:
@@ -341,6 +700,7 @@ def get_metadata_mtbls(filename, dataset):
     return dataset
 
 
+@DATASET_PARSE_SECONDS.time("parse", file_type="rawdata_list")
 def get_rawdata_filenames_mtbls(filename, dataset):
     rawdata_filenames = []
     with open(filename) as f:
@@ -351,14 +711,63 @@ def get_rawdata_filenames_mtbls(filename, dataset):
     return dataset
 
 
+def get_maf_filename_mtbls(local_base_dir):
+    """
+    The m_xxx.tsv file of a dataset (the last one found), None if there is none
+    """
+    metabolites_filename = None
+    for root, dirs, files in os.walk(local_base_dir):
+        for file in files:
+            if MTBLS_MAF_FILE_PATTERN.match(file):
+                metabolites_filename = os.path.join(local_base_dir, file)
+    return metabolites_filename
+
+
+def get_maf_filename_mtbk(local_base_dir):
+    """
+    The xxx.maf.yyy.txt file of a dataset (the last one found), None if there is none
+    """
+    metabolites_filename = None
+    for root, dirs, files in os.walk(local_base_dir):
+        for file in files:
+            if "maf" in file:
+                metabolites_filename = os.path.join(local_base_dir, file)
+    return metabolites_filename
+
+
+@DATASET_PARSE_SECONDS.time("parse", file_type="maf_abundances")
+def get_abundances_maf(filename):
+    """
+    Metabolite names, sample names and abundances (metabolites by samples) of
+    a MAF file, for the rows with a metabolite identification (as in the
+    Metabolites list of the dataset)
+    """
+    import numpy as np
+    import pandas as pd
+
+    if not filename:
+        return [], [], np.empty((0, 0))
+    try:
+        df = pd.read_csv(filename, sep='\t')
+        # the samples columns follow the standard ones
+        standard = [i for i, column in enumerate(df.columns) if column in MAF_STANDARD_COLUMNS]
+        samples = [str(column) for column in df.columns[max(standard) + 1:]] if standard else []
+        df = df[df["metabolite_identification"].notna()]
+        values = df.iloc[:, max(standard) + 1:].apply(pd.to_numeric, errors="coerce") \
+            if samples else pd.DataFrame(index=df.index)
+    except Exception as exc:
+        logger.exception(exc)
+        raise (exc)
+    return df["metabolite_identification"].tolist(), samples, values.to_numpy(dtype=np.float64)
+
+
+@DATASET_PARSE_SECONDS.time("parse", file_type="maf")
 def get_metabolites_names_mtbls(local_base_dir, dataset):
+    import pandas as pd
+
     metabolites_names = []
-    metabolites_filename = None
     try:
-        for root, dirs, files in os.walk(local_base_dir):
-            for file in files:
-                if re.match("(m_).+\.(tsv)", file):
-                    metabolites_filename = os.path.join(local_base_dir, file)
+        metabolites_filename = get_maf_filename_mtbls(local_base_dir)
         if metabolites_filename:
             df = pd.read_csv(metabolites_filename, sep='\t')
             column = df["metabolite_identification"]
@@ -374,26 +783,41 @@ def get_metabolites_names_mtbls(local_base_dir, dataset):
     return dataset
 
 
-def parse_dataset_data_mtwb(prefix, accession):
+def parse_dataset_data_mtwb(prefix, accession, components=("files",)):
+    components = get_components(components)
     dataset = {}
     dataset["accession"] = accession
-    local_base_dir = os.path.join(settings.DATASETS_DIR, prefix, accession)
+    # resolved once, the dataset may switch to a new version meanwhile
+    local_base_dir = os.path.realpath(get_dataset_dir(prefix, accession))
 
     # Get metadata parsing STxxx.json file
     local_json_filename = accession + settings.MTWB_FNAME_JSON_SUFIX
-    logger.debug(
-        f"Get metadata parsing STxxx.json file: {local_json_filename}")
-    dataset = get_metadata_mtwb(os.path.join(
-        local_base_dir, local_json_filename), dataset)
+    if "metadata" in components:
+        logger.debug(
+            "Get metadata parsing STxxx.json file: %s", local_json_filename)
+        dataset = get_metadata_mtwb(os.path.join(
+            local_base_dir, local_json_filename), dataset)
     # get metabolites names parsing STxxx.json file
-    logger.debug(
-        f"Get metabolites names parsing STxxx.json file {local_json_filename}")
-    dataset = get_metabolites_names_mtwb(os.path.join(
-        local_base_dir, local_json_filename), dataset)
+    if "metabolites" in components:
+        logger.debug(
+            "Get metabolites names parsing STxxx.json file %s", local_json_filename)
+        dataset = get_metabolites_names_mtwb(os.path.join(
+            local_base_dir, local_json_filename), dataset)
 
     return dataset
 
 
+def get_component_mtwb(accession, filename):
+    """
+    Component of a Metabolomics Workbench dataset file, the .json file
+    holding the metadata (and the metabolites)
+    """
+    if filename == accession + settings.MTWB_FNAME_JSON_SUFIX:
+        return "metadata"
+    return "files"
+
+
+@DATASET_PARSE_SECONDS.time("parse", file_type="study_json")
 def get_metadata_mtwb(filename, dataset):
     try:
         with open(filename, 'r') as json_file:
@@ -416,6 +840,32 @@ def get_metadata_mtwb(filename, dataset):
     return dataset
 
 
+@DATASET_PARSE_SECONDS.time("parse", file_type="study_json")
+def get_abundances_mtwb(filename):
+    """
+    Metabolite names, sample names and abundances (metabolites by samples)
+    of the MS_METABOLITE_DATA of a STxxx.json file
+    """
+    import numpy as np
+    import pandas as pd
+
+    try:
+        with open(filename, 'r') as json_file:
+            json_data = json.load(json_file)
+        entries = [metabolite_data for metabolite_data in json_data["MS_METABOLITE_DATA"]["Data"]
+                   if metabolite_data["Metabolite"]]
+        samples = list(dict.fromkeys(key for metabolite_data in entries for key in metabolite_data
+                                     if key not in MTWB_DATA_LABEL_KEYS))
+        values = pd.DataFrame.from_records(entries, columns=samples).apply(
+            pd.to_numeric, errors="coerce")
+    except Exception as exc:
+        logger.exception(exc)
+        raise (exc)
+    return ([metabolite_data["Metabolite"] for metabolite_data in entries], samples,
+            values.to_numpy(dtype=np.float64).reshape(len(entries), len(samples)))
+
+
+@DATASET_PARSE_SECONDS.time("parse", file_type="study_json")
 def get_metabolites_names_mtwb(filename, dataset):
     metabolites_names = []
     try:
@@ -434,32 +884,38 @@ def get_metabolites_names_mtwb(filename, dataset):
     return dataset
 
 
-def parse_dataset_data_mtbk(prefix, accession):
+def parse_dataset_data_mtbk(prefix, accession, components=("files",)):
+    components = get_components(components)
     dataset = {}
     dataset["accession"] = accession
-    local_base_dir = os.path.join(settings.DATASETS_DIR, prefix, accession)
+    # resolved once, the dataset may switch to a new version meanwhile
+    local_base_dir = os.path.realpath(get_dataset_dir(prefix, accession))
     # Get metadata parsing xxx.idf.txt file
-    local_idf_filename = accession + \
-        settings.MTBK_IDF_FILE_PREFIX + settings.MTBK_FILES_SUFIX
-    logger.debug(
-        f"Get metadata parsing xxx.idf.txt file: {local_idf_filename}")
-    dataset = get_metadata_mtbk(os.path.join(
-        local_base_dir, local_idf_filename), dataset)
+    if "metadata" in components:
+        local_idf_filename = accession + \
+            settings.MTBK_IDF_FILE_PREFIX + settings.MTBK_FILES_SUFIX
+        logger.debug(
+            "Get metadata parsing xxx.idf.txt file: %s", local_idf_filename)
+        dataset = get_metadata_mtbk(os.path.join(
+            local_base_dir, local_idf_filename), dataset)
     # get metabolites names parsing xxx.maf.txt file
-    logger.debug(
-        f"Get metabolites names parsing xxx.maf.yyy.txt {accession}")
-    dataset = get_metabolites_names_mtbk(local_base_dir, dataset)
+    if "metabolites" in components:
+        logger.debug(
+            "Get metabolites names parsing xxx.maf.yyy.txt %s", accession)
+        dataset = get_metabolites_names_mtbk(local_base_dir, dataset)
 
     # get raw data file names parsing xxx.filelist.txt file
-    local_rawdata_filename = accession + \
-        settings.MTBK_FILELIST_FILE_PREFIX + settings.MTBK_FILES_SUFIX
-    logger.debug(
-        f"Get raw data file names from xxx.filelist.txt {accession}")
-    dataset = get_rawdata_filenames_mtbk(os.path.join(
-        local_base_dir, local_rawdata_filename), dataset)
+    if "rawdata" in components:
+        local_rawdata_filename = accession + \
+            settings.MTBK_FILELIST_FILE_PREFIX + settings.MTBK_FILES_SUFIX
+        logger.debug(
+            "Get raw data file names from xxx.filelist.txt %s", accession)
+        dataset = get_rawdata_filenames_mtbk(os.path.join(
+            local_base_dir, local_rawdata_filename), dataset)
     return dataset
 
 
+@DATASET_PARSE_SECONDS.time("parse", file_type="idf")
 def get_metadata_mtbk(filename, dataset):
     try:
         with open(filename) as f:
@@ -480,14 +936,13 @@ def get_metadata_mtbk(filename, dataset):
     return dataset
 
 
+@DATASET_PARSE_SECONDS.time("parse", file_type="maf")
 def get_metabolites_names_mtbk(local_base_dir, dataset):
+    import pandas as pd
+
     metabolites_names = []
-    metabolites_filename = None
     try:
-        for root, dirs, files in os.walk(local_base_dir):
-            for file in files:
-                if "maf" in file:
-                    metabolites_filename = os.path.join(local_base_dir, file)
+        metabolites_filename = get_maf_filename_mtbk(local_base_dir)
         if metabolites_filename:
             df = pd.read_csv(metabolites_filename, sep='\t')
             column = df["metabolite_identification"]
@@ -502,7 +957,10 @@ def get_metabolites_names_mtbk(local_base_dir, dataset):
     return dataset
 
 
+@DATASET_PARSE_SECONDS.time("parse", file_type="filelist")
 def get_rawdata_filenames_mtbk(filename, dataset):
+    import pandas as pd
+
     rawdata_filenames = []
     try:
         df = pd.read_csv(filename, sep='\t')
@@ -518,3 +976,144 @@ def get_rawdata_filenames_mtbk(filename, dataset):
         raise (exc)
     dataset["Rawdata"] = rawdata_filenames
     return dataset
+
+
+def get_dataset_list_mtbls():
+    """
+    Get the list of public studies from MetaboLights
+    https://ftp.ebi.ac.uk/pub/databases/metabolights/studies/public/
+    """
+    logger.debug(
+        "Getting datasets list from: %s%s", settings.MTBLS_FTP_URL, settings.MTBLS_FTP_BASE_DIR)
+    try:
+        with get_mtbls_ftp_pool().connection() as ftp:
+            entries = list_dir(ftp, settings.MTBLS_FTP_BASE_DIR)
+    except ftplib.all_errors as exc:
+        logger.exception(exc)
+        raise (exc)
+    return {entry["name"]: None for entry in entries
+            if MTBLS_ACCESSION_PATTERN.match(entry["name"])}
+
+
+def get_dataset_list_mtwb():
+    """
+    Get the list of available studies from Metabolomics-Workbench
+    https://www.metabolomicsworkbench.org/rest/study/study_id/ST/available
+    """
+    url = f"{settings.MTWB_REST_BASE_URL}/rest/study/study_id/ST/available"
+    logger.debug("Getting datasets list from: %s", url)
+    json_data = get_json_data(url)
+    if not json_data:
+        raise ValueError(f"Could not get datasets list from {url}")
+    # a single study is returned as a dict, many of them as a dict of dicts
+    if "study_id" in json_data:
+        json_data = [json_data]
+    elif isinstance(json_data, dict):
+        json_data = json_data.values()
+    return {study["study_id"]: study.get("study_title")
+            for study in json_data if study.get("study_id")}
+
+
+def get_dataset_list_mtbk():
+    """
+    Get the list of public studies from Metabobank
+    https://ddbj.nig.ac.jp/public/metabobank/study/
+    """
+    url = f"{settings.MTBK_BASE_URL}/{settings.MTBK_STUDY_CONTEXT}/"
+    logger.debug("Getting datasets list from: %s", url)
+    entries = list_url(url)
+    if not entries:
+        raise ValueError(f"Could not get datasets list from {url}")
+    accessions = [entry["name"] for entry in entries
+                  if entry["type"] == "dir" and MTBK_ACCESSION_PATTERN.match(entry["name"])]
+    return dict.fromkeys(accessions)
+
+
+def sync_dataset_list(prefix, repository_name, datasets):
+    """
+    Synchronize the local catalog of datasets with the list of studies
+    available in a repository, given as a dict of accession: title,
+    returning the number of new and removed ones
+    """
+    logger.debug("Got %s datasets from %s", len(datasets), repository_name)
+
+    repository_id = registry.get_repository_id(prefix, repository_name)
+    listed = Dataset.objects.filter(repository_id=repository_id, available=True)
+    known_accessions = set(listed.values_list("accession", flat=True))
+    new_accessions = datasets.keys() - known_accessions
+    removed_accessions = list(known_accessions - datasets.keys())
+
+    # upsert all listed datasets, so previously removed ones become available again
+    now = timezone.now()
+    title_length = Dataset._meta.get_field("title").max_length
+    has_titles = any(datasets.values())
+    update_fields = ["repository", "available", "last_synced"]
+    if has_titles:
+        update_fields.append("title")
+    Dataset.objects.bulk_create(
+        [Dataset(accession=accession, repository_id=repository_id, available=True,
+                 last_synced=now, title=(title or "")[:title_length] or None)
+         for accession, title in datasets.items()],
+        batch_size=settings.CATALOG_BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=["accession"],
+        update_fields=update_fields)
+
+    # flag datasets no longer listed by the repository
+    for i in range(0, len(removed_accessions), settings.CATALOG_BATCH_SIZE):
+        Dataset.objects.filter(
+            accession__in=removed_accessions[i:i + settings.CATALOG_BATCH_SIZE]
+        ).update(available=False, last_synced=now)
+
+    return {"total": len(datasets),
+            "new": len(new_accessions),
+            "removed": len(removed_accessions)}
+
+
+def load_repository_data(file_path):
+    """
+    Create or update the dataset repositories, and their expected files,
+    from a CSV file (see data/dataset_repositories.csv)
+    """
+    import pandas as pd
+
+    df = pd.read_csv(file_path, dtype=str).fillna("")
+    for index, row in df.iterrows():
+        repository, created = DatasetRepository.objects.update_or_create(
+            accession_template=row["Dataset Accession Number"].strip(),
+            defaults={"name": row["Repository Name"].strip(),
+                      "repository_website": row["Repository Website"].strip()})
+        logger.debug("%s dataset repository %s",
+                     "Created" if created else "Updated", repository)
+        for filename in row["Expected Metadata and Result Files"].split():
+            DatasetRepositoryFile.objects.get_or_create(
+                repository=repository, filename=filename)
+
+
+def sync_dataset_metabolites(prefix, repository_name, accession, title, metabolites):
+    """
+    Store the metabolites of a parsed dataset, replacing the previous ones,
+    returning False if they did not change
+    """
+    repository_id = registry.get_repository_id(prefix, repository_name)
+    title_length = Dataset._meta.get_field("title").max_length
+    dataset, created = Dataset.objects.get_or_create(
+        accession=accession,
+        defaults={"repository_id": repository_id, "title": (title or "")[:title_length] or None})
+    ids = set(Metabolite.objects.get_or_create_names(metabolites).values())
+    current = set(DatasetMetabolite.objects.filter(dataset=dataset)
+                  .values_list("metabolite_id", flat=True))
+    if ids == current:
+        return False
+    removed = list(current - ids)
+    logger.debug("Dataset %s metabolites: %d added, %d removed",
+                 accession, len(ids - current), len(removed))
+    with transaction.atomic():
+        for i in range(0, len(removed), settings.CATALOG_BATCH_SIZE):
+            DatasetMetabolite.objects.filter(
+                dataset=dataset, metabolite_id__in=removed[i:i + settings.CATALOG_BATCH_SIZE]).delete()
+        DatasetMetabolite.objects.bulk_create(
+            [DatasetMetabolite(dataset=dataset, metabolite_id=metabolite_id)
+             for metabolite_id in ids - current],
+            batch_size=settings.CATALOG_BATCH_SIZE, ignore_conflicts=True)
+    return True
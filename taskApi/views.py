@@ -1,25 +1,34 @@
 """
 This file contains the views for the taskApi app.
 """
+import ftplib
+import hmac
 import logging
-import os
-import re
+from concurrent.futures import wait
+from functools import wraps
 
 from django.contrib.auth.models import Group, User
-from django.http import Http404, JsonResponse
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse, JsonResponse
 from django_filters import rest_framework as filters
 from rest_framework import mixins, viewsets
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import ParseError
 from rest_framework.filters import OrderingFilter, SearchFilter
 from rest_framework.permissions import IsAuthenticated
 
+from taskApi import abundances, deadlines, matrix, sections, similarity, utils
+from taskApi.deadlines import DeadlineExceeded
+from taskApi.metrics import (DATASET_CACHE_REQUESTS, RESPONSE_ENCODE_SECONDS,
+                             render_metrics)
 from taskApi.models import DatasetRepository
+from taskApi.parsing import ParseUnavailable
+from taskApi.repositories import get_repository
 from taskApi.serializers import (DatasetRepositorySerializer, GroupSerializer,
                                  UserSerializer)
+from taskApi.throttling import UpstreamUnavailable, get_upstream_errors
 from taskPrj import settings
 
-from .utils import get_dataset_data, parse_dataset_data
-
 logger = logging.getLogger(__name__)
 
 
@@ -60,29 +69,414 @@ class DatasetRepositoryInfoView(viewsets.GenericViewSet,
     ordering = ['name']
 
 
+# paginated lists of a dataset, by URL name
+DATASET_SECTIONS = {"metabolites": "Metabolites", "rawdata": "Rawdata"}
+# components parsed by default, all the fields
+PARSED_COMPONENTS = ("metadata", "metabolites", "rawdata")
+
+
+def get_dataset(repository, accession, components=PARSED_COMPONENTS):
+    """
+    Parse some components of a dataset, downloading them first if not
+    in the local cache or expired. Returns the dataset and the components
+    left out, not downloaded within the request deadline.
+    """
+    pending = ensure_dataset(repository, accession, components)
+    components = tuple(component for component in components if component not in pending)
+    if not components:
+        raise DeadlineExceeded()
+    return parse_dataset(repository, accession, components), pending
+
+
+def parse_dataset(repository, accession, components):
+    """
+    Parse some components of the local copy of a dataset
+    """
+    logger.debug("Parse Dataset %s %s", accession, components)
+    dataset = repository.parse(accession, components)
+    if "Metabolites" in dataset:
+        matrix.record(repository, accession, dataset)
+    return dataset
+
+
+def ensure_dataset(repository, accession, components=PARSED_COMPONENTS):
+    """
+    Download some components of a dataset if not in the local cache or expired,
+    waiting at most DATASET_REQUEST_TIMEOUT seconds. Returns the components
+    still being downloaded by then, left to finish in the background.
+    """
+    # check if already downloaded and not expired
+    cache_result = "hit"
+    missing = [component for component in components
+               if not repository.is_fresh(accession, (component, ))]
+    stale = [component for component in missing
+             if repository.is_usable_stale(accession, settings.DATASETS_STALE_WHILE_REVALIDATE,
+                                           (component, ))]
+    if stale:
+        # serve the expired local copy, refreshing it in the background
+        logger.debug("Serve stale Dataset %s %s while revalidating", accession, stale)
+        repository.revalidate(accession, tuple(stale))
+        cache_result = "revalidate"
+    missing = [component for component in missing if component not in stale]
+    pending = []
+    if missing:
+        logger.debug("Get Dataset from the repository: %s %s", accession, missing)
+        cache_result = "miss"
+        # every component on its own, so the ones done in time are served
+        futures = {component: repository.fetch_async(accession, (component, ))
+                   for component in missing}
+        with deadlines.deadline(settings.DATASET_REQUEST_TIMEOUT):
+            done, not_done = wait(set(futures.values()), timeout=deadlines.remaining())
+        for component, future in futures.items():
+            if future in not_done:
+                pending.append(component)
+                continue
+            try:
+                future.result()
+            except (UpstreamUnavailable, DeadlineExceeded) + get_upstream_errors():
+                # serve the stale local copy while the upstream is unhealthy
+                if not repository.is_usable_stale(accession, settings.DATASETS_STALE_IF_ERROR,
+                                                  (component, )):
+                    raise
+                logger.debug("Serve stale Dataset %s %s", accession, component)
+                cache_result = "stale"
+        if pending:
+            logger.debug("Dataset %s %s still being downloaded", accession, pending)
+            cache_result = "pending"
+    DATASET_CACHE_REQUESTS.inc(repository=repository.name, result=cache_result)
+    repository.record_access(accession)
+    return pending
+
+
+def get_fields(request):
+    """
+    Fields of a dataset requested, all of them if none, i.e.: ?fields=Title,Description
+    """
+    fields = [field for value in request.GET.getlist("fields")
+              for field in value.split(",") if field]
+    invalid = [field for field in fields if field not in utils.DATASET_FIELDS]
+    if invalid:
+        raise ParseError(f"Invalid fields: {', '.join(invalid)}")
+    return fields
+
+
+def get_components(fields):
+    """
+    Components of a dataset with the given fields, all of them if none
+    """
+    if not fields:
+        return PARSED_COMPONENTS
+    return tuple(component for component in PARSED_COMPONENTS
+                 if component in {utils.DATASET_FIELDS[field] for field in fields})
+
+
+def unavailable_response(detail, retry_after):
+    response = JsonResponse({"detail": detail}, status=503)
+    response["Retry-After"] = f"{retry_after:.0f}"
+    return response
+
+
+def get_retry_after():
+    return max(1, settings.DATASET_REQUEST_TIMEOUT)
+
+
+def pending_response(accession):
+    return unavailable_response(
+        f"Dataset download not finished in time, still in progress: {accession}", get_retry_after())
+
+
+def matrix_pending_response():
+    return unavailable_response(
+        "Metabolite matrix being built, try again later", get_retry_after())
+
+
+def get_page_params(request):
+    """
+    Page number and size of a request, i.e.: ?page=2&page_size=100
+    """
+    try:
+        page = max(1, int(request.GET.get("page", 1)))
+        page_size = int(request.GET.get("page_size", settings.DATASET_PAGE_SIZE))
+    except ValueError:
+        raise ParseError("Invalid page")
+    return page, min(max(1, page_size), settings.DATASET_MAX_PAGE_SIZE)
+
+
+def dataset_errors(view):
+    """
+    Responses of the errors getting a dataset: 503 if its repository or the
+    parsing is unavailable, or if it was not downloaded in time, 404 if a file
+    of the dataset is missing. Any other error is left to be a 500.
+    """
+    @wraps(view)
+    def wrapper(request, *args, accession=None, **kwargs):
+        try:
+            return view(request, *args, accession=accession, **kwargs)
+        except UpstreamUnavailable as exc:
+            return unavailable_response(
+                f"Dataset repository temporarily unavailable: {get_repository(accession)}",
+                exc.retry_after)
+        except ParseUnavailable as exc:
+            return unavailable_response(
+                f"Dataset parsing temporarily unavailable: {accession}", exc.retry_after)
+        except DeadlineExceeded:
+            return pending_response(accession)
+        except get_upstream_errors():
+            return unavailable_response(
+                f"Dataset repository temporarily unavailable: {get_repository(accession)}",
+                get_retry_after())
+        except (FileNotFoundError, ftplib.error_perm):
+            raise Http404(f"Dataset not found: {accession}")
+    return wrapper
+
+
 @api_view(['GET'])
+@dataset_errors
 def view_DatasetDetails(request, accession=None):
+    """
+    Dataset details. With ?page_size=N only the first N metabolites and raw data
+    files are returned, read from the sections store, with their total in
+    Metabolites_count and Rawdata_count.
+    With ?fields=Title,Description only those fields are returned, downloading
+    only the files needed for them
+    """
 
     # check accession code
-    if re.match(r"^(MTBLS\w+)", accession):
-        prefix = settings.MTBLS_ACC_PREFIX
-    elif re.match(r"^(ST\w+)", accession):
-        prefix = settings.MTWB_ACC_PREFIX
-    elif re.match(r"^(MTBK\w+)", accession):
-        prefix = settings.MTBK_ACC_PREFIX
-    else:
+    repository = get_repository(accession)
+    if repository is None:
+        raise Http404(f"Invalid accession code: {str(accession)}")
+    fields = get_fields(request)
+    components = get_components(fields)
+
+    pending = ensure_dataset(repository, accession, components)
+    components = tuple(component for component in components if component not in pending)
+    if not components:
+        raise DeadlineExceeded()
+    # the first page of the paged sections is read from the sections store,
+    # not parsed with the rest of the dataset
+    paged = {}
+    if "page_size" in request.GET:
+        page, page_size = get_page_params(request)
+        paged = {section: utils.DATASET_FIELDS[section] for section in DATASET_SECTIONS.values()
+                 if (not fields or section in fields) and utils.DATASET_FIELDS[section] in components}
+    parsed = tuple(component for component in components if component not in paged.values())
+    dataset = parse_dataset(repository, accession, parsed) if parsed else {"accession": accession}
+
+    if fields:
+        dataset = {key: value for key, value in dataset.items()
+                   if key == "accession" or key in fields}
+    for section, component in paged.items():
+        items, count = sections.get_page(
+            repository, accession, section, 0, page_size,
+            lambda component=component: parse_dataset(repository, accession, (component, )))
+        dataset[section] = items
+        dataset[f"{section}_count"] = count
+
+    with RESPONSE_ENCODE_SECONDS.time("encode", view="dataset_details"):
+        if not pending:
+            return JsonResponse(dataset)
+        # partial dataset, the pending components are still being downloaded
+        dataset["pending"] = pending
+        response = JsonResponse(dataset, status=202)
+        response["Retry-After"] = f"{get_retry_after():.0f}"
+        return response
+
+
+@api_view(['GET'])
+@dataset_errors
+def view_DatasetSection(request, accession=None, section=None):
+    """
+    One page of the metabolites or raw data files of a dataset, i.e.:
+    /api/dataset/MTBLS1/metabolites/?page=2&page_size=100
+    """
+    repository = get_repository(accession)
+    if repository is None:
         raise Http404(f"Invalid accession code: {str(accession)}")
+    if section not in DATASET_SECTIONS:
+        raise ParseError(f"Invalid section: {section}, must be one of: {', '.join(DATASET_SECTIONS)}")
+    page, page_size = get_page_params(request)
+    field = DATASET_SECTIONS[section]
+    components = (utils.DATASET_FIELDS[field], )
+    start = (page - 1) * page_size
+
+    if ensure_dataset(repository, accession, components):
+        return pending_response(accession)
+    items, count = sections.get_page(
+        repository, accession, field, start, page_size,
+        lambda: parse_dataset(repository, accession, components))
+
+    with RESPONSE_ENCODE_SECONDS.time("encode", view="dataset_section"):
+        return JsonResponse({"accession": accession,
+                             "count": count,
+                             "page": page,
+                             "page_size": page_size,
+                             "has_next": start + page_size < count,
+                             "results": items})
+
+
+@api_view(['GET'])
+@dataset_errors
+def view_DatasetSimilar(request, accession=None):
+    """
+    Datasets with the most similar metabolites (estimated Jaccard index), among
+    the ones already parsed, i.e.: /api/dataset/MTBLS1/similar/?k=10
+    """
+    repository = get_repository(accession)
+    if repository is None:
+        raise Http404(f"Invalid accession code: {str(accession)}")
+    k = get_k(request)
+
+    dataset, pending = get_dataset(repository, accession, ("metabolites", ))
+
+    metabolites = dataset.get("Metabolites", [])
+    with RESPONSE_ENCODE_SECONDS.time("encode", view="dataset_similar"):
+        return JsonResponse({"accession": accession,
+                             "metabolites": len(set(metabolites)),
+                             "results": similarity.find_similar(accession, metabolites, k)})
 
-    local_path = os.path.join(settings.DATASETS_DIR, prefix, accession)
+
+@api_view(['GET'])
+@dataset_errors
+def view_DatasetAbundances(request, accession=None):
+    """
+    Abundances of a dataset, for some metabolites and samples (all of them
+    by default), one page of metabolites at a time, i.e.:
+    /api/dataset/MTBLS1/abundances/?metabolite=Glucose&sample=S1&sample=S2
+    /api/dataset/ST000001/abundances/?page=2&page_size=100
+    """
+    repository = get_repository(accession)
+    if repository is None:
+        raise Http404(f"Invalid accession code: {str(accession)}")
+    page, page_size = get_page_params(request)
+
+    if ensure_dataset(repository, accession, ("metabolites", )):
+        return pending_response(accession)
+    abundance_matrix = abundances.get_matrix(repository, accession)
+
+    missing = []
+    if request.GET.getlist("metabolite"):
+        rows, missing = abundance_matrix.get_rows(request.GET.getlist("metabolite"))
+    else:
+        rows = list(range(len(abundance_matrix.metabolites)))
+    if request.GET.getlist("sample"):
+        columns, missing_samples = abundance_matrix.get_columns(request.GET.getlist("sample"))
+        if missing_samples:
+            raise Http404(f"Samples not found: {', '.join(missing_samples)}")
+    else:
+        columns = list(range(len(abundance_matrix.samples)))
+    start = (page - 1) * page_size
+    page_rows = rows[start:start + page_size]
+    with RESPONSE_ENCODE_SECONDS.time("encode", view="dataset_abundances"):
+        return JsonResponse({"accession": accession,
+                             "count": len(rows),
+                             "page": page,
+                             "page_size": page_size,
+                             "has_next": start + page_size < len(rows),
+                             "missing": missing,
+                             "samples": [abundance_matrix.samples[column] for column in columns],
+                             "metabolites": [abundance_matrix.metabolites[row] for row in page_rows],
+                             "values": abundance_matrix.get_slice(page_rows, columns)})
+
+
+def get_k(request):
+    """
+    Number of results of a metabolites query, i.e.: ?k=20
+    """
     try:
-        # check if already downloaded
-        if not os.path.exists(local_path):
-            logger.debug(f"Get Dataset for the first time: {accession}")
-            get_dataset_data(prefix, accession)
-        # parse local cache data
-        logger.debug(f"Parse Dataset {accession}")
-        dataset = parse_dataset_data(prefix, accession)
-    except Exception as ex:
-        raise Http404(f"Dataset not found: {accession}")
-
-    return JsonResponse(dataset)
+        k = int(request.GET.get("k", settings.METABOLITE_TOP_K))
+    except ValueError:
+        raise ParseError("Invalid k")
+    return min(max(1, k), settings.METABOLITE_MAX_K)
+
+
+@api_view(['GET'])
+def view_MetaboliteCounts(request):
+    """
+    Number of studies reporting each metabolite, by repository, i.e.:
+    /api/metabolites/counts/?name=Glucose&name=L-Alanine
+    """
+    names = request.GET.getlist("name")
+    if not names:
+        raise Http404("No metabolite name")
+    metabolite_matrix = matrix.get_matrix()
+    if metabolite_matrix is None:
+        return matrix_pending_response()
+    results = []
+    for name in names:
+        column = metabolite_matrix.get_column(name)
+        if column is None:
+            counts = dict.fromkeys(metabolite_matrix.repositories, 0)
+        else:
+            name = metabolite_matrix.get_metabolite(column)
+            counts = metabolite_matrix.get_counts(column)
+        results.append({"name": name, "studies": sum(counts.values()), "repositories": counts})
+    return JsonResponse({"studies": metabolite_matrix.count_studies(), "results": results})
+
+
+@api_view(['GET'])
+def view_MetaboliteTop(request):
+    """
+    Metabolites reported by the most studies, of all the repositories or one, i.e.:
+    /api/metabolites/top/?k=20&repository=MetaboLights
+    """
+    repository = request.GET.get("repository")
+    metabolite_matrix = matrix.get_matrix()
+    if metabolite_matrix is None:
+        return matrix_pending_response()
+    counts = metabolite_matrix.get_column_counts(repository=repository)
+    return JsonResponse({"repository": repository,
+                         "results": [{"name": metabolite_matrix.get_metabolite(column),
+                                      "studies": int(counts[column])}
+                                     for column in metabolite_matrix.top(counts, get_k(request))]})
+
+
+@api_view(['GET'])
+def view_MetaboliteCooccurrence(request):
+    """
+    Metabolites reported by the most studies also reporting a given one, with
+    the Jaccard index of both sets of studies, i.e.:
+    /api/metabolites/cooccurrence/?name=Glucose&k=20&repository=MetaboBank
+    """
+    name = request.GET.get("name")
+    repository = request.GET.get("repository")
+    metabolite_matrix = matrix.get_matrix()
+    if metabolite_matrix is None:
+        return matrix_pending_response()
+    column = metabolite_matrix.get_column(name) if name else None
+    if column is None:
+        raise Http404(f"Metabolite not found: {name}")
+    studies = metabolite_matrix.get_studies(column, repository)
+    counts = metabolite_matrix.get_column_counts(studies)
+    counts[column] = 0
+    totals = metabolite_matrix.get_column_counts(repository=repository)
+    results = []
+    for other in metabolite_matrix.top(counts, get_k(request)):
+        count = int(counts[other])
+        results.append({"name": metabolite_matrix.get_metabolite(other),
+                        "studies": count,
+                        "jaccard": round(count / (len(studies) + int(totals[other]) - count), 4)})
+    return JsonResponse({"name": metabolite_matrix.get_metabolite(column),
+                         "repository": repository,
+                         "studies": len(studies),
+                         "results": results})
+
+
+def is_metrics_client(request):
+    """
+    Whether the request comes from an allowed address or has the metrics token
+    """
+    if request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS:
+        return True
+    authorization = request.headers.get("Authorization", "")
+    return bool(settings.METRICS_TOKEN) and hmac.compare_digest(
+        authorization.encode(), f"Bearer {settings.METRICS_TOKEN}".encode())
+
+
+def view_Metrics(request):
+    """
+    Runtime metrics of this process, in Prometheus text format
+    """
+    if not is_metrics_client(request):
+        raise PermissionDenied("Metrics not allowed")
+    return HttpResponse(render_metrics(),
+                        content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import json
 import os
 from pathlib import Path
 
@@ -53,6 +54,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'taskApi.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -89,9 +91,19 @@ WSGI_APPLICATION = 'taskPrj.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.getenv('DATABASE_PATH', default=BASE_DIR / 'db.sqlite3'),
     }
 }
+# set on every new SQLite connection: write-ahead log, so reads do not wait
+# for writes, and wait for locks instead of failing with "database is locked"
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "cache_size": -32000,  # 32MB
+    "temp_store": "MEMORY",
+    "mmap_size": 268435456,  # 256MB
+}
 
 
 # Password validation
@@ -131,16 +143,18 @@ USE_TZ = True
 STATIC_URL = 'static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_ROOT = "files/"
-DATASETS_DIR = os.path.join(BASE_DIR, MEDIA_ROOT, 'datasets')
+DATASETS_DIR = os.getenv('DATASETS_DIR', default=os.path.join(BASE_DIR, MEDIA_ROOT, 'datasets'))
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-LOGS_PATH = os.path.join(BASE_DIR, "logs")
-if not os.path.exists(LOGS_PATH):
-    os.mkdir(LOGS_PATH)
+# created by the log handler if missing
+LOGS_PATH = os.getenv('LOGS_PATH', default=os.path.join(BASE_DIR, "logs"))
+# log level, and log format: simple | json
+LOG_LEVEL = os.getenv('LOG_LEVEL', default="INFO")
+LOG_FORMAT = os.getenv('LOG_FORMAT', default="simple")
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -149,29 +163,38 @@ LOGGING = {
             "format": "{asctime} {levelname} {message}",
             "style": "{",
         },
+        "json": {
+            "()": "taskApi.log.JsonFormatter",
+        },
     },
     "handlers": {
         "file": {
             "level": "DEBUG",
-            "class": "logging.handlers.RotatingFileHandler",
+            # written from a background thread, records are dropped if the queue is full
+            "class": "taskApi.log.QueueRotatingFileHandler",
             "filename": os.path.join(LOGS_PATH, APP_NAME+".log"),
             "maxBytes": 1024 * 1024 * 50,  # 50MB
             "backupCount": 7,
-            "formatter": "simple",
+            "queueSize": 10000,
+            "formatter": LOG_FORMAT,
         },
     },
     "loggers": {
         "django.utils.autoreload": {
             "level": "INFO",
         },
+        # every SQL query at DEBUG level
+        "django.db.backends": {
+            "level": "WARNING",
+        },
         "django": {
             "handlers": ["file"],
-            "level": "DEBUG",
+            "level": LOG_LEVEL,
             "propagate": True,
         },
         "": {
             "handlers": ["file"],
-            "level": "DEBUG",
+            "level": LOG_LEVEL,
             "propagate": True,
         },
     },
@@ -209,27 +232,157 @@ SWAGGER_SETTINGS = {
     "exclude_namespaces": ["internal_apis"],  # List URL namespaces to ignore
 }
 
+# admin lists of tables over this number of rows show an estimated count,
+# and long text fields truncated to this length
+ADMIN_COUNT_ESTIMATE_THRESHOLD = 100000
+ADMIN_TEXT_EXCERPT_LENGTH = 100
+
 # Global settings for different datasets repositories
+# seconds the repositories registry loaded from the database is kept in memory
+REPOSITORY_REGISTRY_TTL = 300
 # reposiroty is MetaboLights
 MTBLS_ACC_PREFIX = "MTBLS"
-MTBLS_FTP_URL = "ftp.ebi.ac.uk"
+MTBLS_FTP_URL = os.getenv('MTBLS_FTP_URL', default="ftp.ebi.ac.uk")
+MTBLS_FTP_PORT = int(os.getenv('MTBLS_FTP_PORT', default="21"))
 MTBLS_FTP_USER = "anonymous"
 MTBLS_FTP_USER_PASS = "task_JR538"
 MTBLS_FTP_BASE_DIR = "/pub/databases/metabolights/studies/public/"
-MTBLS_REMOTE_URL = "https://ftp.ebi.ac.uk/pub/databases/metabolights/studies/public/"
+MTBLS_REMOTE_URL = os.getenv(
+    'MTBLS_REMOTE_URL', default="https://ftp.ebi.ac.uk/pub/databases/metabolights/studies/public/")
 MTBLS_FNAME_INVESTIGATION = "i_Investigation.txt"
 MTBLS_FNAME_RESULT_FILES = "rawdata_files.txt"
+# pool of FTP connections, kept alive sending NOOP every MTBLS_FTP_KEEPALIVE seconds
+MTBLS_FTP_POOL_SIZE = int(os.getenv('MTBLS_FTP_POOL_SIZE', default="4"))
+MTBLS_FTP_KEEPALIVE = 30
+# list also the subdirectories within the FILES dir
+MTBLS_FTP_RECURSIVE_FILES = True
+# max. number of datasets fetched at the same time, and seconds a local copy
+# is considered fresh (one week by default, empty means forever)
+MTBLS_MAX_CONCURRENT_FETCHES = 4
+MTBLS_CACHE_TTL = float(os.getenv('MTBLS_CACHE_TTL', default="604800") or "inf")
 # reposiroty is Metabolomics-Workbench
 MTWB_ACC_PREFIX = "ST"
-MTWB_REST_BASE_URL = "https://www.metabolomicsworkbench.org"
+MTWB_REST_BASE_URL = os.getenv(
+    'MTWB_REST_BASE_URL', default="https://www.metabolomicsworkbench.org")
 MTWB_FNAME_JSON_SUFIX = ".json"
 MTWB_FNAME_MWTAB_SUFIX = ".mwtab.txt"
+MTWB_MAX_CONCURRENT_FETCHES = 4
+MTWB_CACHE_TTL = float(os.getenv('MTWB_CACHE_TTL', default="604800") or "inf")
 # reposiroty is MetaboBank
 MTBK_ACC_PREFIX = "MTBK"
-MTBK_BASE_URL = "https://ddbj.nig.ac.jp/public/metabobank"
+MTBK_BASE_URL = os.getenv(
+    'MTBK_BASE_URL', default="https://ddbj.nig.ac.jp/public/metabobank")
 MTBK_STUDY_CONTEXT = "study"
 MTBK_IDF_FILE_PREFIX = ".idf"
 MTBK_SDRF_FILE_PREFIX = ".sdrf"
 MTBK_FILELIST_FILE_PREFIX = ".filelist"
 MTBK_MAF_FILE_PREFIX = ".maf"
 MTBK_FILES_SUFIX = ".txt"
+MTBK_MAX_CONCURRENT_FETCHES = 4
+MTBK_CACHE_TTL = float(os.getenv('MTBK_CACHE_TTL', default="604800") or "inf")
+
+# directory listings (MetaboBank study folders over HTTP, MetaboLights study
+# folders over FTP) are reused for this many seconds
+HTTP_LISTING_TTL = int(os.getenv('HTTP_LISTING_TTL', default="60"))
+# max. number of directory listings kept in memory
+HTTP_LISTING_CACHE_SIZE = 1000
+
+# Local datasets cache
+# empty file written once all the dataset files were downloaded
+DATASET_COMPLETE_MARKER = ".complete"
+# cache warming (manage.py warm_cache)
+WARM_CACHE_WORKERS = int(os.getenv('WARM_CACHE_WORKERS', default="4"))
+# seconds after the TTL an expired dataset is still served while it is refreshed
+# in the background, and served if its refresh fails (empty means no limit, 0 never)
+DATASETS_STALE_WHILE_REVALIDATE = float(
+    os.getenv('DATASETS_STALE_WHILE_REVALIDATE', default="") or "inf")
+DATASETS_STALE_IF_ERROR = float(os.getenv('DATASETS_STALE_IF_ERROR', default="") or "inf")
+# seconds a replaced version of a dataset is kept for the requests still reading it
+DATASETS_RETIRE_GRACE = 60
+# metabolites and raw data files per page (results page, paginated API)
+DATASET_PAGE_SIZE = 100
+DATASET_MAX_PAGE_SIZE = 1000
+# parse datasets in the request thread (inline) or in a pool of worker processes
+# (process), with max. tasks pending or running and seconds to wait for each task
+PARSE_BACKEND = os.getenv('PARSE_BACKEND', default="inline")
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', default=str(os.cpu_count() or 1)))
+PARSE_QUEUE_SIZE = 32
+PARSE_TIMEOUT = 30
+# max. size in bytes of the local datasets cache (0 means no limit), evicting
+# the least recently (lru) or least frequently (lfu) used datasets first
+DATASETS_CACHE_QUOTA = int(os.getenv('DATASETS_CACHE_QUOTA', default="0"))
+DATASETS_CACHE_POLICY = os.getenv('DATASETS_CACHE_POLICY', default="lru")
+# accession numbers never evicted, i.e.: MTBLS1,ST000001
+DATASETS_CACHE_PINNED = [accession for accession in os.getenv(
+    'DATASETS_CACHE_PINNED', default="").split(",") if accession]
+# size, last access and hits of every dataset
+DATASETS_CACHE_INDEX = os.path.join(DATASETS_DIR, ".cache_index.json")
+# seconds between writes of the accesses to the index, and between background sweeps
+DATASETS_CACHE_FLUSH_INTERVAL = 10
+DATASETS_CACHE_SWEEP_INTERVAL = 300
+# local datasets storage: "files" (a copy of every file per dataset) or "blobs" (every
+# distinct file stored once by its hash, the datasets dirs holding hardlinks to them)
+DATASETS_STORAGE = os.getenv('DATASETS_STORAGE', default="files")
+DATASETS_BLOBS_DIR = os.path.join(DATASETS_DIR, ".blobs")
+# storage shared by all the nodes, the local datasets dir being a cache in front of it:
+# a Django storage backend (i.e. storages.backends.s3.S3Storage) and its options as JSON,
+# i.e. {"bucket_name": "datasets", "endpoint_url": "http://127.0.0.1:9000"}. Disabled if empty.
+DATASETS_SHARED_STORAGE = os.getenv('DATASETS_SHARED_STORAGE', default="")
+DATASETS_SHARED_STORAGE_OPTIONS = json.loads(
+    os.getenv('DATASETS_SHARED_STORAGE_OPTIONS', default="{}"))
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+    "datasets": {"BACKEND": DATASETS_SHARED_STORAGE or "django.core.files.storage.FileSystemStorage",
+                 "OPTIONS": DATASETS_SHARED_STORAGE_OPTIONS},
+}
+# abundances (metabolites by samples) of every dataset, extracted as NumPy files
+DATASETS_COLUMNAR_DIR = os.path.join(DATASETS_DIR, ".columnar")
+# metabolites and raw data files of every dataset, as parsed, to read them one page at a time
+DATASETS_SECTIONS_DIR = os.path.join(DATASETS_DIR, ".sections")
+# study-by-metabolite matrix (numpy arrays, memory-mapped), built once from the DatasetMetabolite
+# table, with the datasets stored later in a delta merged once it holds METABOLITE_MATRIX_MERGE_SIZE
+METABOLITE_MATRIX_DIR = os.path.join(DATASETS_DIR, ".matrix")
+METABOLITE_MATRIX_MERGE_SIZE = int(os.getenv('METABOLITE_MATRIX_MERGE_SIZE', default="100"))
+# parsed datasets waiting to have their metabolites stored
+METABOLITE_MATRIX_QUEUE_SIZE = 1000
+# default and max. number of results of the metabolites queries (?k=)
+METABOLITE_TOP_K = 20
+METABOLITE_MAX_K = 1000
+# similar datasets search: MinHash signature size, and number of LSH bands (must divide it).
+# Datasets sharing all the values of any band are compared, 32 bands of 4 values find most
+# datasets with a Jaccard index over ~0.4
+SIMILARITY_PERMUTATIONS = 128
+SIMILARITY_BANDS = 32
+# repositories catalog (manage.py get_dataset_list)
+CATALOG_BATCH_SIZE = 500
+# upstream servers rate limit (requests per second and host, 0 means no limit),
+# with optional per host values, i.e.: {"ftp.ebi.ac.uk": 2}
+UPSTREAM_RATE_LIMIT = float(os.getenv('UPSTREAM_RATE_LIMIT', default="5"))
+UPSTREAM_RATE_LIMITS = {}
+UPSTREAM_RATE_BURST = 10
+# seconds a request may wait for its turn before giving up
+UPSTREAM_MAX_WAIT = 30
+# consecutive errors opening the circuit, and seconds before trying again
+UPSTREAM_FAILURE_THRESHOLD = 5
+UPSTREAM_RESET_TIMEOUT = 60
+# rate limit and circuit state, shared by all the worker processes
+UPSTREAM_STATE_DIR = os.getenv(
+    'UPSTREAM_STATE_DIR', default=os.path.join(BASE_DIR, MEDIA_ROOT, 'upstreams'))
+# seconds to connect to an upstream server, and to wait for its data (per read,
+# also bounding the FTP commands)
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', default="5"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv('UPSTREAM_READ_TIMEOUT', default="30"))
+# seconds an API request waits for the datasets downloads (the ones not done by then
+# go on in the background, returning what is available), and max. seconds of every
+# download, 0 means no limit
+DATASET_REQUEST_TIMEOUT = float(os.getenv('DATASET_REQUEST_TIMEOUT', default="10"))
+DATASET_FETCH_TIMEOUT = float(os.getenv('DATASET_FETCH_TIMEOUT', default="600"))
+# runtime metrics (/metrics), add the time of each stage to the
+# Server-Timing header of the responses
+METRICS_SERVER_TIMING = os.getenv('METRICS_SERVER_TIMING', default="False") == "True"
+# addresses allowed to read /metrics, i.e.: 127.0.0.1,10.0.0.5, and token
+# of the other clients (Authorization: Bearer <token>), empty to disable it
+METRICS_ALLOWED_IPS = [address for address in os.getenv(
+    'METRICS_ALLOWED_IPS', default="127.0.0.1,::1").split(",") if address]
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', default="")
@@ -4,8 +4,11 @@ URL configuration for taskPrj project.
 from django.contrib import admin
 from django.urls import include, path, re_path
 
+from taskApi import views
+
 urlpatterns = [
     path("api/", include(('taskApi.urls', 'api'), namespace='api')),
     path("admin/", admin.site.urls, name="admin"),
+    path("metrics", views.view_Metrics, name="metrics"),
     path('', include(('taskWebapp.urls', 'web'), namespace='web')),
 ]
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'taskPrj.settings')
 
 application = get_wsgi_application()
+
+# import the heavy modules and load the caches before the workers are forked
+if os.getenv('PRELOAD_APP', default="False") == "True":
+    from taskApi.preload import preload
+    preload()
@@ -1,17 +1,20 @@
 """
 This file contains the views for the taskWebapp app.
 """
+import ftplib
 import mimetypes
 import os
-import re
 
-import requests
 from django.http import (FileResponse, Http404, HttpResponse,
                          HttpResponseRedirect)
 from django.shortcuts import render
 from django.template import loader
 from django.urls import reverse
 
+from taskApi.deadlines import DeadlineExceeded
+from taskApi.repositories import get_repository
+from taskApi.throttling import UpstreamUnavailable, get_upstream_errors
+from taskApi.views import ensure_dataset
 from taskPrj import settings
 
 from .forms import DsSearchForm
@@ -30,16 +33,25 @@ def home(request):
 
 
 def ds_details_view(request, accession):
+    import requests
+
     data = {}
     # call the API endpoint to get dataset details
+    # only the first page of metabolites and raw data files,
+    # the next ones are loaded by the page from the API
     url = request.build_absolute_uri(
         reverse('api:dataset_details', args=(accession, )))
-    with requests.get(url, stream=True) as req:
-        if req.status_code == 200:
+    # the API waits at most DATASET_REQUEST_TIMEOUT seconds for the downloads,
+    # then returns a partial dataset (202) if some parts are still downloading
+    with requests.get(url, params={"page_size": settings.DATASET_PAGE_SIZE}, stream=True,
+                      timeout=(settings.UPSTREAM_CONNECT_TIMEOUT,
+                               settings.DATASET_REQUEST_TIMEOUT + settings.UPSTREAM_READ_TIMEOUT)) as req:
+        if req.status_code in (200, 202):
             json_data = req.json()
             data = json_data
         else:
             raise Http404()
+    data["page_size"] = settings.DATASET_PAGE_SIZE
 
     return render(request, "results.html", data)
 
@@ -56,28 +68,34 @@ def get_dataset(request):
     return render(request, "search.html", {"form": form})
 
 
+def retry_later_response(message):
+    response = HttpResponse(message, status=503)
+    response["Retry-After"] = f"{max(1, settings.DATASET_REQUEST_TIMEOUT):.0f}"
+    return response
+
+
 def download_file(request, accession, filetype="metadata"):
     """
     Download the metadata files
     """
     # check accession code
-    if re.match(r"^(MTBLS\w+)", accession):
-        prefix = settings.MTBLS_ACC_PREFIX
-        if filetype == "metadata":
-            filename = "i_Investigation.txt"
-        elif filetype == "metabolites":
-            filename = f"m_{accession}_*_maf.tsv"
-        elif filetype == "rawdata":
-            filename = "i_Investigation.txt"
-
-    elif re.match(r"^(ST\w+)", accession):
-        prefix = settings.MTWB_ACC_PREFIX
-        filename = f"{accession}.mwtab.txt"
-    elif re.match(r"^(MTBK\w+)", accession):
-        prefix = settings.MTBK_ACC_PREFIX
-        filename = f"{accession}.idf.txt"
-
-    filepath = os.path.join(settings.DATASETS_DIR, prefix, accession, filename)
+    repository = get_repository(accession)
+    if repository is None:
+        raise Http404()
+    # the details page only downloads the files it shows
+    try:
+        pending = ensure_dataset(repository, accession, (repository.download_component(filetype), ))
+    except (UpstreamUnavailable, DeadlineExceeded) + get_upstream_errors():
+        return retry_later_response("Dataset repository temporarily unavailable, try again later")
+    except (FileNotFoundError, ftplib.error_perm):
+        raise Http404()
+    if pending:
+        return retry_later_response("Download in progress, try again in a few seconds")
+    filename = repository.download_filename(accession, filetype)
+    if filename is None:
+        raise Http404()
+
+    filepath = os.path.join(settings.DATASETS_DIR, repository.prefix, accession, filename)
 
     try:
         path = open(filepath, "r")